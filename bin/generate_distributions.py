@@ -1,15 +1,41 @@
 import ConfigParser
 import sys
 
+import numpy as np
+
+import utils.station
+
 __author__ = 'Andrew A Campbell'
 
+"""
+Builds the count and speed distributions of every station time series. Reads each station once and writes a
+distributions.npz with the full (day, slot, bin) tensors of both metrics. Optionally also writes the legacy per-day csv
+files used by utils.station.group_days.
+"""
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print 'ERROR: need to supply the path to the conifg file'
     config_path = sys.argv[1]
     conf = ConfigParser.ConfigParser()
     conf.read(config_path)
+    # Paths
+    station_dir = conf.get('Paths', 'station_dir')  # Parent directory of all the station time series
+    # Params
+    # Bins are defined as: start, stop, step. The stop value is included as the last bin edge.
+    start, stop, step = [float(s) for s in conf.get('Params', 'count_bins').split(',')]
+    count_bins = list(np.arange(start, stop + step/2.0, step))
+    start, stop, step = [float(s) for s in conf.get('Params', 'speed_bins').split(',')]
+    speed_bins = list(np.arange(start, stop + step/2.0, step))
+    n_workers = 1
+    if conf.has_option('Params', 'n_workers'):
+        n_workers = conf.getint('Params', 'n_workers')
+    legacy_csv = True  # Write the per-day csv files
+    if conf.has_option('Params', 'legacy_csv'):
+        legacy_csv = conf.getboolean('Params', 'legacy_csv')
 
-
-    # For each station
-        # read into a df
\ No newline at end of file
+    ##
+    # 1 - Build the distributions of every station
+    ##
+    utils.station.generate_all_distributions(station_dir, count_bins, speed_bins, n_workers=n_workers,
+                                             legacy_csv=legacy_csv)
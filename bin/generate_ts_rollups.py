@@ -1,10 +1,5 @@
 import ConfigParser
-import os
 import sys
-import time
-import shutil
-
-import numpy as np
 
 import utils.station
 
@@ -20,21 +15,17 @@ if __name__ == "__main__":
     conf.read(config_path)
     # station_path is the parent directory all the time series
     station_path = conf.get('Paths', 'station_dir')
-    out_name = conf.get('Paths', 'out_name')
-    agg_period = int(conf.get('Params', 'agg_period'))
-
-    start_dir = os.getcwd()
-    os.chdir(station_path)
-    stations = [n for n in os.listdir('.') if n.isdigit()]
-    tic0 = time.time()
-    for stat in stations:
-        tic = time.time()
-        os.chdir(stat)  # move to individaul station dir and make the rollup
-        #TODO check for missing rows. If present, call timeseries_reindex  --> do this in utils.station.rollup_time_series
-        utils.station.rollup_time_series(agg_period, '.', out_name)
-        os.chdir(station_path)  # move back up to parent dir
-        toc = time.time()
-        print 'Time to proces station %s: %d' % (stat, toc - tic)
-    print 'Total time to build distributions %d' % (time.time() - tic0)
-    os.chdir(start_dir)
+    # agg_period and out_name can be comma separated lists to build several rollups from one read of each station
+    out_names = [s.strip() for s in conf.get('Paths', 'out_name').split(',')]
+    agg_periods = [int(s) for s in conf.get('Params', 'agg_period').split(',')]
+    manifest_path = None  # Defaults to rollup_manifest.txt in station_path
+    if conf.has_option('Paths', 'manifest_path'):
+        manifest_path = conf.get('Paths', 'manifest_path')
+    n_workers = 1
+    if conf.has_option('Params', 'n_workers'):
+        n_workers = conf.getint('Params', 'n_workers')
 
+    failed = utils.station.rollup_all_stations(station_path, agg_periods, out_names, n_workers=n_workers,
+                                               manifest_path=manifest_path)
+    if failed:
+        print 'Failed stations: %s' % ', '.join(failed)
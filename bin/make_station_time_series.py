@@ -19,9 +19,17 @@ if __name__ == '__main__':
     meta_path = conf.get('Paths', 'meta_path')
     station_dir = conf.get('Paths', 'station_dir')
     time_series_dir = conf.get('Paths', 'time_series_dir')
+    # Params
+    n_workers = 1  # Number of worker processes. Default is serial processing.
+    if conf.has_option('Params', 'n_workers'):
+        n_workers = conf.getint('Params', 'n_workers')
+    out_format = 'csv'  # Format of the station time series: csv, npz or both
+    if conf.has_option('Params', 'out_format'):
+        out_format = conf.get('Params', 'out_format')
 
 
     ##
     # 1 - Create unique time series folder and files for each station
     ##
-    utils.station.generate_time_series_V2(meta_path, station_dir, time_series_dir, n_chunks=8)
\ No newline at end of file
+    utils.station.generate_time_series_shuffle(meta_path, station_dir, time_series_dir, n_workers=n_workers,
+                                               out_format=out_format)
\ No newline at end of file
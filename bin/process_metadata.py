@@ -22,6 +22,16 @@ if __name__ == '__main__':
     meta_dir = conf.get('Paths', 'meta_dir')
     filtered_meta_path = conf.get('Paths', 'filtered_meta_path')
     bad_meta_path = conf.get('Paths', 'bad_meta_path')
+    scd_meta_path = None  # Optional validity-interval version of the filtered metadata
+    if conf.has_option('Paths', 'scd_meta_path'):
+        scd_meta_path = conf.get('Paths', 'scd_meta_path')
+    meta_catalog_dir = None  # Optional catalog, so only new metadata files are parsed
+    if conf.has_option('Paths', 'meta_catalog_dir'):
+        meta_catalog_dir = conf.get('Paths', 'meta_catalog_dir')
+    # Largest coordinate change, in degrees, not counted as a moving station
+    moving_tolerance = 0.0
+    if conf.has_option('Params', 'moving_tolerance'):
+        moving_tolerance = conf.getfloat('Params', 'moving_tolerance')
 
 
 
@@ -29,7 +39,7 @@ if __name__ == '__main__':
     # 1 - Join the metadata files
     ##
 
-    meta_joined = utils.meta.join_meta(meta_dir)
+    meta_joined = utils.meta.join_meta(meta_dir, catalog_dir=meta_catalog_dir)
 
 
     ##
@@ -42,8 +52,7 @@ if __name__ == '__main__':
     ##
     # 3 - Filter out moving IDs
     ##
-    meta_filtered = utils.meta.filter_moving_ids(meta_joined)  # good Ids
-    meta_bad = utils.meta.get_moving_ids(meta_joined)  # bad, moving IDs
+    meta_filtered, meta_bad = utils.meta.partition_moving_ids(meta_joined, moving_tolerance)  # good and moving IDs
     print("Number of good unique sensors: %d" % np.unique(meta_filtered['ID']).size)
     print("Number of bad unique sensors: %d" % np.unique(meta_bad['ID']).size)
 
@@ -52,4 +61,8 @@ if __name__ == '__main__':
     ##
     meta_filtered.to_csv(filtered_meta_path)
     meta_bad.to_csv(bad_meta_path)
+    if scd_meta_path:
+        meta_scd = utils.meta.collapse_meta(meta_filtered)
+        print("Metadata rows collapsed from %d to %d" % (meta_filtered.shape[0], meta_scd.shape[0]))
+        meta_scd.to_csv(scd_meta_path, sep='\t', index=False)
 
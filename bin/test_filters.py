@@ -37,6 +37,12 @@ def main(args):
     counts_year = conf.get('Params', 'counts_year')
 
     date_list = counts.date_string_list(start_date, end_date, weekdays)
+    outlier_method = None  # Use the batched outlier_detection with this method instead of outlier_detection_SVM
+    if conf.has_option('Params', 'outlier_method'):
+        outlier_method = conf.get('Params', 'outlier_method')
+    n_workers = 1
+    if conf.has_option('Params', 'n_workers'):
+        n_workers = conf.getint('Params', 'n_workers')
 
     ##
     # Initialize the StationFilter and add filters
@@ -58,7 +64,10 @@ def main(args):
     sf.boundary_buffer(poly_path)
 
     #4 - outlier_detection_SVM
-    sf.outlier_detection_SVM(date_list, decision_dist=4, threshold=0.05)
+    if outlier_method:
+        sf.outlier_detection(date_list, cutoff=4, threshold=0.05, method=outlier_method)
+    else:
+        sf.outlier_detection_SVM(date_list, decision_dist=4, threshold=0.05)
 
     #5 - observed
     sf.observed(date_list)
@@ -67,7 +76,7 @@ def main(args):
     # Run the filters.
     ##
     t_start = time.time()
-    sf.run_filters(check_removed=True)
+    sf.run_filters(check_removed=True, n_workers=n_workers)
     t_end = time.time()
     print "Time to run %d filters: %d [sec]" % (len(sf.filters), t_end - t_start)
     print
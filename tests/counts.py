@@ -0,0 +1,19 @@
+"""
+Test stub of the counts module of the parent project, which utils.station_filter imports. Only the function used by
+StationFilter is provided. python -m unittest discover -s tests puts the tests directory first on the path, so the
+tests use this stub.
+"""
+
+from datetime import datetime
+
+import pandas as pd
+
+
+def get_TS_summary_dates(summary_path):
+    """
+    :param summary_path: (str) Path to the summary.csv of a station time series. See utils.station.ts_agg_measures.
+    :return: ((datetime, datetime)) First and last days of the time series.
+    """
+    summary = pd.read_csv(summary_path)
+    return (datetime.strptime(summary['First_Day'].iloc[0], '%m/%d/%Y'),
+            datetime.strptime(summary['Last_Day'].iloc[0], '%m/%d/%Y'))
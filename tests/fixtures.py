@@ -0,0 +1,152 @@
+"""
+Small synthetic fixtures for the tests. Every fixture is generated from a seeded RandomState, so the tests are
+repeatable and no data files need to be stored in the repository.
+"""
+
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import shapefile
+
+import utils.station
+
+RAW_IDS = [400001, 400002, 400010, 400100, 400200]  # Stations in the raw station files
+TARGET_IDS = RAW_IDS + [400300]  # Stations in the target metadata. 400300 has no data.
+SQUARE = [(-122.5, 37.0), (-122.5, 38.0), (-121.5, 38.0), (-121.5, 37.0), (-122.5, 37.0)]  # Clockwise shell
+
+
+def make_raw_station_files(root, n_days=3, seed=0):
+    """
+    Writes raw 5-minute station data files in the PeMS clearinghouse format, and a target metadata file.
+    :param root: (str) Directory to write to. The files go to root/raw and root/meta.csv.
+    :param n_days: (int) Number of day files, starting on 05/01/2014.
+    :param seed: (int) Seed of the random values.
+    :return: ((str, str)) Path to the station file directory and to the target metadata file.
+    """
+    rs = np.random.RandomState(seed)
+    station_path = os.path.join(root, 'raw')
+    os.makedirs(station_path)
+    for d in range(n_days):
+        day = datetime.datetime(2014, 5, 1) + datetime.timedelta(days=d)
+        lines = []
+        for slot in range(288):
+            t = (day + datetime.timedelta(minutes=5*slot)).strftime(utils.station.TIMESTAMP_FORMAT)
+            for sid in RAW_IDS + [999999]:  # 999999 is not a target
+                if rs.rand() < 0.05:  # Missing row
+                    continue
+                speed = '' if sid == 400200 or rs.rand() < 0.1 else '%.1f' % (40 + 30*rs.rand())
+                lines.append(','.join([t, str(sid), '4', '101', 'N', 'ML', '0.5', '%d' % rs.randint(0, 20),
+                                       '%d' % rs.choice([0, 50, 100]), '%d' % rs.randint(0, 300),
+                                       '%.4f' % rs.rand(), speed] + ['1', '2', '', '', '0']*2))
+        name = 'd04_text_station_5min_%s.txt' % day.strftime('%Y_%m_%d')
+        with open(os.path.join(station_path, name), 'w') as fo:
+            fo.write('\n'.join(lines) + '\n')
+    meta_path = os.path.join(root, 'meta.csv')
+    pd.DataFrame({'ID': TARGET_IDS, 'Latitude': 37.0, 'Longitude': -122.0}).to_csv(meta_path)
+    return station_path, meta_path
+
+
+def make_time_series(root, n_stations=16, n_days=21, seed=5):
+    """
+    Writes station time series directories, as made by utils.station.generate_time_series_shuffle, and the metadata and
+    link map files used by the StationFilter. Some stations have missing values, whole missing hours, a day whose rows
+    all miss the flow, duplicated rows, outlier days, low observed fractions, late start dates or no link.
+    :param root: (str) Directory to write to. The time series go to root/ts.
+    :param n_stations: (int) Number of stations, IDs starting at 400000.
+    :param n_days: (int) Number of days, starting on 05/01/2014.
+    :param seed: (int) Seed of the random values.
+    :return: ((str, str, str)) Path to the time series directory, the metadata file and the link map file.
+    """
+    rs = np.random.RandomState(seed)
+    ts_path = os.path.join(root, 'ts')
+    os.makedirs(ts_path)
+    idx = pd.date_range('2014-05-01', periods=288*n_days, freq='5min')
+    profile = 100 + 80*np.sin(np.arange(288) / 288.0 * 2*np.pi)
+    for k in range(n_stations):
+        flow = np.tile(profile, n_days)*rs.uniform(0.8, 1.2) + rs.normal(0, 5, idx.shape[0])
+        if k % 5 == 0:
+            flow[rs.rand(flow.shape[0]) < 0.3] = np.nan  # Missing values
+        if k % 7 == 0:
+            flow[288*3:288*3 + 12*5] = np.nan  # Whole hours missing on one day
+        if k % 6 == 0:
+            flow[288*rs.randint(0, n_days, 4)[:, np.newaxis] + np.arange(288)] *= 3  # Outlier days
+        if k % 4 == 3:
+            flow[288*8:288*9] = np.nan  # Outage on 05/09/2014: the rows exist but all miss the flow
+        observed = np.where(rs.rand(idx.shape[0]) < (0.3 if k % 9 == 0 else 0.95), 100, 0)
+        df = pd.DataFrame({'Timestamp': idx.strftime(utils.station.TIMESTAMP_FORMAT), 'Station': 400000 + k,
+                           'District': 4, 'Fwy': 101, 'Dir': 'N', 'Type': 'ML', 'Length': 0.5, 'Samples': 10,
+                           'Observed': observed, 'Total_Flow': flow.round(0), 'Avg_Occ': 0.05,
+                           'Avg_Speed': 60.0})[utils.station.STATION_HEAD]
+        if k == 10:  # Two hours of 05/03/2014 are in the file twice
+            df = pd.concat([df, df.iloc[288*2:288*2 + 24]]).sort_values('Timestamp', kind='mergesort')
+        stat_dir = os.path.join(ts_path, str(400000 + k))
+        os.mkdir(stat_dir)
+        utils.station.write_time_series(df, stat_dir, 'csv' if k % 2 else 'npz')
+        # Stations with k % 4 == 0 report a late first day
+        summary = utils.station.ts_agg_measures(df)
+        if k % 4 == 0:
+            summary.loc[0, 'First_Day'] = '05/10/2014'
+        summary.to_csv(os.path.join(stat_dir, 'summary.csv'), sep=',', index=False)
+    meta_path = os.path.join(root, 'meta.csv')
+    pd.DataFrame({'ID': range(400000, 400000 + n_stations), 'Latitude': 37.0, 'Longitude': -122.0}).to_csv(meta_path)
+    link_map_path = os.path.join(root, 'link_map.csv')
+    pd.DataFrame({'ID': [str(400000 + k) for k in range(n_stations) if k % 8]}).to_csv(link_map_path, index=False)
+    return ts_path, meta_path, link_map_path
+
+
+def make_joined_meta(n_stations=300, n_files=12, seed=1):
+    """
+    Builds joined station metadata, as made by utils.meta.join_meta(), around SQUARE. Some stations move
+    in a later file, some only jitter by 1e-7 degrees, some lie on the edge of the square and some have missing or
+    partly missing coordinates.
+    :param n_stations: (int) Number of stations, IDs starting at 400000.
+    :param n_files: (int) Number of weekly metadata files, starting on 2014_05_01.
+    :param seed: (int) Seed of the random values.
+    :return: (pd.DataFrame) ID, Latitude, Longitude and Date columns, in file order.
+    """
+    rs = np.random.RandomState(seed)
+    lat = rs.uniform(36.8, 38.2, n_stations).round(6)
+    lon = rs.uniform(-122.7, -121.3, n_stations).round(6)
+    lat[::25] = 37.0  # On the southern edge of the square
+    moves_at = np.where(rs.rand(n_stations) < 0.1, rs.randint(1, n_files, n_stations), n_files)
+    jitters = rs.rand(n_stations) < 0.05
+    frames = []
+    for f in range(n_files):
+        day = datetime.date(2014, 5, 1) + datetime.timedelta(weeks=f)
+        f_lat = np.where(moves_at <= f, lat + 0.3, lat)
+        f_lon = np.where(jitters & (f % 2 == 1), lon + 1e-7, lon)
+        f_lat[::40] = np.nan  # Always missing
+        if f == n_files - 1:
+            f_lon[7::40] = np.nan  # Partly missing
+        frames.append(pd.DataFrame({'ID': 400000 + np.arange(n_stations), 'Latitude': f_lat, 'Longitude': f_lon,
+                                    'Date': day.strftime('%Y_%m_%d')}))
+    return pd.concat(frames, ignore_index=True)[['ID', 'Latitude', 'Longitude', 'Date']]
+
+
+def write_shapefile(path, polygons):
+    """
+    Writes a polygon shapefile.
+    :param path: (str) Path of the shapefile, without extension.
+    :param polygons: ([[[(float, float)]]]) One list of rings for each shape. Shells are clockwise and holes counter
+    clockwise.
+    :return: (str) path
+    """
+    w = shapefile.Writer(path, shapefile.POLYGON)
+    w.field('NAME', 'C')
+    for i, rings in enumerate(polygons):
+        w.poly(rings)
+        w.record(str(i))
+    w.close()
+    return path
+
+
+def weekdays(start, n_days):
+    """
+    :param start: (datetime.date) First day.
+    :param n_days: (int) Number of days.
+    :return: ([str]) The weekdays among the days, as '%m/%d/%Y' strings.
+    """
+    days = [start + datetime.timedelta(days=d) for d in range(n_days)]
+    return [d.strftime('%m/%d/%Y') for d in days if d.weekday() < 5]
@@ -0,0 +1,91 @@
+"""
+Checks that histogram_stats gives the statistics of the observations its binned counts stand for, and that
+generate_distributions matches the per-day groupby it replaced.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import fixtures
+import utils.station
+
+
+def distributions_groupby(ts_path, metric_col, bins):
+    """
+    The original implementation of generate_distributions, one groupby per day. Days are datetime.weekday(), where
+    Monday = 0, and only the slots with observations are returned. Variance of totals uses true division.
+    """
+    ts = pd.read_csv(ts_path, sep=',')
+    ts['Timestamp'] = pd.to_datetime(ts['Timestamp'])
+    out = []
+    for day in range(7):
+        ts_temp = ts[ts['Timestamp'].apply(lambda t: t.weekday() == day)][['Timestamp', metric_col]]
+        ts_temp['Minutes'] = ts_temp['Timestamp'].apply(lambda t: '%02d:%02d' % (t.hour, t.minute))
+        series = ts_temp.groupby('Minutes').apply(lambda s: np.histogram(s[metric_col], bins=bins)[0])
+        totals = pd.DataFrame([a for a in series], index=series.index, columns=bins[0:-1])
+        proportions = totals.apply(lambda a: a/np.sum(a), axis=1)
+        row_totals = totals.sum(axis=1)
+        z = zip(row_totals, proportions.values)
+        var_tots = pd.DataFrame([np.power(a, 3)/float(a-1)*b*(1-b) for a, b in z], index=row_totals.index,
+                                columns=proportions.columns)
+        var_props = proportions.apply(lambda x: x*(1-x))
+        out.append([totals, proportions, var_tots, var_props])
+    return out
+
+
+class TestHistogramStats(unittest.TestCase):
+
+    def test_matches_expanded_observations(self):
+        rs = np.random.RandomState(0)
+        mid_points = np.arange(0, 400, 20) + 10.0
+        counts = rs.randint(0, 6, (50, mid_points.shape[0]))
+        counts[counts.sum(axis=1) == 0, 0] = 1  # Every row needs a positive total
+        counts[0, :] = 0
+        counts[0, 3] = 1  # A single observation
+        counts[1, :] = 0
+        counts[1, [0, -1]] = 7  # Only the extreme bins
+        percentiles = [0, 5, 25, 50, 75, 95, 99.5, 100]
+        pct, mean, std = utils.station.histogram_stats(counts, mid_points, percentiles)
+        for i in range(counts.shape[0]):
+            obs = np.repeat(mid_points, counts[i])
+            np.testing.assert_allclose(pct[i], np.percentile(obs, percentiles))
+            np.testing.assert_allclose(mean[i], np.mean(obs))
+            np.testing.assert_allclose(std[i], np.std(obs), atol=1e-9)
+
+
+class TestDistributionsMatchGroupby(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.ts_path = fixtures.make_time_series(cls.root, n_stations=8, n_days=14)[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def test_count(self):
+        bins = range(0, 400, 20)  # The outlier days fall past the last edge
+        # The groupby only reads csv time series. They have missing values, whole missing hours and an outage day.
+        for k in [1, 3, 5, 7]:
+            stat_dir = os.path.join(self.ts_path, str(400000 + k))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ref = distributions_groupby(os.path.join(stat_dir, 'time_series.csv'), 'Total_Flow', bins)
+                new = utils.station.generate_distributions(stat_dir, 'Count', bins)
+            for day in range(7):  # Sunday = 0 is weekday() 6
+                ref_frames, new_frames = ref[(day + 6) % 7], new[day]
+                self.assertTrue(ref_frames[0].shape[0] > 0)
+                # Slots without observations are zero rows in the new frames
+                self.assertEqual(new_frames[0].drop(ref_frames[0].index).values.sum(), 0)
+                for r, n in zip(ref_frames, new_frames):
+                    np.testing.assert_allclose(n.loc[r.index].values, r.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
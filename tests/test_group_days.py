@@ -0,0 +1,81 @@
+"""
+Checks that group_days and group_days_multi write the same files as the csv round trip they replaced.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import fixtures
+import utils.station
+
+DAY_GROUPS = [[1, 2, 3, 4, 5], [6, 0], [2, 3, 4], [0]]
+
+
+def group_days_csv(station_dir, days, out_dir):
+    """
+    The original implementation of group_days, summing the totals csv files of the days pairwise.
+    """
+    os.mkdir(out_dir)
+    for tot_name, prop_name in utils.station.DIST_FILES.values():
+        dfs = [pd.read_csv(os.path.join(station_dir, utils.station.DAY_DIRS[day], tot_name), sep=',',
+                           index_col='Minutes') for day in days]
+        totals = dfs[0]
+        for d in dfs[1:]:
+            totals = totals + d
+        proportions = totals.apply(lambda a: a/np.sum(a), axis=1)
+        totals.to_csv(os.path.join(out_dir, tot_name), sep=',', header=True, index=True)
+        proportions.to_csv(os.path.join(out_dir, prop_name), sep=',', header=True, index=True)
+
+
+class TestGroupDaysMatchesCsv(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        ts_path = fixtures.make_time_series(cls.root, n_stations=1, n_days=7)[0]
+        cls.stat_dir = os.path.join(ts_path, '400000')  # Whole hours of its only Sunday have no observations
+        utils.station.build_station_distributions(cls.stat_dir, np.arange(0., 400, 20), np.arange(0., 100, 5))
+        cls.ref_dir = os.path.join(cls.root, 'ref')
+        os.mkdir(cls.ref_dir)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for days in DAY_GROUPS:
+                group_days_csv(cls.stat_dir, days, os.path.join(cls.ref_dir, '_'.join(map(str, days))))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def assert_same_groups(self, stat_dir):
+        for days in DAY_GROUPS:
+            out_dir = os.path.join(stat_dir, '7_Day_Groups', '_'.join(utils.station.DAY_DIRS[d] for d in days))
+            for names in utils.station.DIST_FILES.values():
+                for name in names:
+                    self.assertTrue(filecmp.cmp(os.path.join(self.ref_dir, '_'.join(map(str, days)), name),
+                                                os.path.join(out_dir, name), shallow=False),
+                                    '%s/%s differs' % (out_dir, name))
+
+    def test_group_days_from_csv(self):
+        stat_dir = os.path.join(self.root, 'csv_only')
+        shutil.copytree(self.stat_dir, stat_dir)
+        os.remove(os.path.join(stat_dir, 'distributions.npz'))
+        for days in DAY_GROUPS:
+            utils.station.group_days(stat_dir, days)
+        self.assert_same_groups(stat_dir)
+
+    def test_multi_from_npz(self):
+        stat_dir = os.path.join(self.root, 'npz')
+        shutil.copytree(self.stat_dir, stat_dir)
+        utils.station.group_days_multi(stat_dir, DAY_GROUPS)
+        utils.station.group_days_multi(stat_dir, DAY_GROUPS)  # Existing output directories are reused
+        self.assert_same_groups(stat_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Checks that join_stations concatenates the station files, with and without compression.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import fixtures
+import utils.station
+
+
+class TestJoinStations(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.station_path, _ = fixtures.make_raw_station_files(self.root)
+        self.names = sorted(os.listdir(self.station_path))
+        # The second file has no final newline, so its last row could run into the first row of the third
+        path = os.path.join(self.station_path, self.names[1])
+        with open(path, 'rb') as fi:
+            text = fi.read()
+        with open(path, 'wb') as fo:
+            fo.write(text.rstrip('\n'))
+        self.days = []
+        for name in self.names:
+            with open(os.path.join(self.station_path, name), 'rb') as fi:
+                text = fi.read()
+            self.days.append(text if text.endswith('\n') else text + '\n')
+        os.makedirs(os.path.join(self.root, 'plain'))
+        os.makedirs(os.path.join(self.root, 'gz'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_plain(self):
+        out_file = utils.station.join_stations(self.station_path, os.path.join(self.root, 'plain'),
+                                               'd04_text_station_5min')
+        with open(out_file, 'rb') as fi:
+            self.assertEqual(fi.read(), ''.join(self.days))
+        self.assertEqual(utils.station.read_joined_day(out_file, '05/02/2014'), self.days[1])
+
+    def test_compressed(self):
+        out_file = utils.station.join_stations(self.station_path, os.path.join(self.root, 'gz'),
+                                               'd04_text_station_5min', compress=True)
+        self.assertTrue(out_file.endswith('.gz'))
+        with gzip.open(out_file, 'rb') as fi:
+            self.assertEqual(fi.read(), ''.join(self.days))
+        self.assertEqual(utils.station.read_joined_day(out_file, '05/02/2014'), self.days[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
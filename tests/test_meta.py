@@ -0,0 +1,165 @@
+"""
+Checks that collapse_meta is lossless, that MetaSCD finds the metadata valid on a date and that the spatial filters
+match the row-wise filters they replaced.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import shapefile
+from shapely.geometry import Polygon
+
+import fixtures
+import utils.meta
+
+FILE_DATES = ['2014_05_01', '2014_06_01', '2014_07_01', '2014_08_01']
+
+
+def make_meta():
+    """
+    :return: (pd.DataFrame) Joined metadata, as made by utils.meta.join_meta(). Station 2 moves in the 2014_07_01
+    file, station 3 is missing from the 2014_06_01 file and station 4 only has missing values.
+    """
+    rows = []
+    for d in FILE_DATES:
+        for stat in [1, 2, 3, 4]:
+            if stat == 3 and d == '2014_06_01':
+                continue
+            lat = 37.1 if stat == 2 and d >= '2014_07_01' else 37.0
+            rows.append((stat, np.nan if stat == 4 else lat, np.nan if stat == 4 else -122.0, d))
+    return pd.DataFrame(rows, columns=['ID', 'Latitude', 'Longitude', 'Date'])
+
+
+class TestCollapseMeta(unittest.TestCase):
+
+    def setUp(self):
+        self.meta_df = make_meta()
+        self.scd_df = utils.meta.collapse_meta(self.meta_df)
+
+    def test_round_trip(self):
+        # Expanding every interval over the file dates it covers gives back the joined metadata
+        rows = []
+        for _, row in self.scd_df.iterrows():
+            for d in FILE_DATES:
+                if row['valid_from'] <= d and (row['valid_to'] is None or d < row['valid_to']):
+                    rows.append((row['ID'], row['Latitude'], row['Longitude'], d))
+        expanded = pd.DataFrame(rows, columns=self.meta_df.columns)
+        expected = self.meta_df.sort_values(['ID', 'Date'], kind='mergesort').reset_index(drop=True)
+        pd.testing.assert_frame_equal(expanded, expected, check_dtype=False)
+
+    def test_intervals(self):
+        self.assertEqual(self.scd_df.shape[0], 6)
+        moved = self.scd_df[self.scd_df['ID'] == 2]
+        self.assertEqual(list(moved['valid_from']), ['2014_05_01', '2014_07_01'])
+        self.assertEqual(list(moved['valid_to']), ['2014_07_01', None])
+
+    def test_as_of(self):
+        scd = utils.meta.MetaSCD(self.scd_df)
+        self.assertEqual(scd.as_of(2, '2014_06_15')['Latitude'], 37.0)  # Between two releases, before the move
+        self.assertEqual(scd.as_of(2, '2014_07_01')['Latitude'], 37.1)  # valid_to is exclusive
+        self.assertEqual(scd.as_of(2, '2014_09_01')['Latitude'], 37.1)  # After the latest release
+        self.assertIsNone(scd.as_of(3, '2014_06_10'))  # Missing from the 2014_06_01 file
+        self.assertIsNone(scd.as_of(1, '2014_04_30'))  # Before the first release
+        self.assertIsNone(scd.as_of(5, '2014_06_01'))  # Unknown station
+        pos = scd.lookup([1, 2, 3, 4], ['2014_08_01']*4)
+        self.assertEqual(list(scd.scd_df['ID'].values[pos]), [1, 2, 3, 4])
+
+    def test_as_of_after_csv(self):
+        # Open-ended intervals are read back from csv as NaN
+        scd_csv = pd.read_csv(pd.compat.StringIO(self.scd_df.to_csv(sep='\t', index=False)), sep='\t')
+        scd = utils.meta.MetaSCD(scd_csv)
+        self.assertEqual(scd.as_of(2, '2014_09_01')['Latitude'], 37.1)
+        self.assertEqual(scd.as_of(2, '2014_06_15')['Latitude'], 37.0)
+
+
+class TestSpatialFilters(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.meta_df = fixtures.make_joined_meta()
+        cls.square_path = fixtures.write_shapefile(os.path.join(cls.root, 'square'), [[fixtures.SQUARE]])
+        cls.hole = [(-122.2, 37.3), (-121.8, 37.3), (-121.8, 37.7), (-122.2, 37.7), (-122.2, 37.3)]
+        cls.east = [(-121.4, 37.2), (-121.4, 37.8), (-121.0, 37.8), (-121.0, 37.2), (-121.4, 37.2)]
+        cls.multi_path = fixtures.write_shapefile(os.path.join(cls.root, 'multi'),
+                                                  [[fixtures.SQUARE, cls.hole], [cls.east]])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def in_poly_apply(self, poly):
+        """
+        The original row-wise filter of get_meta_targets_from_df.
+        """
+        return self.meta_df[self.meta_df.apply(lambda x: utils.meta.in_poly(x, poly), axis=1)]
+
+    def test_targets(self):
+        poly = Polygon(shapefile.Reader(self.square_path).shapes()[0].points)  # The original polygon reader
+        ref = self.in_poly_apply(poly)
+        self.assertTrue(0 < ref.shape[0] < self.meta_df.shape[0])
+        pd.testing.assert_frame_equal(utils.meta.get_meta_targets_from_df(self.meta_df, self.square_path), ref)
+
+    def test_moving_targets(self):
+        poly = Polygon(shapefile.Reader(self.square_path).shapes()[0].points)
+        in_poly_ids = np.unique(self.in_poly_apply(poly)['ID'])
+        ref = self.meta_df[self.meta_df.apply(lambda x: x['ID'] in in_poly_ids, axis=1)]
+        # Stations that move across the edge keep all their rows
+        self.assertTrue(ref.shape[0] > self.in_poly_apply(poly).shape[0])
+        pd.testing.assert_frame_equal(utils.meta.get_moving_meta_targets_from_df(self.meta_df, self.square_path), ref)
+
+    def test_multi_polygon(self):
+        # Stations in the hole are out, stations in the second shape are in
+        ref = self.in_poly_apply(Polygon(fixtures.SQUARE, [self.hole]).union(Polygon(self.east)))
+        new = utils.meta.get_meta_targets_from_df(self.meta_df, self.multi_path)
+        pd.testing.assert_frame_equal(new, ref)
+        self.assertTrue((new['Longitude'] > -121.5).any())
+
+
+class TestMovingIds(unittest.TestCase):
+
+    def setUp(self):
+        self.meta_df = fixtures.make_joined_meta()
+
+    def moving_ids_loop(self):
+        """
+        The original duplicate search of filter_moving_ids and get_moving_ids. DataFrame.sort is now sort_values.
+        """
+        unique_id_locs = self.meta_df[['ID', 'Latitude', 'Longitude', 'Date']].sort_values('Date').\
+            drop_duplicates(['ID', 'Latitude', 'Longitude'])
+        unique_id = unique_id_locs.drop_duplicates(['ID'])
+        idx = [i for i in unique_id_locs.index if i not in unique_id.index]
+        return np.unique(unique_id_locs.loc[idx, 'ID'])
+
+    def test_matches_loop(self):
+        moving_ids = self.moving_ids_loop()
+        good_ref = self.meta_df[self.meta_df.apply(lambda x: x['ID'] not in moving_ids, axis=1)]
+        moving_ref = self.meta_df[self.meta_df.apply(lambda x: x['ID'] in moving_ids, axis=1)]
+        self.assertTrue(good_ref.shape[0] and moving_ref.shape[0])
+        good, moving = utils.meta.partition_moving_ids(self.meta_df)
+        pd.testing.assert_frame_equal(good, good_ref)
+        pd.testing.assert_frame_equal(moving, moving_ref)
+        pd.testing.assert_frame_equal(utils.meta.filter_moving_ids(self.meta_df), good_ref)
+        pd.testing.assert_frame_equal(utils.meta.get_moving_ids(self.meta_df), moving_ref)
+
+    def test_tolerance(self):
+        moving_ids = set(utils.meta.get_moving_ids(self.meta_df)['ID'])
+        tol_ids = set(utils.meta.get_moving_ids(self.meta_df, tolerance=1e-4)['ID'])
+        ids = self.meta_df.groupby('ID')
+        spread = (ids[['Latitude', 'Longitude']].max() - ids[['Latitude', 'Longitude']].min()).max(axis=1)
+        jittered = set(spread.index[(spread > 0) & (spread < 1e-4)])
+        counts = ids['Longitude'].count()
+        partly_missing = set(counts.index[(counts > 0) & (counts < ids.size())])
+        self.assertTrue(jittered and partly_missing)
+        # Only the jitter is ignored. Partly missing coordinates still count as movement.
+        self.assertEqual(tol_ids, moving_ids - jittered)
+        self.assertTrue(partly_missing <= tol_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Checks that a MetaCatalog serves the same frames as join_meta and only parses new or modified metadata files.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+import fixtures
+import utils.meta
+import utils.meta_catalog
+
+
+def write_meta_file(meta_path, date, rows):
+    """
+    Writes one tab separated metadata file.
+    :param meta_path: (str) Directory of the metadata files.
+    :param date: (str) Date of the file, 'YYYY_MM_DD'.
+    :param rows: (pd.DataFrame) Rows of the file, without the Date column.
+    :return: (None)
+    """
+    rows.to_csv(os.path.join(meta_path, 'd04_text_meta_%s.txt' % date), sep='\t', index=False)
+
+
+class TestMetaCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.meta_path = os.path.join(self.root, 'meta')
+        os.mkdir(self.meta_path)
+        joined = fixtures.make_joined_meta(n_stations=50, n_files=6)
+        joined['Fwy'] = 101
+        joined['Dir'] = 'N'
+        self.files = [(d, g.drop('Date', axis=1)) for d, g in joined.groupby('Date')]
+        for d, rows in self.files[:-1]:  # The last file arrives later
+            write_meta_file(self.meta_path, d, rows)
+        self.catalog_dir = os.path.join(self.root, 'catalog')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assert_same_as_join(self, **kwargs):
+        ref = utils.meta.join_meta(self.meta_path, **kwargs)
+        new = utils.meta.join_meta(self.meta_path, catalog_dir=self.catalog_dir, **kwargs)
+        pd.testing.assert_frame_equal(new, ref)
+        return new
+
+    def test_matches_join_meta(self):
+        self.assert_same_as_join()
+        df = self.assert_same_as_join(start_date=datetime.datetime(2014, 5, 8),
+                                      end_date=datetime.datetime(2014, 5, 22))
+        self.assertEqual(sorted(df['Date'].unique()), ['2014_05_08', '2014_05_15', '2014_05_22'])
+        ref = utils.meta.join_meta(self.meta_path)
+        ids = [400003, 400010, 400041]
+        new = utils.meta_catalog.MetaCatalog(self.catalog_dir).to_df(ids=ids)
+        pd.testing.assert_frame_equal(new, ref[ref['ID'].isin(ids)].reset_index(drop=True))
+
+    def test_incremental(self):
+        catalog = utils.meta_catalog.MetaCatalog(self.catalog_dir)
+        self.assertEqual(catalog.update(self.meta_path), 5)
+        self.assertEqual(utils.meta_catalog.MetaCatalog(self.catalog_dir).update(self.meta_path), 0)
+        # A new file is the only one parsed
+        write_meta_file(self.meta_path, *self.files[-1])
+        self.assertEqual(utils.meta_catalog.MetaCatalog(self.catalog_dir).update(self.meta_path), 1)
+        self.assert_same_as_join()
+        # So is a modified file
+        d, rows = self.files[0]
+        rows = rows.assign(Fwy=280)
+        write_meta_file(self.meta_path, d, rows)
+        path = os.path.join(self.meta_path, 'd04_text_meta_%s.txt' % d)
+        os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 10))
+        self.assertEqual(utils.meta_catalog.MetaCatalog(self.catalog_dir).update(self.meta_path), 1)
+        self.assertTrue((self.assert_same_as_join()['Fwy'] == 280).any())
+        # A removed file is dropped with its partition
+        os.remove(path)
+        self.assertEqual(utils.meta_catalog.MetaCatalog(self.catalog_dir).update(self.meta_path), 0)
+        self.assertFalse(os.path.isfile(os.path.join(self.catalog_dir, 'd04_text_meta_%s.pkl' % d)))
+        self.assert_same_as_join()
+
+
+if __name__ == '__main__':
+    unittest.main()
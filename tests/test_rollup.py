@@ -0,0 +1,75 @@
+"""
+Checks that rollup_time_series writes the same files as the loop it replaced.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import fixtures
+import utils.station
+
+
+def rollup_loop(agg_period, station_path, out_file, nrows):
+    """
+    The original implementation of rollup_time_series, one window at a time.
+    """
+    ts = pd.read_csv(os.path.join(station_path, 'time_series.csv'), sep=',', index_col='Timestamp')
+    if ts.shape[0] != nrows:
+        ts = utils.station.reindex_timeseries(ts)
+    harm_means = np.empty((ts.shape[0] / agg_period))
+    samp_sums = np.empty((ts.shape[0] / agg_period))
+    flow_sums = np.empty((ts.shape[0] / agg_period))
+    for j, i in enumerate(np.arange(0, ts.shape[0], agg_period)):
+        end = i + agg_period
+        samp_sums[j] = np.sum(ts['Samples'][i:end])
+        sf = np.sum(ts['Total_Flow'][i:end])
+        flow_sums[j] = sf
+        harm_means[j] = sf / np.sum(np.divide(ts['Total_Flow'][i:end], ts['Avg_Speed'][i:end]))
+    out = ts.iloc[np.arange(0, ts.shape[0], agg_period), :]
+    out = out.drop(['Avg_Occ', 'Observed', 'Samples', 'Total_Flow', 'Avg_Speed'], axis=1)
+    out['Samples_Rollup'] = samp_sums
+    out['Total_Flow_Rollup'] = flow_sums
+    out['Avg_Speed_Rollup'] = harm_means
+    out.to_csv(out_file, header=True, index=True)
+
+
+class TestRollupMatchesLoop(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.ts_path = fixtures.make_time_series(cls.root, n_stations=6, n_days=7)[0]
+        # The loop only reads csv time series. 400003 has an outage day and 400005 missing values.
+        cls.stations = [os.path.join(cls.ts_path, str(400000 + k)) for k in [1, 3, 5]]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def assert_same_rollups(self, agg_periods, nrows):
+        out_names = ['rollup_%d.csv' % p for p in agg_periods]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for stat_dir in self.stations:
+                utils.station.rollup_time_series(agg_periods, stat_dir, out_names, nrows=nrows)
+                for period, name in zip(agg_periods, out_names):
+                    ref_file = os.path.join(self.root, 'ref_' + name)
+                    rollup_loop(period, stat_dir, ref_file, nrows)
+                    self.assertTrue(filecmp.cmp(ref_file, os.path.join(stat_dir, name), shallow=False),
+                                    '%s/%s differs' % (stat_dir, name))
+
+    def test_full_rows(self):
+        self.assert_same_rollups([3, 6, 12], 288*7)
+
+    def test_reindexed(self):
+        self.assert_same_rollups([72], 105120)
+
+
+if __name__ == '__main__':
+    unittest.main()
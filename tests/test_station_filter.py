@@ -0,0 +1,166 @@
+"""
+Checks that StationFilter.run_filters gives the same results with worker processes, that the batched
+outlier_detection builds the same profiles and gives the same verdicts as outlier_detection_SVM, that StationFeatures
+matches the pandas resample and groupby it replaced, and that boundary_buffer removes the stations within the buffer
+distance of the boundary.
+Run from the repository root with: python -m unittest discover -s tests
+The station_filter module imports the counts module of the parent project. The tests use the stub in tests/counts.py.
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, Polygon
+
+import fixtures
+import utils.outliers
+import utils.station
+from utils.station_filter import StationFeatures, StationFilter
+
+N_DAYS = 21
+
+
+class TestRunFilters(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.ts_path, cls.meta_path, cls.link_map_path = fixtures.make_time_series(cls.root, n_days=N_DAYS)
+        cls.date_list = fixtures.weekdays(datetime.date(2014, 5, 1), N_DAYS)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def run_filters(self, add_filters, check_removed=True, n_workers=1):
+        sf = StationFilter(self.ts_path, self.meta_path)
+        sf.set_stations(sorted(sf.stations))
+        add_filters(sf)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')  # run_filters prints every station
+        try:
+            sf.run_filters(check_removed=check_removed, n_workers=n_workers)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return sf
+
+    def add_filters(self, sf):
+        sf.date_range(datetime.datetime(2014, 5, 5), datetime.datetime(2014, 5, 20))
+        sf.link_mapping(self.link_map_path)
+        sf.missing_data(self.date_list)
+        sf.outlier_detection_SVM(self.date_list, decision_dist=0.5, threshold=0.05, gamma=0.1)
+        sf.observed(self.date_list)
+
+    def test_workers(self):
+        for check_removed in [True, False]:
+            serial = self.run_filters(self.add_filters, check_removed)
+            workers = self.run_filters(self.add_filters, check_removed, n_workers=2)
+            self.assertTrue(serial.cleaned_station_ids)
+            self.assertTrue(serial.removed_station_ids)
+            self.assertEqual(serial.cleaned_station_ids, workers.cleaned_station_ids)
+            self.assertEqual(serial.removed_station_ids, workers.removed_station_ids)
+            self.assertEqual(dict(serial.removed_stats_reasons), dict(workers.removed_stats_reasons))
+
+    def test_profiles_match_features(self):
+        # Outage days and duplicated rows are rolled up the same way by both paths
+        stations = sorted(n for n in os.listdir(self.ts_path) if n.isdigit())
+        profiles, present = utils.outliers.build_profiles(self.ts_path, stations, self.date_list)
+        for i, stat in enumerate(stations):
+            features = StationFeatures(stat, utils.station.read_time_series(os.path.join(self.ts_path, stat)))
+            np.testing.assert_array_equal(profiles[i][present[i]], features.hourly_flow(self.date_list))
+        self.assertFalse(np.isnan(profiles[present]).all(axis=1).all())
+        self.assertTrue(np.isnan(profiles[present]).all(axis=1).any())  # The outage days are present
+
+    def test_outlier_detection_batch(self):
+        per_station = self.run_filters(lambda sf: sf.outlier_detection_SVM(self.date_list, decision_dist=0.5,
+                                                                           threshold=0.05, gamma=0.1))
+        for n_workers in [1, 2]:
+            batch = self.run_filters(lambda sf: sf.outlier_detection(self.date_list, 0.5, 0.05, gamma=0.1),
+                                     n_workers=n_workers)
+            self.assertTrue(batch.removed_station_ids)
+            # Stations with an outage day are left undecided by both
+            self.assertTrue(set(batch.stations) - batch.cleaned_station_ids - batch.removed_station_ids)
+            self.assertEqual(per_station.cleaned_station_ids, batch.cleaned_station_ids)
+            self.assertEqual(per_station.removed_station_ids, batch.removed_station_ids)
+
+
+class TestStationFeatures(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.ts_path = fixtures.make_time_series(cls.root, n_days=N_DAYS)[0]
+        # Every day, so the whole missing hours of 05/04/2014 are in. 06/30/2014 is not in the time series.
+        cls.date_list = [(datetime.date(2014, 5, 1) + datetime.timedelta(days=d)).strftime('%m/%d/%Y')
+                         for d in range(N_DAYS)] + ['06/30/2014']
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def test_matches_pandas(self):
+        for stat in sorted(n for n in os.listdir(self.ts_path) if n.isdigit()):
+            ts = utils.station.read_time_series(os.path.join(self.ts_path, stat))
+            features = StationFeatures(stat, ts)
+            # The original filters selected the rows by date string, then resampled each day to hourly sums and
+            # averaged Observed by date. min_count=1 keeps an hour without observations NaN.
+            ts = ts.set_index('Timestamp')
+            dates = ts.index.strftime('%m/%d/%Y')
+            mask = np.in1d(dates, self.date_list)
+            np.testing.assert_array_equal(features.date_mask(self.date_list)[0], mask)
+            hourly, observed = [], []
+            for day, g in ts[mask].groupby(dates[mask]):
+                hours = pd.date_range(datetime.datetime.strptime(day, '%m/%d/%Y'), periods=24, freq='h')
+                hourly.append(g['Total_Flow'].resample('1h').sum(min_count=1).reindex(hours).values)
+                observed.append(g['Observed'].mean())
+            np.testing.assert_allclose(features.hourly_flow(self.date_list), np.array(hourly), rtol=1e-6)
+            np.testing.assert_allclose(features.daily_observed(self.date_list), np.array(observed), rtol=1e-6)
+
+
+class TestBoundaryBuffer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        rs = np.random.RandomState(3)
+        cls.meta_df = pd.DataFrame({'ID': 400000 + np.arange(400), 'Latitude': rs.uniform(36.7, 38.3, 400),
+                                    'Longitude': rs.uniform(-122.8, -121.2, 400)})
+        cls.meta_path = os.path.join(cls.root, 'meta.csv')
+        cls.meta_df.to_csv(cls.meta_path)
+        cls.poly_path = os.path.join(cls.root, 'square.shp')
+        cls.square = gpd.GeoSeries([Polygon(fixtures.SQUARE)], crs={'init': 'epsg:4326'})
+        gpd.GeoDataFrame(geometry=cls.square).to_file(cls.poly_path)
+        cls.points = gpd.GeoSeries([Point(xy) for xy in zip(cls.meta_df['Longitude'], cls.meta_df['Latitude'])],
+                                   index=cls.meta_df['ID'].astype(str).values, crs={'init': 'epsg:4326'})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def test_projected_distance(self):
+        sf = StationFilter(self.root, self.meta_path)
+        sf.set_stations(list(self.points.index))
+        sf.boundary_buffer(self.poly_path, buffer_dist=10)
+        sf.run_filters()
+        # Distance of every station to the boundary, in meters of California Albers
+        boundary = self.square.to_crs({'init': 'epsg:3310'}).boundary.iloc[0]
+        dist = self.points.to_crs({'init': 'epsg:3310'}).distance(boundary)
+        near = set(dist.index[dist.values < 10000])
+        self.assertTrue(near)
+        self.assertEqual(sf.removed_station_ids, near)
+        self.assertEqual(sf.cleaned_station_ids, set(self.points.index) - near)
+        # The original buffer of buffer_dist * 0.01 degrees gets some of them wrong
+        old_buffer = self.square.boundary.buffer(0.1).iloc[0]
+        self.assertNotEqual(set(self.points.index[self.points.within(old_buffer).values]), near)
+
+
+if __name__ == '__main__':
+    unittest.main()
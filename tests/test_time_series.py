@@ -0,0 +1,54 @@
+"""
+Checks that generate_time_series_shuffle writes the same station time series as generate_time_series_V2.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+import fixtures
+import utils.station
+
+
+class TestShuffleMatchesV2(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.station_path, cls.meta_path = fixtures.make_raw_station_files(cls.root)
+        cls.v2_path = os.path.join(cls.root, 'v2')
+        os.makedirs(cls.v2_path)
+        utils.station.generate_time_series_V2(cls.meta_path, cls.station_path, cls.v2_path, n_chunks=2, n_workers=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def assert_same_output(self, out_path):
+        stations = sorted(n for n in os.listdir(self.v2_path) if n.isdigit())
+        self.assertEqual(stations, sorted(n for n in os.listdir(out_path) if n.isdigit()))
+        self.assertTrue(stations)
+        for stat in stations:
+            for name in ['time_series.csv', 'summary.csv']:
+                self.assertTrue(filecmp.cmp(os.path.join(self.v2_path, stat, name), os.path.join(out_path, stat, name),
+                                            shallow=False), '%s/%s differs' % (stat, name))
+
+    def test_serial(self):
+        out_path = os.path.join(self.root, 'shuffle_serial')
+        os.makedirs(out_path)
+        utils.station.generate_time_series_shuffle(self.meta_path, self.station_path, out_path, buffer_mb=1)
+        self.assert_same_output(out_path)
+
+    def test_workers(self):
+        out_path = os.path.join(self.root, 'shuffle_workers')
+        os.makedirs(out_path)
+        utils.station.generate_time_series_shuffle(self.meta_path, self.station_path, out_path, n_workers=2,
+                                                   prefetch=2)
+        self.assert_same_output(out_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
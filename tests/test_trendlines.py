@@ -0,0 +1,80 @@
+"""
+Checks that distribution_trendlines matches the row-wise apply it replaced, also when the stacked histograms are read
+back from their cache.
+Run from the repository root with: python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import fixtures
+import utils.station
+
+TARGET_DIR = os.path.join('7_Day_Groups', '1_Mon_2_Tue_3_Wed_4_Thur_5_Fri')
+
+
+def trendlines_apply(parent_dir, target_dir, m_file_name):
+    """
+    The original implementation of distribution_trendlines, one row-wise apply per station.
+    """
+    stations = [n for n in os.listdir(parent_dir) if n.isdigit()]
+    temp = pd.read_csv(os.path.join(parent_dir, stations[0], target_dir, m_file_name), sep=',', header=0, index_col=0)
+    bins = temp.columns.astype(float)
+    mid_points = bins + (bins[1] - bins[0])/2
+    temp_list = []
+    for stat in stations:
+        tp = os.path.join(parent_dir, stat, target_dir, m_file_name)
+        temp_list.append(pd.read_csv(tp, sep=',', header=0, index_col=0).
+                         apply(lambda x: np.dot(x, mid_points) / np.sum(x), axis=1))
+    out = pd.concat(temp_list, axis=1).transpose()
+    out.index = stations
+    return out
+
+
+class TestTrendlinesMatchApply(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.ts_path = fixtures.make_time_series(cls.root, n_stations=8, n_days=7)[0]
+        for stat in os.listdir(cls.ts_path):
+            stat_dir = os.path.join(cls.ts_path, stat)
+            utils.station.build_station_distributions(stat_dir, np.arange(0., 400, 20), np.arange(0., 100, 5))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                utils.station.group_days(stat_dir, [1, 2, 3, 4, 5])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def assert_same_trendlines(self, out_dir):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ref = trendlines_apply(self.ts_path, TARGET_DIR, 'counts_totals.csv').sort_index()
+            new = utils.station.distribution_trendlines(self.ts_path, TARGET_DIR, out_dir, 'Count', n_threads=2)
+        self.assertEqual(list(new.index), list(ref.index))
+        self.assertEqual(list(new.columns), list(ref.columns))
+        np.testing.assert_allclose(new.values, ref.values)
+        written = pd.read_csv(os.path.join(out_dir, os.path.basename(TARGET_DIR), 'counts_totals_trendlines.csv'),
+                              index_col=0)
+        np.testing.assert_allclose(written.values, ref.values)
+
+    def test_trendlines(self):
+        out_dir = os.path.join(self.root, 'trends')
+        self.assert_same_trendlines(out_dir)  # Builds the cache
+        self.assert_same_trendlines(out_dir)  # Reads the cache
+        # A changed station file is newer than the cache, so the histograms are read again
+        time.sleep(1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            utils.station.group_days(os.path.join(self.ts_path, '400001'), [3, 4, 5],
+                                     out_dir=os.path.basename(TARGET_DIR))
+        self.assert_same_trendlines(out_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
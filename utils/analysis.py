@@ -5,6 +5,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+import utils.station_dataset
+
 """
 These tools are used to analyze processed PeMS station data. In general, they should be used on the things produced
 by the utils.extractor tools.
@@ -18,8 +20,9 @@ by the utils.extractor tools.
 def plot_daily_station_series(df, station, out_path, field, fs=(10,6)):
     """
     Creates and saves daily time series plots for one field for one station.
-    :param df: (pd.DataFrame) Data frame of combined station data files. Typically will be output
-    from utils.extractor.station_files_to_df
+    :param df: (pd.DataFrame | utils.station_dataset.StationDataset) Data frame of combined station data files.
+    Typically will be output from utils.station.station_files_to_df. Or a StationDataset over the station data files,
+    in which case only the rows of station and the Timestamp and field columns are read.
     :param station: (int) Numeric id of station to plot data for.
     :param out_path: (str) Path to directory to write the images.
     :param field: (str) Column name of field from df to plot.
@@ -27,13 +30,20 @@ def plot_daily_station_series(df, station, out_path, field, fs=(10,6)):
     :return: (None)
 
     """
-    station_df = df[df['Station'] == station][['Timestamp', field]]
+    if isinstance(df, utils.station_dataset.StationDataset):
+        station_df = df.filter(stations=[station], columns=['Timestamp', field]).to_df()
+    else:
+        station_df = df[df['Station'] == station][['Timestamp', field]]
     # If the dataframe has not already converted timestamps to datetimes, convert them now
     if station_df.dtypes['Timestamp'] != np.dtype('<M8[ns]'):
-        station_df['Timestamp'] = pd.to_datetime(station['Timestamp'])
-    dates = np.unique(station_df['Timestamp'].apply(lambda x: x.date()))  # Unique dates
+        if np.issubdtype(station_df.dtypes['Timestamp'], np.integer):  # Seconds since the epoch
+            station_df['Timestamp'] = pd.to_datetime(station_df['Timestamp'], unit='s')
+        else:
+            station_df['Timestamp'] = pd.to_datetime(station_df['Timestamp'])
+    days = station_df['Timestamp'].dt.date
+    dates = np.unique(days)  # Unique dates
     for d in dates:
-        idx = station_df['Timestamp'].apply(lambda x: x.date() == d)
+        idx = days == d
         plt.close('all')
         fig = plt.figure(figsize=fs)
         ax = fig.gca()
@@ -6,21 +6,27 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 import shapefile
-from shapely.geometry import Polygon, Point
+from shapely.geometry import Point, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
 
+import meta_catalog
 import util_exceptions
 
 """
 These tools are used for processing station metadata files.
 """
 
+OPEN_END = 99991231  # date_key() of the valid_to of intervals that run to the latest metadata file
+
 ######################################################################################################################
 # Worker functions
 ######################################################################################################################
 # These are the functions that do all the heavy lifting
 
 def join_meta(meta_path, start_date=None, end_date=None,
-              out_path=None, write_out=False, preamble='d04_text_meta_', concat_intv=10):
+              out_path=None, write_out=False, preamble='d04_text_meta_', concat_intv=10, catalog_dir=None,
+              collapse=False):
     """
     Combines all the metadata files into one big dataframe and writes is to a csv with an appended date file.
     There is an option to use start and end dates so as to filter out files that do not fall within that daterange.
@@ -30,8 +36,23 @@ def join_meta(meta_path, start_date=None, end_date=None,
     :param out_path: (str) Full path of output file.
     :param write_out: (bool) Set to False to suppress writing of output csv. Default it False.
     :param preamble: (str) Leading text of metadata files. Used to avoid reading hidden OS files.
+    :param catalog_dir: (str) Optional, path to a utils.meta_catalog.MetaCatalog. If given, only the files that are
+    new or modified since the last run are parsed and added to the catalog. The rest are served from the catalog.
+    :param collapse: (bool) If True, the stacked files are collapsed into validity intervals with collapse_meta().
     :return: (pd.DataFrame) Data frame of vertically stacked metadata files. A date column is appendend.
     """
+    if catalog_dir:
+        catalog = meta_catalog.MetaCatalog(catalog_dir)
+        catalog.update(meta_path, preamble)
+        if start_date and end_date:
+            df = catalog.to_df(start_date, end_date)
+        else:
+            df = catalog.to_df()
+        if collapse:
+            df = collapse_meta(df)
+        if write_out:
+            df.to_csv(out_path, sep='\t', index=False)
+        return df
     start_dir = os.getcwd()
     os.chdir(meta_path)
     fnames = [n for n in os.listdir('.') if n[0:len(preamble)] == preamble]  # List of all file name to read
@@ -56,15 +77,51 @@ def join_meta(meta_path, start_date=None, end_date=None,
             temp_list = [pd.concat(temp_list)]
     os.chdir(start_dir)
     df = pd.concat(temp_list, ignore_index=True)
+    if collapse:
+        df = collapse_meta(df)
     if write_out:
         df.to_csv(out_path, sep='\t', index=False)
     return df
 
+def collapse_meta(meta_df):
+    """
+    Collapses joined metadata into a slowly-changing-dimension table. Consecutive metadata files repeat almost every
+    row, so each run of files in which a station keeps the same attributes becomes one row, valid from the date of the
+    first file of the run until the date of the next file, in which the station has changed or is missing. A station
+    that changes any attribute, or is missing from a file, starts a new row.
+    :param meta_df: (pd.DataFrame) Dataframe of joined metadata files. Must be output of meta.join_meta()
+    :return: (pd.DataFrame) One row per (ID, attribute set) interval, sorted by ID and date. The Date column is replaced
+    by valid_from and valid_to, in the same format as Date. valid_from is the date of the first file of the interval
+    and valid_to, which is exclusive, the date of the file after the last one. valid_to is None if the interval runs
+    to the latest file.
+    """
+    attrs = [c for c in meta_df.columns if c != 'Date']
+    df = meta_df.sort_values(['ID', 'Date'], kind='mergesort').reset_index(drop=True)
+    if not df.shape[0]:
+        return pd.DataFrame(columns=attrs + ['valid_from', 'valid_to'])
+    dates = df['Date'].values
+    file_dates = np.unique(dates)
+    date_idx = np.searchsorted(file_dates, dates)  # Position of each file date among all the file dates
+    # A row starts a new interval if any attribute, including ID, differs from the row before. Missing values are equal.
+    cur = df[attrs]
+    prev = cur.shift(1)
+    differs = (cur.values != prev.values) & ~(cur.isnull().values & prev.isnull().values)
+    starts = differs.any(axis=1)
+    starts[1:] |= (date_idx[1:] - date_idx[:-1]) > 1  # The station skipped at least one file
+    starts[0] = True
+    first = np.where(starts)[0]
+    last = np.append(first[1:] - 1, df.shape[0] - 1)
+    out = cur.iloc[first].reset_index(drop=True)
+    out['valid_from'] = dates[first]
+    next_idx = date_idx[last] + 1  # The file after the last one of the interval
+    out['valid_to'] = [file_dates[i] if i < file_dates.shape[0] else None for i in next_idx]
+    return out
+
 def get_meta_targets_from_files(meta_path, shape_path, out_path='', write_out=False,  preamble='d04_text_meta'):
     """
     Extracts all rows from station metadata files where the station falls within the polygon defined by the shapefile.
     :param meta_path: (str) Path to directory of station metadata files.
-    :param shape_path: (str) Path to the polygon shapefile. Shapefile must contain only one polygon.
+    :param shape_path: (str) Path to the polygon shapefile. If it has several polygons, their union is used.
     :return: (None)
     """
     if write_out == True and out_path == "":
@@ -75,9 +132,7 @@ def get_meta_targets_from_files(meta_path, shape_path, out_path='', write_out=Fa
     os.chdir(meta_path)
     fnames = [n for n in os.listdir(meta_path) if n[0:13] == preamble]
 
-    # Create Shapely polygon
-    poly_points = shapefile.Reader(shape_path).shapes()[0].points
-    poly = Polygon(poly_points)
+    poly = read_shape_polygon(shape_path)
 
     temp_list = []
     for name in fnames:  # Add the rest
@@ -93,14 +148,12 @@ def get_meta_targets_from_df(meta_df, shape_path):
     Extracts all rows from dataframe of joined metadata files where the station falls within the
     polygon defined by the shapefile.
     :param meta_df: (pandas.DataFrame) Dataframe of joined metadata files. Must be output of meta.join_meta()
-    :param shape_path: (str) Path to the polygon shapefile. Shapefile must contain only one polygon.
+    :param shape_path: (str) Path to the polygon shapefile. If it has several polygons, their union is used.
     :return: (pandas.DataFrame) Dataframe that is a subset of the input dataframe. Only contains rows of stations
             within the polygon boundaries.
     """
-    # Create Shapely polygon
-    poly_points = shapefile.Reader(shape_path).shapes()[0].points
-    poly = Polygon(poly_points)
-    return meta_df[meta_df.apply(lambda x: in_poly(x, poly), axis=1)]
+    poly = read_shape_polygon(shape_path)
+    return meta_df[points_in_poly(meta_df, poly)]
 
 def get_moving_meta_targets_from_df(meta_df, shape_path):
     """
@@ -108,18 +161,16 @@ def get_moving_meta_targets_from_df(meta_df, shape_path):
     least one observation for the station ID falls within the polygon defined by the shapefile.
     :param meta_df: (pandas.DataFrame) Dataframe of joined metadata files. This should only contain observations of
     moving stations! Must be output of meta.get_moving_ids()
-    :param shape_path: (str) Path to the polygon shapefile. Shapefile must contain only one polygon.
+    :param shape_path: (str) Path to the polygon shapefile. If it has several polygons, their union is used.
     :return: (pandas.DataFrame) Dataframe that is a subset of the input dataframe. Only contains rows of stations
             within the polygon boundaries.
     """
-    # Create Shapely polygon
-    poly_points = shapefile.Reader(shape_path).shapes()[0].points
-    poly = Polygon(poly_points)
+    poly = read_shape_polygon(shape_path)
     # Dataframe where all observations fall within the polygon
-    in_poly_df = meta_df[meta_df.apply(lambda x: in_poly(x, poly), axis=1)]  # Only rows within poly
+    in_poly_df = meta_df[points_in_poly(meta_df, poly)]  # Only rows within poly
     # Dataframe that includes all stations IDs where at least one observations was within the poly
     moving_ids = np.unique(in_poly_df['ID'])
-    return meta_df[meta_df.apply(lambda x: x['ID'] in moving_ids, axis=1)]
+    return meta_df[meta_df['ID'].isin(moving_ids)]
 
 def get_uniqe_id_locs(meta_df):
     """
@@ -130,37 +181,57 @@ def get_uniqe_id_locs(meta_df):
     :return: (pd.DataFrame) Dataframe of all the unique 3-tuples (ID, Latitude, Longitude). Date is the first appearance
             of the unique 3-tuple
     """
-    return meta_df[['ID', 'Latitude', 'Longitude', 'Date']].sort('Date').\
+    return meta_df[['ID', 'Latitude', 'Longitude', 'Date']].sort_values('Date', kind='mergesort').\
         drop_duplicates(['ID', 'Latitude', 'Longitude'])
 
-def filter_moving_ids(meta_df):
+def partition_moving_ids(meta_df, tolerance=0.0):
+    """
+    Due to bugs in the PeMS database, the mapping of station ID to Latitude and Longitude is not consistent. Some
+    stations "move". Splits the metadata into the rows of the stations that stay put and the rows of the stations that
+    move, in one pass.
+    :param meta_df: (pd.DataFrame) Pandas Dataframe of joined metadata files. Must be the output of
+    utils.meta.join_meta() to ensure the date column with proper format is present.
+    :param tolerance: (float) Largest change in Latitude or Longitude, in degrees, that is not counted as movement.
+    With the default of 0.0 a station moves if it has more than one distinct (Latitude, Longitude) pair. A missing
+    coordinate counts as a distinct value.
+    :return: ((pd.DataFrame, pd.DataFrame)) The rows of the good stations and the rows of the moving stations. Both
+    keep the order of meta_df.
+    """
+    coords = meta_df.groupby('ID')[['Latitude', 'Longitude']]
+    if tolerance > 0:
+        spread = coords.max() - coords.min()  # Missing coordinates are skipped
+        counts = coords.count()
+        sizes = coords.size()
+        partly_missing = (counts > 0).values & (counts.values < sizes.values[:, None])
+        moving = (spread > tolerance).values.any(axis=1) | partly_missing.any(axis=1)
+    else:
+        moving = (coords.nunique(dropna=False) > 1).values.any(axis=1)
+    moving_ids = coords.size().index[moving]  # Station ID values of moving stations
+    is_moving = meta_df['ID'].isin(moving_ids).values
+    return meta_df[~is_moving], meta_df[is_moving]
+
+def filter_moving_ids(meta_df, tolerance=0.0):
     """
     Due to bugs in the PeMS database, the mapping of station ID to Latitude and Longitude is not consistent. Some
     stations "move". Since data from these stations cannot be trusted, this script will remove them.
     :param meta_df: (pd.DataFrame) Pandas Dataframe of joined metadata files. Must be the output of
     utils.meta.join_meta() to ensure the date column with proper format is present.
+    :param tolerance: (float) See partition_moving_ids().
     :return: (pd.DataFrame) Subset of input with moving stations removed.
     """
-    unique_id_locs = get_uniqe_id_locs(meta_df)  # DF w/ one entry for each unique (ID, Lat, Lon) 3-tuple
-    unique_id = unique_id_locs.drop_duplicates(['ID'])  # DF w/ one entry for each unique ID
-    idx = [i for i in unique_id_locs.index if i not in unique_id.index]  # Indices of IDs that appear more than once
-    moving_ids = np.unique(unique_id_locs.loc[idx, 'ID'])  # Series of station ID values of moving stations
-    return meta_df[meta_df.apply(lambda x: x['ID'] not in moving_ids, axis=1)]
+    return partition_moving_ids(meta_df, tolerance)[0]
 
-def get_moving_ids(meta_df):
+def get_moving_ids(meta_df, tolerance=0.0):
     """
     Due to bugs in the PeMS database, the mapping of station ID to Latitude and Longitude is not consistent. Some
     stations "move". This script finds the moving stations and returns only their data. This is useful for
     analysis of the problem of moving stations.
     :param meta_df: (pd.DataFrame) Pandas Dataframe of joined metadata files. Must be the output of
     utils.meta.join_meta() to ensure the date column with proper format is present.
+    :param tolerance: (float) See partition_moving_ids().
     :return: (pd.DataFrame) Subset of input that only includes the IDs that move
     """
-    unique_id_locs = get_uniqe_id_locs(meta_df)  # DF w/ one entry for each unique (ID, Lat, Lon) 3-tuple
-    unique_id = unique_id_locs.drop_duplicates(['ID'])  # DF w/ one entry for each unique ID
-    idx = [i for i in unique_id_locs.index if i not in unique_id.index]  # Indices of IDs that appear more than once
-    moving_ids = np.unique(unique_id_locs.loc[idx, 'ID'])  # Series of station ID values of moving stations
-    return meta_df[meta_df.apply(lambda x: x['ID'] in moving_ids, axis=1)]
+    return partition_moving_ids(meta_df, tolerance)[1]
 
 def get_unique_xy(meta_path, county=75, preamble='d04_text_meta'):
     """
@@ -211,6 +282,94 @@ def in_poly(row, poly):
     """
     return poly.contains(Point(row['Longitude'], row['Latitude']))
 
+def read_shape_polygon(shape_path):
+    """
+    Reads every shape in a polygon shapefile and combines them into one geometry. Multi-part shapes and holes are kept.
+    :param shape_path: (str) Path to the polygon shapefile.
+    :return: (Polygon | MultiPolygon) Shapely geometry of the union of all the shapes.
+    """
+    shapes = [shape(s.__geo_interface__) for s in shapefile.Reader(shape_path).shapes()]
+    return shapes[0] if len(shapes) == 1 else unary_union(shapes)
+
+def points_in_poly(meta_df, poly):
+    """
+    Bulk version of in_poly(). The metadata repeat the same few thousand station locations in every file, so each
+    unique (Latitude, Longitude) pair is tested only once, against a prepared geometry, and the results are broadcast
+    back to the rows.
+    :param meta_df: (pd.DataFrame) Station metadata with Latitude and Longitude columns.
+    :param poly: (Polygon | MultiPolygon) Shapely geometry.
+    :return: (np.array) Boolean array, True for the rows within the poly. Rows with a missing coordinate are False.
+    """
+    lat = meta_df['Latitude'].values.astype(float)
+    lon = meta_df['Longitude'].values.astype(float)
+    inside = np.zeros(lat.shape[0], dtype=bool)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    if not valid.any():
+        return inside
+    # Each point as one complex number, so np.unique can dedupe the pairs
+    locs, inverse = np.unique(lon[valid] + 1j*lat[valid], return_inverse=True)
+    prepared = prep(poly)
+    loc_inside = np.array([prepared.contains(Point(z.real, z.imag)) for z in locs], dtype=bool)
+    inside[valid] = loc_inside[inverse]
+    return inside
+
+def date_key(dates):
+    """
+    :param dates: ([str | datetime]) Dates, as datetimes or strings in the 'YYYY_MM_DD' format of the Date column of
+    join_meta().
+    :return: (np.array) Dates as int64 YYYYMMDD numbers, which sort in date order.
+    """
+    return np.array([int(d.strftime('%Y%m%d')) if isinstance(d, datetime) else int(str(d).replace('_', ''))
+                     for d in dates], dtype=np.int64)
+
+class MetaSCD(object):
+    """
+    As-of lookups in the output of collapse_meta(). Intervals are sorted by (ID, valid_from) into one int64 key array,
+    so each lookup is a binary search. An interval covers the dates from valid_from up to, but not including, valid_to.
+    Intervals without a valid_to cover every later date.
+    """
+
+    def __init__(self, scd_df):
+        """
+        :param scd_df: (pd.DataFrame) Output of collapse_meta().
+        """
+        self.scd_df = scd_df.sort_values(['ID', 'valid_from'], kind='mergesort').reset_index(drop=True)
+        self.__ids = self.scd_df['ID'].values.astype(np.int64)
+        open_ended = self.scd_df['valid_to'].isnull().values
+        self.__valid_to = np.full(open_ended.shape[0], OPEN_END, dtype=np.int64)
+        self.__valid_to[~open_ended] = date_key(self.scd_df['valid_to'].values[~open_ended])
+        self.__keys = self.__ids*100000000 + date_key(self.scd_df['valid_from'])  # ID followed by YYYYMMDD
+
+    def lookup(self, stat_ids, dates):
+        """
+        :param stat_ids: ([int]) Station IDs.
+        :param dates: ([str | datetime]) Query date of each station. See date_key().
+        :return: (np.array) Row of self.scd_df that was valid for each (ID, date) pair, or -1 if there is none.
+        """
+        stat_ids = np.asarray(stat_ids, dtype=np.int64)
+        days = date_key(dates)
+        pos = np.searchsorted(self.__keys, stat_ids*100000000 + days, side='right') - 1  # Last interval started by then
+        safe = np.maximum(pos, 0)
+        found = (pos >= 0) & (self.__ids[safe] == stat_ids) & (days < self.__valid_to[safe])
+        return np.where(found, pos, -1)
+
+    def as_of(self, stat_id, date):
+        """
+        :param stat_id: (int) Station ID.
+        :param date: (str | datetime) Query date. See date_key().
+        :return: (pd.Series) The metadata of the station on date, or None if it was not in the metadata on that date.
+        """
+        pos = self.lookup([stat_id], [date])[0]
+        return self.scd_df.iloc[pos] if pos >= 0 else None
+
+    def as_of_many(self, stat_ids, dates):
+        """
+        :param stat_ids: ([int]) Station IDs.
+        :param dates: ([str | datetime]) Query date of each station. See date_key().
+        :return: (pd.DataFrame) One row per query, in query order. Rows of queries with no match are all NaN.
+        """
+        return self.scd_df.reindex(self.lookup(stat_ids, dates)).reset_index(drop=True)
+
 def temp_df(name, poly):
     """
     Helper function to read a metadata file into a dataframe and append a date column
@@ -220,6 +379,6 @@ def temp_df(name, poly):
     """
     temp = pd.read_csv(name, sep='\t')
     # Extract only the values within the poly
-    temp = temp[temp.apply(lambda x: in_poly(x, poly), axis=1)]
+    temp = temp[points_in_poly(temp, poly)]
     temp['Date'] = name[-14:-4]  # File names are fixed width
     return temp
\ No newline at end of file
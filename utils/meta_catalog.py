@@ -0,0 +1,101 @@
+__author__ = 'Andrew A Campbell'
+
+import os
+from datetime import datetime
+
+import pandas as pd
+
+"""
+Persistent catalog of the station metadata files. Every metadata file is parsed once and stored as a pickled partition
+of the rows of that date, so the joined metadata can be served again without re-parsing hundreds of text files. A
+manifest of file names and modification times tracks what has been ingested: update() only parses files that are new
+or have changed since the last run.
+"""
+
+MANIFEST_NAME = 'manifest.csv'
+
+
+class MetaCatalog(object):
+    """
+    Catalog of the metadata files of one directory, stored in catalog_dir. Each partition holds the rows of one
+    metadata file, in file order, with the Date column appended as in utils.meta.join_meta(). Rows are keyed by the
+    date of their partition and their ID.
+    """
+
+    def __init__(self, catalog_dir):
+        """
+        :param catalog_dir: (str) Path to the catalog directory. Created if it does not exist.
+        """
+        self.catalog_dir = catalog_dir
+        if not os.path.isdir(catalog_dir):
+            os.makedirs(catalog_dir)
+        self.manifest_path = os.path.join(catalog_dir, MANIFEST_NAME)
+        if os.path.isfile(self.manifest_path):
+            self.manifest = pd.read_csv(self.manifest_path, sep=',', dtype={'name': str, 'mtime': str, 'part': str})
+        else:
+            self.manifest = pd.DataFrame(columns=['name', 'mtime', 'part'])
+
+    def update(self, meta_path, preamble='d04_text_meta_'):
+        """
+        Brings the catalog in line with the metadata files in meta_path. New and modified files are parsed and stored.
+        Files that are no longer in meta_path are dropped from the catalog.
+        :param meta_path: (str) Path to directory with metadata files.
+        :param preamble: (str) Leading text of metadata files. Used to avoid reading hidden OS files.
+        :return: (int) Number of files parsed.
+        """
+        fnames = sorted([n for n in os.listdir(meta_path) if n[0:len(preamble)] == preamble])
+        known = dict(zip(self.manifest['name'], self.manifest['mtime']))
+        rows = []
+        n_parsed = 0
+        for name in fnames:
+            mtime = repr(os.path.getmtime(os.path.join(meta_path, name)))
+            part = name.split('.')[0] + '.pkl'
+            if known.get(name) != mtime or not os.path.isfile(os.path.join(self.catalog_dir, part)):
+                print 'Adding to catalog: ' + name
+                temp = pd.read_csv(os.path.join(meta_path, name), sep='\t')
+                temp['Date'] = name.split('.')[0][-10:]  # Date of the metadata file
+                temp.to_pickle(os.path.join(self.catalog_dir, part))
+                n_parsed += 1
+            rows.append((name, mtime, part))
+        for part in set(self.manifest['part']) - set(r[2] for r in rows):  # Files removed from meta_path
+            if os.path.isfile(os.path.join(self.catalog_dir, part)):
+                os.remove(os.path.join(self.catalog_dir, part))
+        self.manifest = pd.DataFrame(rows, columns=['name', 'mtime', 'part'])
+        self.manifest.to_csv(self.manifest_path, sep=',', index=False)
+        return n_parsed
+
+    def dates(self):
+        """
+        :return: ([datetime]) Date of each catalogued file, in chronological order.
+        """
+        return [file_date(n) for n in self.manifest['name']]
+
+    def to_df(self, start_date=None, end_date=None, ids=None):
+        """
+        Serves the catalogued rows in the format of utils.meta.join_meta().
+        :param start_date: (datetime) Optional, earliest date of files to include.
+        :param end_date: (datetime) Optional, latest date of files to include.
+        :param ids: ([int]) Optional, station IDs to include.
+        :return: (pd.DataFrame) Data frame of vertically stacked metadata files, in chronological order. A date column
+        is appended.
+        """
+        temp_list = []
+        for part, d in zip(self.manifest['part'], self.dates()):
+            if (start_date and d < start_date) or (end_date and d > end_date):
+                continue
+            temp = pd.read_pickle(os.path.join(self.catalog_dir, part))
+            if ids is not None:
+                temp = temp[temp['ID'].isin(ids)]
+            temp_list.append(temp)
+        if not temp_list:
+            return pd.DataFrame()
+        return pd.concat(temp_list, ignore_index=True)
+
+
+def file_date(name):
+    """
+    :param name: (str) Name of a metadata file, e.g. d04_text_meta_2014_05_01.txt
+    :return: (datetime) Date in the file name.
+    """
+    parts = name.split('.')[0].split('_')
+    return datetime(int(parts[-3]), int(parts[-2]), int(parts[-1]))
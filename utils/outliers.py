@@ -0,0 +1,287 @@
+import datetime
+import multiprocessing
+import os
+
+import numpy as np
+from sklearn import preprocessing, svm
+
+import utils.station
+import utils.util_exceptions
+
+__author__ = 'Andrew A Campbell'
+
+"""
+Batched outlier detection over the daily hourly flow profiles of many stations. The profiles of all the stations are
+built as one [station, day, hour] array by reshaping the 288 5-minute slots of each day. A detector then scores every
+station-day, larger scores being more outlying. The scores are kept, so the fraction of outlier days of each station
+can be recomputed for any cutoff with outlier_fractions() without refitting.
+
+Days without any rows in a station's time series are left out. A station with a day that has rows but is missing
+some hours, including a day whose flows are all missing, is not scored, as in StationFilter.outlier_detection_SVM, and
+its scores are NaN.
+"""
+
+SLOTS_PER_DAY = 288
+SLOTS_PER_HOUR = 12
+MAD_SCALE = 1.4826  # Makes the median absolute deviation consistent with the standard deviation of a normal
+MAD_FLOOR = 1e-6  # Smallest MAD used, so hours that are constant over all days do not divide by zero
+
+
+def hourly_profiles(grid):
+    """
+    Rolls up 5-minute flows to hourly flows.
+    :param grid: (np.array) Array of shape (..., 288) of 5-minute flows. Missing observations are NaN.
+    :return: (np.array) Array of shape (..., 24). Each hour is the sum of its observed 5-minute flows, NaN if the hour
+    has no observations. Same as StationFeatures.hourly_flow.
+    """
+    slots = np.asarray(grid, dtype=np.float64).reshape(grid.shape[:-1] + (24, SLOTS_PER_HOUR))
+    counts = np.sum(~np.isnan(slots), axis=-1)
+    sums = np.nansum(slots, axis=-1)
+    return np.where(counts > 0, sums, np.nan)
+
+
+def build_profiles(ts_dir, stations, date_list, n_workers=1):
+    """
+    Builds the hourly profiles of the stations from their time series.
+    :param ts_dir: (str) Path to the parent directory of the station time series. See
+    utils.station.generate_time_series_shuffle.
+    :param stations: ([str]) Station IDs, the names of the station directories.
+    :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
+    :param n_workers: (int) Number of worker processes reading the time series. The default of 1 reads them here.
+    :return: ((np.array, np.array)) Array of shape (n_stations, n_days, 24) of hourly flows, and mask of shape
+    (n_stations, n_days) of the days with rows in the time series. The days are those of date_list, in chronological
+    order. Each hour is the sum of its observed 5-minute flows, NaN if the hour has no observations. Same as
+    StationFeatures.hourly_flow.
+    """
+    days = date_days(date_list)
+    jobs = [(ts_dir, stat, days) for stat in stations]
+    if n_workers > 1 and jobs:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.map(station_profile_job, jobs, chunksize=max(1, len(jobs) // (4*n_workers)))
+        pool.close()
+        pool.join()
+    else:
+        results = [station_profile_job(job) for job in jobs]
+    if not results:
+        return np.empty((0, days.shape[0], 24)), np.empty((0, days.shape[0]), dtype=bool)
+    return np.stack([r[0] for r in results]), np.stack([r[1] for r in results])
+
+
+def cube_profiles(cube, date_list, stations=None):
+    """
+    Builds the hourly profiles of the stations from a station cube, without reading any time series.
+    :param cube: (utils.station_cube.StationCube) Cube with a Total_Flow field.
+    :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
+    :param stations: ([int | str]) Station IDs. If None, all the stations of the cube.
+    :return: ((np.array, np.array)) Array of shape (n_stations, n_days, 24) of hourly flows, and mask of the days with
+    any observation. The cube does not keep which rows existed, so unlike build_profiles, days whose flows are all
+    missing count as absent. Days outside the cube are NaN and absent.
+    """
+    days = date_days(date_list)
+    st_idx = np.arange(len(cube.stations)) if stations is None else cube.station_index(stations)
+    day_idx = (days - np.datetime64(cube.start.date())).astype(np.int64)
+    in_cube = (day_idx >= 0) & (day_idx < cube.days)
+    grid = np.full((st_idx.shape[0], days.shape[0], SLOTS_PER_DAY), np.nan)
+    grid[:, in_cube, :] = cube.field('Total_Flow')[np.ix_(st_idx, day_idx[in_cube], np.arange(SLOTS_PER_DAY))]
+    profiles = hourly_profiles(grid)
+    return profiles, ~np.isnan(profiles).all(axis=2)
+
+
+def outlier_scores(profiles, method='svm', n_workers=1, present=None, **kwargs):
+    """
+    Scores every station-day with one of the detectors.
+    :param profiles: (np.array) Array of shape (n_stations, n_days, 24). See build_profiles.
+    :param method: (str) 'svm', 'zscore' or 'mahalanobis'. See svm_scores, zscore_scores and mahalanobis_scores.
+    :param n_workers: (int) Number of worker processes. Only used by 'svm'.
+    :param present: (np.array) Mask of shape (n_stations, n_days) of the days with rows. See day_masks.
+    :param kwargs: Arguments of the detector.
+    :return: (np.array) Array of shape (n_stations, n_days) of scores.
+    """
+    if method == 'svm':
+        return svm_scores(profiles, present, n_workers=n_workers, **kwargs)
+    elif method == 'zscore':
+        return zscore_scores(profiles, present, **kwargs)
+    elif method == 'mahalanobis':
+        return mahalanobis_scores(profiles, present, **kwargs)
+    else:
+        raise utils.util_exceptions.WrongParamError(
+            "The method parameter must be one of 'svm', 'zscore' or 'mahalanobis'"
+        )
+
+
+def svm_scores(profiles, present=None, kernel='rbf', nu=0.5, gamma=0.0, n_workers=1):
+    """
+    Fits a one-class SVM to the standardized days of each station, as StationFilter.outlier_detection_SVM does. The
+    fits are run in a pool of worker processes.
+    :param profiles: (np.array) Array of shape (n_stations, n_days, 24).
+    :param present: (np.array) Mask of shape (n_stations, n_days) of the days with rows. See day_masks.
+    :param kernel: (str) See sklearn.svm.OneClassSVM.
+    :param nu: (float) See sklearn.svm.OneClassSVM.
+    :param gamma: (float) See sklearn.svm.OneClassSVM.
+    :param n_workers: (int) Number of worker processes. The default of 1 fits the stations here.
+    :return: (np.array) Array of shape (n_stations, n_days). The negated distance of each day from the decision
+    boundary, so days beyond decision_dist of the per-station filter score above decision_dist.
+    """
+    present, decided = day_masks(profiles, present)
+    scores = np.full(present.shape, np.nan)
+    st_idx = np.where(decided)[0]
+    jobs = [(profiles[i][present[i]], kernel, nu, gamma) for i in st_idx]
+    if n_workers > 1 and jobs:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap(svm_scores_job, jobs, chunksize=max(1, len(jobs) // (4*n_workers)))
+    else:
+        pool = None
+        results = (svm_scores_job(job) for job in jobs)
+    for i, dists in zip(st_idx, results):
+        scores[i, present[i]] = dists
+    if pool:
+        pool.close()
+        pool.join()
+    return scores
+
+
+def zscore_scores(profiles, present=None):
+    """
+    Robust z-scores of the standardized days of each station. Each hour is compared to the median of that hour over
+    the station's days, in units of the scaled median absolute deviation. Much cheaper than svm_scores.
+    :param profiles: (np.array) Array of shape (n_stations, n_days, 24).
+    :param present: (np.array) Mask of shape (n_stations, n_days) of the days with rows. See day_masks.
+    :return: (np.array) Array of shape (n_stations, n_days). Root mean square of the 24 hourly z-scores of each day.
+    """
+    present, decided = day_masks(profiles, present)
+    scores = np.full(present.shape, np.nan)
+    st_idx = np.where(decided)[0]
+    if not st_idx.shape[0]:
+        return scores
+    Z = standardize(profiles[st_idx])  # Absent days stay NaN and are ignored by the nan functions
+    med = np.nanmedian(Z, axis=1)[:, np.newaxis, :]
+    mad = np.maximum(MAD_SCALE*np.nanmedian(np.abs(Z - med), axis=1), MAD_FLOOR)[:, np.newaxis, :]
+    scores[st_idx] = np.sqrt(np.mean(((Z - med) / mad)**2, axis=2))
+    return scores
+
+
+def mahalanobis_scores(profiles, present=None):
+    """
+    Mahalanobis distance of the standardized days of each station from the station's mean day. The pseudo-inverse of
+    the covariance is used, since it is singular when a station has fewer days than hours.
+    :param profiles: (np.array) Array of shape (n_stations, n_days, 24).
+    :param present: (np.array) Mask of shape (n_stations, n_days) of the days with rows. See day_masks.
+    :return: (np.array) Array of shape (n_stations, n_days). NaN for stations with fewer than 2 days.
+    """
+    present, decided = day_masks(profiles, present)
+    decided &= present.sum(axis=1) > 1
+    scores = np.full(present.shape, np.nan)
+    st_idx = np.where(decided)[0]
+    if not st_idx.shape[0]:
+        return scores
+    Z = standardize(profiles[st_idx])
+    mask = present[st_idx][:, :, np.newaxis]
+    n = mask.sum(axis=1)  # Days of each station, shape (n_stations, 1)
+    mu = np.where(mask, Z, 0).sum(axis=1) / n
+    Xc = np.where(mask, Z - mu[:, np.newaxis, :], 0)  # Absent days are zeroed out of the covariance
+    cov = np.einsum('sdh,sdg->shg', Xc, Xc) / (n - 1)[:, :, np.newaxis]
+    d2 = np.einsum('sdh,shg,sdg->sd', Xc, np.linalg.pinv(cov, rcond=1e-10), Xc)
+    scores[st_idx] = np.where(present[st_idx], np.sqrt(np.maximum(d2, 0)), np.nan)
+    return scores
+
+
+def outlier_fractions(scores, cutoff):
+    """
+    Fraction of outlier days of each station. Cheap, so the cutoff can be tuned on saved scores.
+    :param scores: (np.array) Array of shape (n_stations, n_days). See outlier_scores.
+    :param cutoff: (float) Days scoring above cutoff are outliers.
+    :return: (np.array) Fraction of each station's scored days that are outliers. NaN if the station was not scored.
+    """
+    scored = ~np.isnan(scores)
+    n_out = np.sum(np.where(scored, scores, -np.inf) > cutoff, axis=1)
+    n_days = scored.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n_days > 0, np.true_divide(n_out, n_days), np.nan)
+
+
+######################################################################################################################
+# Helper functions
+######################################################################################################################
+
+def nan_bincount(keys, values, n):
+    """
+    Sums and counts the non-NaN values of each key.
+    :param keys: (np.array) Integer key of each value, in [0, n).
+    :param values: (np.array) Values to sum.
+    :param n: (int) Number of keys.
+    :return: ((np.array, np.array)) The sum and the number of non-NaN values of each key.
+    """
+    valid = ~np.isnan(values)
+    sums = np.bincount(keys[valid], weights=values[valid].astype(np.float64), minlength=n)
+    counts = np.bincount(keys[valid], minlength=n)
+    return sums, counts
+
+
+def date_days(date_list):
+    """
+    :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
+    :return: (np.array) The unique days, as datetime64[D], in chronological order.
+    """
+    return np.unique(np.array([datetime.datetime.strptime(d, '%m/%d/%Y').date() for d in date_list],
+                              dtype='datetime64[D]'))
+
+
+def day_masks(profiles, present=None):
+    """
+    :param profiles: (np.array) Array of shape (n_stations, n_days, 24).
+    :param present: (np.array) Mask of shape (n_stations, n_days) of the days with rows, as returned by build_profiles.
+    If None, the days with any observation.
+    :return: ((np.array, np.array)) Mask of shape (n_stations, n_days) of the present days, and mask of the stations
+    that can be scored: none of their present days miss an hour and they have at least one.
+    """
+    missing = np.isnan(profiles)
+    if present is None:
+        present = ~missing.all(axis=2)
+    partial = missing.any(axis=2) & present
+    return present, present.any(axis=1) & ~partial.any(axis=1)
+
+
+def standardize(profiles):
+    """
+    Scales each day to zero mean and unit variance over its hours, as sklearn.preprocessing.scale(X, axis=1).
+    :param profiles: (np.array) Array of shape (..., 24).
+    :return: (np.array) The scaled profiles. Days with a constant flow are only centered.
+    """
+    mean = profiles.mean(axis=-1)[..., np.newaxis]
+    std = profiles.std(axis=-1)[..., np.newaxis]
+    return (profiles - mean) / np.where(std > 0, std, 1)
+
+
+def station_profile_job(job):
+    """
+    Builds the hourly profiles of one station.
+    :param job: ((str, str, np.array)) Path to the parent directory of the station time series, station ID and the
+    days, as datetime64[D] in chronological order.
+    :return: ((np.array, np.array)) Array of shape (n_days, 24) of hourly flows, and mask of the days with rows.
+    """
+    ts_dir, stat, days = job
+    if not days.shape[0]:
+        return np.empty((0, 24)), np.empty(0, dtype=bool)
+    ts = utils.station.read_time_series(os.path.join(ts_dir, stat))
+    stamps = ts['Timestamp'].values
+    row_days = stamps.astype('datetime64[D]')
+    day_idx = np.minimum(np.searchsorted(days, row_days), days.shape[0] - 1)
+    mask = days[day_idx] == row_days
+    hours = ((stamps[mask] - row_days[mask]) // np.timedelta64(1, 'h')).astype(np.int64)
+    # Every row is summed, as in StationFeatures.hourly_flow, so duplicated timestamps are counted the same way
+    sums, counts = nan_bincount(day_idx[mask]*24 + hours, ts['Total_Flow'].values[mask], days.shape[0]*24)
+    present = np.bincount(day_idx[mask], minlength=days.shape[0]) > 0
+    return np.where(counts > 0, sums, np.nan).reshape((days.shape[0], 24)), present
+
+
+def svm_scores_job(job):
+    """
+    Fits a one-class SVM to the days of one station.
+    :param job: ((np.array, str, float, float)) Days x 24 hourly flows, kernel, nu and gamma.
+    :return: (np.array) Negated distance of each day from the decision boundary.
+    """
+    X, kernel, nu, gamma = job
+    X = preprocessing.scale(X, axis=1)
+    clf = svm.OneClassSVM(kernel=kernel, nu=nu, gamma=gamma)
+    clf.fit(X)
+    return -clf.decision_function(X).ravel()
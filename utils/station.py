@@ -1,9 +1,16 @@
+from collections import defaultdict, deque
 import datetime
 import gc
+import gzip
+from itertools import izip
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import shutil
 import sys
 import time
+import zlib
 
 import numpy as np
 import pandas as pd
@@ -18,98 +25,151 @@ spatial aggregation, which may be too big or small for the level of analysis. Th
 that fall within a shapefile polygon that defines your casestudy area.
 """
 
+# Header of the station-level columns of a raw 5-minute station file. The per-lane columns that follow are not used.
+STATION_HEAD = ['Timestamp', 'Station', 'District', 'Fwy', 'Dir', 'Type',
+                'Length', 'Samples', 'Observed', 'Total_Flow', 'Avg_Occ', 'Avg_Speed']
+TIMESTAMP_FORMAT = '%m/%d/%Y %H:%M:%S'  # Format of the Timestamp strings in station files and time_series.csv
+# Compact dtypes of the station-level columns, used by read_station_file(). Timestamp is converted after parsing.
+STATION_DTYPES = {'Timestamp': 'category', 'Station': np.int32, 'District': np.int16, 'Fwy': 'category',
+                  'Dir': 'category', 'Type': 'category', 'Length': np.float32, 'Samples': np.float32,
+                  'Observed': np.float32, 'Total_Flow': np.float32, 'Avg_Occ': np.float32, 'Avg_Speed': np.float32}
+FILE_DATE_PATTERN = re.compile(r'(\d{4})_(\d{2})_(\d{2})')  # Date in the station file names, e.g. _2014_05_01
+TIME_STRINGS = ['%02d:%02d' % (m // 60, m % 60) for m in range(0, 60*24, 5)]  # 'hh:mm' label of each 5-minute slot
+# Day-of-week directories of the distributions, Sunday = 0
+DAY_DIRS = {0: '0_Sun', 1: '1_Mon', 2: '2_Tue', 3: '3_Wed', 4: '4_Thur', 5: '5_Fri', 6: '6_Sat'}
+# Totals and proportions csv files of each distribution metric
+DIST_FILES = {'count': ['counts_totals.csv', 'counts_proportions.csv'],
+              'speed': ['speed_totals.csv', 'speed_proportions.csv']}
+
 ######################################################################################################################
 # Worker functions
 ######################################################################################################################
 # These are the functions that do all the heavy lifting
 
 def get_station_targets(station_path, meta_path, out_path,
-                        preamble='d04_text_station', prologue='_FCMS_extract.txt'):
+                        preamble='d04_text_station', prologue='_FCMS_extract.txt', chunksize=500000,
+                        station_cols_only=False, n_workers=2, prefetch=4):
     """
     Extracts station data rows from only the stations that have and ID that appears in the metadata file defined
     by meta_path. The meta_path file should be the aggregate of all stations we want to study. Thus, all station
     filtering should be done in the creation of this aggregate metadata file. Writes the target stations to
     csv files in the same format.
+
+    Each file is streamed in chunks of chunksize rows and the extract is written incrementally, so memory use does not
+    depend on the file size. Fields are kept as the original strings, so extracted rows are written exactly as read.
     :param station_path: (str) Path to directory with station data.
     :param meta_path: (str) Path to a file with the meta data for all case study stations. This should be the text file
     written by get_meta_targets()
     :param out_path: (str) Path to directory to write output files
     :param preamble: (str) The leading characters of the name of station data files
     :param prologue: (str) The characters to append to the ened of extracted data files.
+    :param chunksize: (int) Number of rows to read at a time.
+    :param station_cols_only: (bool) If True, only the 12 station-level columns are read and written. The per-lane
+    columns are dropped.
+    :param n_workers: (int) Number of reader processes. See iter_station_files().
+    :param prefetch: (int) Maximum number of files being read ahead. See iter_station_files().
     :return: (None)
     """
-    start_dir = os.getcwd()
-    os.chdir(station_path)
-    fnames = [n for n in os.listdir('.') if n[0:len(preamble)] == preamble]  # List of all file name to read
+    fnames = [n for n in os.listdir(station_path) if n[0:len(preamble)] == preamble]  # List of all file name to read
+    fnames.sort()
     target_ids = np.unique(pd.read_csv(meta_path, sep='\t')['ID'])  # IDs of stations in case study area
 
-    # Process every file in fnames
+    # Process every file in fnames. The extracts are made by the reader workers, ahead of this loop.
+    jobs = [(os.path.join(station_path, name), target_ids, out_path+name.split('.')[0]+prologue, chunksize,
+             station_cols_only) for name in fnames]
     row_count = 0
-    for name in fnames:
-        print 'Processing: ' + name
-        temp = pd.read_csv(name, sep=',', compression='gzip', header=None)
-        temp = temp[temp.apply(lambda x: x[1] in target_ids, axis=1)]  # Keep only rows that are in the metadata file
-        row_count += temp.shape[0]
-        temp.to_csv(out_path+name.split('.')[0]+prologue, sep=',', index=False, header=False)
+    for name, n_rows in izip(fnames, iter_station_files(jobs, extract_station_rows, n_workers, prefetch)):
+        print 'Processed: ' + name
+        row_count += n_rows
     print 'Total extracted observations: %d' % row_count
-    os.chdir(start_dir)
 
-def station_files_to_df(station_path, preamble='d04_text_station', concat_intv=10):
+def station_files_to_df(station_path, preamble='d04_text_station', concat_intv=10, n_workers=2, prefetch=4):
     """
     Reads all the individual station files in directory at station_path and returns them as a single dataframe.
     :param station_path: (str) Path to directory with station data files.
     :param concat_intv: (int) Aggregation interval is the number of files to open and convert to data frame before
     aggregating. It would be fastest to open everything and concat only once. But this could cause memory problems.
     :param preamble: (str) Text that target file names begin with.
+    :param n_workers: (int) Number of reader processes. See iter_station_files().
+    :param prefetch: (int) Maximum number of files being read ahead. See iter_station_files().
     :return: (pd.DataFrame) Dataframe containing all the data from the individual files with a date column appended.
-    WARNING: This method only keeps the totals for each station. The lane-level data are thrown away.
+    The columns have the compact dtypes of read_station_file().
+    WARNING: This method only keeps the totals for each station. The lane-level data are thrown away. For a year of
+    data, use a utils.station_dataset.StationDataset instead, which only reads the stations, dates and columns needed.
     """
     head = ['Timestamp', 'Station', 'District', 'Fwy', 'Dir', 'Type',
             'Length', 'Samples', 'Observed', 'Total_Flow', 'Avg_Occ', 'Avg_Speed'] # Header for output df
-    df = pd.DataFrame(columns=head)
-    start_dir = os.getcwd()
-    os.chdir(station_path)
-    fnames = [n for n in os.listdir('.') if n[0:len(preamble)] == preamble]  # List of all file name to read
-    temp_list = [df]
-    for name in fnames:
+    fnames = [n for n in os.listdir(station_path) if n[0:len(preamble)] == preamble]  # List of all file name to read
+    if not fnames:
+        return pd.DataFrame(columns=head)
+    jobs = [(os.path.join(station_path, name),) for name in fnames]
+    temp_list = []
+    for name, temp in izip(fnames, iter_station_files(jobs, n_workers=n_workers, prefetch=prefetch)):
         print 'Adding file: ' + name
-        temp = pd.read_csv(name, sep=',', header=None).iloc[:, 0:len(head)]
-        temp.columns = head
         temp_list.append(temp)
-        #TODO cast the Station column to int
         if len(temp_list) == concat_intv:
-            temp_list = [pd.concat(temp_list)]
-    os.chdir(start_dir)
-    return pd.concat(temp_list)
+            temp_list = [pd.concat(temp_list, ignore_index=True)]
+    return concat_station_frames(temp_list)
 
-def join_stations(station_path, out_path,  preamble='d04_text_station'):
+def join_stations(station_path, out_path,  preamble='d04_text_station', compress=False, buffer_mb=16):
     """
-    Combines all the station files into one long text file.
+    Combines all the station files into one long text file. Gzipped station files are decompressed on the fly, or,
+    with compress=True, copied as they are. Files are copied in blocks of buffer_mb, not line by line. The first and
+    last dates in the output name are taken from the file names, or read from the first and last rows of the data if
+    the names have no date.
+
+    An index with the byte offset and length of each file in the combined file is written next to it, as
+    <combined file>.index.csv. Station files hold one day each, so read_joined_day() can use the index to read a single
+    day without scanning. With compress=True every day is a separate gzip member of the combined file. Gzipped station
+    files are then copied without being read, so they must end with a newline, as the clearinghouse files do.
     :param station_path: (str) Path to directory with station data files
     :param out_path: (str) Path to directory to write the combined file.
     :param preamble: (str) Text that target file names begin with.
-    :return: (None)
+    :param compress: (bool) If True, the combined file is gzipped and its name ends with .gz.
+    :param buffer_mb: (int) Size of the copy buffer in megabytes.
+    :return: (str) Path of the combined file.
     """
-    start_dir = os.getcwd()
-    os.chdir(station_path)
-    fnames = [n for n in os.listdir('.') if n[0:len(preamble)] == preamble]  # List of all file name to read
+    fnames = [n for n in os.listdir(station_path) if n[0:len(preamble)] == preamble]  # List of all file name to read
     fnames.sort()  # Sorting names ensures the dates will be read chronologically
-    with open(fnames[0], 'r') as f:  # Get the earliest date
-        start_date = f.next().split(',')[0].split()[0].split('/')  # [dd, mm, yyyy]
-    with open(fnames[-1], 'r') as f:  # Get the latest date
-        for line in f:
-            pass
-        last_date = line.split(',')[0].split()[0].split('/')  # [dd, mm, yyyy]
-    out_name = preamble + '_combined_' + start_date[1] + '_' + start_date[2] + '_' + last_date[1] + '_' + \
-               last_date[2] + '.txt'
-    with open(out_path+out_name, 'w') as fo:  # Combine all the files
+    start_date = station_file_date(os.path.join(station_path, fnames[0]))  # Get the earliest date
+    last_date = station_file_date(os.path.join(station_path, fnames[-1]), last=True)  # Get the latest date
+    out_name = preamble + '_combined_%02d_%d_%02d_%d.txt' % (start_date.day, start_date.year, last_date.day,
+                                                             last_date.year)
+    if compress:
+        out_name += '.gz'
+    out_file = os.path.join(out_path, out_name)
+    buffer_size = buffer_mb*1024*1024
+    index = []  # (date, offset, length) of each file in the combined file
+    with open(out_file, 'w+b') as fo:  # Combine all the files
         for name in fnames:
-            with open(name, 'r') as fi:
-                for line in fi:
-                    fo.writelines(line)
-    os.chdir(start_dir)
+            in_file = os.path.join(station_path, name)
+            offset = fo.tell()
+            if compress and name.endswith('.gz'):  # Already a gzip member
+                with open(in_file, 'rb') as fi:
+                    shutil.copyfileobj(fi, fo, buffer_size)
+            elif compress:
+                last = ''  # Last byte copied
+                with open(in_file, 'rb') as fi:
+                    gz = gzip.GzipFile(filename='', mode='wb', fileobj=fo)
+                    for block in iter(lambda: fi.read(buffer_size), ''):
+                        gz.write(block)
+                        last = block[-1]
+                    if last and last != '\n':  # Do not run the last row of this file into the first row of the next
+                        gz.write('\n')
+                    gz.close()  # Ends the member. Does not close fo.
+            else:
+                with open_station_file(in_file) as fi:
+                    shutil.copyfileobj(fi, fo, buffer_size)
+                if fo.tell() > offset:
+                    fo.seek(-1, os.SEEK_CUR)
+                    if fo.read(1) != '\n':  # Do not run the last row of this file into the first row of the next
+                        fo.write('\n')
+            index.append((station_file_date(in_file).strftime('%m/%d/%Y'), offset, fo.tell() - offset))
+    pd.DataFrame(index, columns=['date', 'offset', 'length']).to_csv(out_file + '.index.csv', sep=',', index=False)
+    return out_file
 
-def generate_time_series(meta_target_path, station_path, out_path, preamble='d04_text_station_5min', n_chunks=4):
+def generate_time_series(meta_target_path, station_path, out_path, preamble='d04_text_station_5min', n_chunks=4,
+                         n_workers=2, prefetch=4):
     """
     Creates individual time series of counts and speeds for each station ID in the aggregated metadata file at
     meta_target_path. A sub directory is created for each unique ID. The time series for that ID is saved as a
@@ -126,6 +186,8 @@ def generate_time_series(meta_target_path, station_path, out_path, preamble='d04
     :param out_path: (str) Path to the parent directory for the output time series.
     :param preamble: (str) The leading characters of station data file names. Prevents trying to parse hidden files etc.
     :param n_chunks: (int) Number of chunks to break the set of unique IDs into.
+    :param n_workers: (int) Number of reader processes. See iter_station_files().
+    :param prefetch: (int) Maximum number of files being read ahead. See iter_station_files().
     :return: (None)
     """
     # Step 0 - Define constants and get list of file names to open and read.
@@ -133,6 +195,8 @@ def generate_time_series(meta_target_path, station_path, out_path, preamble='d04
             'Length', 'Samples', 'Observed', 'Total_Flow', 'Avg_Occ', 'Avg_Speed']  # Header for output df
     fnames = [n for n in os.listdir(station_path) if n[0:len(preamble)] == preamble]
     fnames.sort()  # Sort names in ascending chronological order
+    # Untyped reads, so time_series.csv keeps its format. Paths are absolute because the output steps change the cwd.
+    jobs = [(os.path.abspath(os.path.join(station_path, name)), False) for name in fnames]
     start_dir = os.getcwd()
     # Step 1 - Get all unique station IDs from meta_target_path. Aggregated into n_chunks arrays
     target_ids = np.unique(pd.read_csv(meta_target_path, sep='\t')['ID'])  # IDs of stations in case study area
@@ -149,12 +213,11 @@ def generate_time_series(meta_target_path, station_path, out_path, preamble='d04
         temp_chunk = pd.DataFrame(columns=head, index=np.arange(max_rows))
         temp_chunk.iloc[:, :] = -9
         # Step 3 - Iterate through all the station data files
-        os.chdir(station_path)
         ix = 0  # Index of current row in temp_chunk
-        for name in fnames:
+        for name, temp in izip(fnames, iter_station_files(jobs, read_station_file, n_workers, prefetch)):
             tic = time.time()
             print 'Processing ' + name
-            temp = pd.read_csv(name, sep=',', index_col=False)
+            temp = temp.iloc[1:]  # This version has always read the first row of each file as a header
             # Step 4 - Iterate through all the IDs in the chunk, extract the time series and append to temp_chunk.
             for stat_id in chunk:
                 temp_ts = get_id_time_series(temp, stat_id)  # Time series for stat_id
@@ -174,7 +237,8 @@ def generate_time_series(meta_target_path, station_path, out_path, preamble='d04
     os.chdir(start_dir)
 
 #TODO remove and archive original version. Get rid of references to V2
-def generate_time_series_V2(meta_target_path, station_path, out_path, preamble='d04_text_station_5min', n_chunks=4):
+def generate_time_series_V2(meta_target_path, station_path, out_path, preamble='d04_text_station_5min', n_chunks=4,
+                            out_format='csv', n_workers=2, prefetch=4):
     """
     Creates individual time series of counts and speeds for each station ID in the aggregated metadata file at
     meta_target_path. A sub directory is created for each unique ID. The time series for that ID is saved as a
@@ -191,6 +255,9 @@ def generate_time_series_V2(meta_target_path, station_path, out_path, preamble='
     :param out_path: (str) Path to the parent directory for the output time series.
     :param preamble: (str) The leading characters of station data file names. Prevents trying to parse hidden files etc.
     :param n_chunks: (int) Number of chunks to break the set of unique IDs into.
+    :param out_format: (str) Format of the station time series: 'csv', 'npz' or 'both'. See write_time_series().
+    :param n_workers: (int) Number of reader processes. See iter_station_files().
+    :param prefetch: (int) Maximum number of files being read ahead. See iter_station_files().
     :return: (None)
     """
     # Step 0 - Define constants and get list of file names to open and read.
@@ -198,6 +265,8 @@ def generate_time_series_V2(meta_target_path, station_path, out_path, preamble='
             'Length', 'Samples', 'Observed', 'Total_Flow', 'Avg_Occ', 'Avg_Speed']  # Header for output df
     fnames = [n for n in os.listdir(station_path) if n[0:len(preamble)] == preamble]
     fnames.sort()  # Sort names in ascending chronological order
+    # Untyped reads, so time_series.csv keeps its format. Paths are absolute because the output steps change the cwd.
+    jobs = [(os.path.abspath(os.path.join(station_path, name)), False) for name in fnames]
     start_dir = os.getcwd()
     # Step 1 - Get all unique station IDs from meta_target_path. Aggregated into n_chunks arrays
     # target_ids = np.unique(pd.read_csv(meta_target_path, sep='\t')['ID'])  # IDs of stations in case study area
@@ -213,11 +282,10 @@ def generate_time_series_V2(meta_target_path, station_path, out_path, preamble='
         # Initiate one large temp dataframe for holding values for all IDs in chunk
         temp_list = []
         # Step 3 - Iterate through all the station data files
-        os.chdir(station_path)
         tic = time.time()
-        for name in fnames:  # Iterate through each station data file. Each file is typically a unique date.
+        # Iterate through each station data file. Each file is typically a unique date.
+        for name, temp in izip(fnames, iter_station_files(jobs, read_station_file, n_workers, prefetch)):
             print 'Processing ' + name
-            temp = pd.read_csv(name, sep=',', header=None, index_col=False)
             # Step 4 - Iterate through all the IDs in the chunk, extract the time series and append to temp_chunk.
             for stat_id in chunk:
                 temp_list.append(get_id_time_series(temp, stat_id))  # Time series for stat_id
@@ -234,55 +302,176 @@ def generate_time_series_V2(meta_target_path, station_path, out_path, preamble='
             os.mkdir(str(stat_id))
             os.chdir(str(stat_id))
             temp_ts = temp_chunk[temp_chunk['Station'] == stat_id]  # time series with just the stat_id
-            temp_ts.to_csv('time_series.csv', sep=',', index=False)
+            write_time_series(temp_ts, '.', out_format)
             ts_agg_measures(temp_ts).to_csv('summary.csv', sep=',', index=False)
         del temp_chunk  # clear this from memory
     os.chdir(start_dir)
 
+def generate_time_series_shuffle(meta_target_path, station_path, out_path, preamble='d04_text_station_5min',
+                                 spill_dir=None, buffer_mb=256, n_workers=1, out_format='csv', prefetch=4):
+    """
+    Single-pass replacement for generate_time_series_V2. Produces the same output: a sub directory for each unique ID
+    in the aggregated metadata file, holding time_series.csv and summary.csv.
+
+    Each station data file is read exactly once. The rows of the target stations are sorted by station ID and split
+    into per-station buckets in one vectorized step. The buckets are collected in per-station append buffers that are
+    spilled to one file per station whenever the buffers exceed buffer_mb. Once every file has been read, the spill
+    file of each station is converted into its time_series.csv and summary.csv. The total work is linear in the size
+    of the input, independent of the number of stations, and memory is bounded by one station data file plus the
+    buffers.
+
+    With n_workers > 1 the station data files are parsed and partitioned by the reader processes of
+    iter_station_files(), at most prefetch files ahead of the parent. The parent merges the partitions into the append
+    buffers in chronological order, and the output files are written by a pool of n_workers processes. The output is
+    byte-identical to the serial path.
+
+    :param meta_target_path: (str) Path to the aggregated metadata file of target stations. This file is the canonical
+    set of station IDs to use in the study!
+    :param station_path: (str) Path to the directory containing all the extracted raw station data files to be
+    processed. This directory should have been created by utils.station.get_station_targets().
+    :param out_path: (str) Path to the parent directory for the output time series.
+    :param preamble: (str) The leading characters of station data file names. Prevents trying to parse hidden files etc.
+    :param spill_dir: (str) Path to a scratch directory for the per-station spill files. Defaults to a '_spill'
+    directory in out_path. Any existing contents are deleted and the directory is removed when finished.
+    :param buffer_mb: (int) Size, in megabytes, of the in-memory append buffers before they are spilled to disk.
+    :param n_workers: (int) Number of worker processes. Default is 1, which processes everything in this process.
+    :param out_format: (str) Format of the station time series: 'csv', 'npz' or 'both'. See write_time_series().
+    :param prefetch: (int) Maximum number of files being read ahead when n_workers > 1. See iter_station_files().
+    :return: (None)
+    """
+    # Step 0 - Get list of file names to open and read.
+    fnames = [n for n in os.listdir(station_path) if n[0:len(preamble)] == preamble]
+    fnames.sort()  # Sort names in ascending chronological order
+    target_ids = np.unique(pd.read_csv(meta_target_path)['ID'])  # IDs of stations in case study area
+    if not spill_dir:
+        spill_dir = os.path.join(out_path, '_spill')
+    if os.path.isdir(spill_dir):  # Leftovers from an interrupted run would be appended to
+        shutil.rmtree(spill_dir)
+    os.makedirs(spill_dir)
+    spill = StationSpill(spill_dir, buffer_mb*1024*1024)
+    # Step 1 - Read each file once and append the rows of every station to its buffer
+    tic = time.time()
+    jobs = [(os.path.join(station_path, name), target_ids) for name in fnames]
+    partitions = iter_station_files(jobs, partition_station_file, n_workers if n_workers > 1 else 0, prefetch)
+    for name, partition in izip(fnames, partitions):
+        print 'Processing ' + name
+        for stat_id, text in partition:
+            spill.append(stat_id, text)
+    spill.flush()
+    print 'Time to partition %f' % (time.time() - tic)
+    # Step 2 - Write the output for every target ID
+    jobs = [(spill.spill_path(stat_id), os.path.join(out_path, str(stat_id)), out_format) for stat_id in target_ids]
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        pool.map(write_station_time_series_job, jobs)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            write_station_time_series_job(job)
+    shutil.rmtree(spill_dir)
+
 
 def rollup_time_series(agg_period, station_path, out_name, nrows=105120):
     """
     Used to rollup the raw time series into larger temporal aggregates. By default, the time series will be in 5-minute
-    time bins. This method can be used to bin them into 15 or 30 minute bins (or any other aggregation).
-    :param agg_period: (int) Defines how many rows to group together during aggregation.
+    time bins. This method can be used to bin them into 15 or 30 minute bins (or any other aggregation). Several
+    aggregations can be built from a single read of the time series by passing lists of agg_period and out_name.
+    :param agg_period: (int | [int]) Defines how many rows to group together during aggregation.
     :param station_path: (str) Path to the directory containing the station time_series.csv
     processed. This directory should have been created by utils.station.get_station_targets().
-    :param out_name: (str) Name of output csv to be written in same directory as station_path
+    :param out_name: (str | [str]) Name of output csv to be written in same directory as station_path. One name for
+    each agg_period.
     :param nrows: (int) Number of rows that a time series with no missing observations should. Defaults to 105120,
     365*24*60/5
     :return:
     """
-    start_dir = os.getcwd()
-    os.chdir(station_path)
-    ts = pd.read_csv('time_series.csv', sep=',', index_col='Timestamp')
+    agg_periods = agg_period if isinstance(agg_period, (list, tuple)) else [agg_period]
+    out_names = out_name if isinstance(out_name, (list, tuple)) else [out_name]
+    if len(agg_periods) != len(out_names):
+        raise utils.util_exceptions.WrongParamError(
+            'There must be one out_name for each agg_period'
+        )
+    ts = read_time_series(station_path).set_index('Timestamp')
     # Check for missing rows and reindex if needed
     if ts.shape[0] != nrows:
         ts = reindex_timeseries(ts)
-    # Generate the rolling harmonic mean
-    harm_means = np.empty((ts.shape[0] / agg_period))
-    samp_sums = np.empty((ts.shape[0] / agg_period))
-    flow_sums = np.empty((ts.shape[0] / agg_period))
-    #TODO should we be using ts.resample here?
-    for j, i in enumerate(np.arange(0, ts.shape[0], agg_period)):
-        end = i + agg_period  # end index of period
-        ss = np.sum(ts['Samples'][i:end])  # sum of samples
-        samp_sums[j] = ss
-        sf = np.sum(ts['Total_Flow'][i:end])  # sum of flows
-        flow_sums[j] = sf
-        hm = sf / np.sum(np.divide(ts['Total_Flow'][i:end], ts['Avg_Speed'][i:end]))
-        harm_means[j] = hm
-    # Create output dataframe and write to csv
-    out = ts.iloc[np.arange(0, ts.shape[0], agg_period), :]
-    out.drop('Avg_Occ', axis=1, inplace=True)
-    out.drop('Observed', axis=1, inplace=True)
-    out.drop('Samples', axis=1, inplace=True)
-    out.drop('Total_Flow', axis=1, inplace=True)
-    out.drop('Avg_Speed', axis=1, inplace=True)
-    out['Samples_Rollup'] = samp_sums
-    out['Total_Flow_Rollup'] = flow_sums
-    out['Avg_Speed_Rollup'] = harm_means
-    out.to_csv(out_name, header=True, index=True)
-    os.chdir(start_dir)
+    for period, name in zip(agg_periods, out_names):
+        # Sums and the flow-weighted harmonic mean speed of every window
+        samp_sums, flow_sums, harm_means = rollup_arrays(ts['Samples'].values, ts['Total_Flow'].values,
+                                                         ts['Avg_Speed'].values, period)
+        # Create output dataframe and write to csv
+        out = ts.iloc[np.arange(0, ts.shape[0], period), :].drop(
+            ['Avg_Occ', 'Observed', 'Samples', 'Total_Flow', 'Avg_Speed'], axis=1)
+        out['Samples_Rollup'] = samp_sums
+        out['Total_Flow_Rollup'] = flow_sums
+        out['Avg_Speed_Rollup'] = harm_means
+        out.index = out.index.strftime(TIMESTAMP_FORMAT)
+        out.index.name = 'Timestamp'
+        out.to_csv(os.path.join(station_path, name), header=True, index=True)
+
+
+def rollup_all_stations(parent_dir, agg_period, out_name, n_workers=1, manifest_path=None, nrows=105120):
+    """
+    Runs rollup_time_series for every station directory in parent_dir. Stations are processed in a pool of worker
+    processes and every completed station is appended to a manifest file, so a killed run can be restarted without
+    redoing finished stations. A station is skipped if all of its output files exist and either the manifest records it
+    for the current version of its time series, or the output files are newer than its time series.
+    :param parent_dir: (str) Path to the parent directory of the station time series directories.
+    :param agg_period: (int | [int]) See rollup_time_series.
+    :param out_name: (str | [str]) See rollup_time_series.
+    :param n_workers: (int) Number of worker processes. Default is 1, which processes everything in this process.
+    :param manifest_path: (str) Path to the manifest file. Defaults to rollup_manifest.txt in parent_dir.
+    :param nrows: (int) See rollup_time_series.
+    :return: ([str]) Names of the stations that failed, including those without a time series. They are not recorded
+    in the manifest.
+    """
+    out_names = out_name if isinstance(out_name, (list, tuple)) else [out_name]
+    if not manifest_path:
+        manifest_path = os.path.join(parent_dir, 'rollup_manifest.txt')
+    # Manifest lines are: station,mtime of the time series when the rollup was made
+    done = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as fi:
+            for line in fi:
+                parts = line.strip().split(',')
+                if len(parts) == 2:
+                    done[parts[0]] = parts[1]
+    stations = sorted([n for n in os.listdir(parent_dir) if n.isdigit()])
+    jobs = []
+    failed = []
+    for stat in stations:
+        stat_dir = os.path.join(parent_dir, stat)
+        try:
+            src_mtime = repr(os.path.getmtime(time_series_path(stat_dir)))
+        except OSError as e:
+            print 'FAILED station %s: %s' % (stat, repr(e))
+            failed.append(stat)
+            continue
+        out_mtimes = [os.path.getmtime(os.path.join(stat_dir, n)) for n in out_names
+                      if os.path.isfile(os.path.join(stat_dir, n))]
+        if len(out_mtimes) == len(out_names):  # Only skip stations that have every output
+            if done.get(stat) == src_mtime or min(out_mtimes) > float(src_mtime):
+                continue
+        jobs.append((stat_dir, agg_period, out_name, nrows))
+    print 'Stations to process: %d of %d' % (len(jobs), len(stations))
+    tic0 = time.time()
+    pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+    results = pool.imap_unordered(rollup_station_job, jobs) if pool else (rollup_station_job(job) for job in jobs)
+    with open(manifest_path, 'a') as fo:
+        for stat, src_mtime, secs, error in results:
+            if error:
+                print 'FAILED station %s: %s' % (stat, error)
+                failed.append(stat)
+                continue
+            fo.write('%s,%s\n' % (stat, src_mtime))
+            fo.flush()  # Survive a killed run
+            print 'Time to proces station %s: %f' % (stat, secs)
+    if pool:
+        pool.close()
+        pool.join()
+    print 'Total time to build rollups %d' % (time.time() - tic0)
+    return failed
 
 
 def generate_distributions(ts_df, metric, bins, days=None):
@@ -290,8 +479,8 @@ def generate_distributions(ts_df, metric, bins, days=None):
     Reads a station time series (output of station.generate_time_series()) and produces the empirical probabiltiy
     density distribution for the given days of the week.
 
-    :param ts_df: (str) Path to csv file with the station time series. This csv must be the output of
-    station.generate_time_series
+    :param ts_df: (str) Path to the station time series, either a station directory or its time_series.csv. Read with
+    read_time_series(), so a time_series.npz is used if present.
     :param metric: (str) Identifies the metric for which to generate a distribution. Either 'Count' or 'Speed'
     :param bins: (list) List of bin edges, including lower and upper bins. e.g [0,1,2,3] defines three bins. These bins
     describe the width the metric (e.g. how many mph wide should the speed distribution bins be?)
@@ -299,61 +488,68 @@ def generate_distributions(ts_df, metric, bins, days=None):
     Saturday = 6. Defaults to None. If None, all seven days used, days = [0, 1, ... 6]
     :return: ([[df...]]) List of lists of dataframes. Each sublist contains four dataframes: totals (histogram),
     proportions (distribution), variance of totals,
-    and variance of proportions.
+    and variance of proportions. Every dataframe has one row for each of the 288 5-minute slots of the day.
     """
     if not days:
         days = [0, 1, 2, 3, 4, 5, 6]
-    # Read the whole time series and convert the time strings to datetimes
-    ts = pd.read_csv(ts_df, sep=',')
-    ts['Timestamp'] = pd.to_datetime(ts['Timestamp'])
+    metric_col = get_metric_col(metric)
+    # Read the whole time series and count every (day, slot, bin) cell in one pass
+    tensor = distribution_tensor(read_time_series(ts_df), metric_col, bins)
+    return [distribution_frames(tensor[day], bins) for day in days]
 
-    # Get the column name for the metric for which disributions are being calculated
-    if metric.lower() == 'count':
-        metric_col = 'Total_Flow'
-    elif metric.lower() == 'speed':
-        metric_col = 'Avg_Speed'
+def build_station_distributions(stat_dir, count_bins, speed_bins, legacy_csv=True):
+    """
+    Builds the count and speed distributions of one station from a single read of its time series. The full
+    (day, slot, bin) count tensor of each metric is written to distributions.npz in stat_dir with the keys
+    'count_totals', 'count_bins', 'speed_totals' and 'speed_bins'. See read_distributions().
+    :param stat_dir: (str) Path to the station directory.
+    :param count_bins: (list) Bin edges of the count distribution. See generate_distributions().
+    :param speed_bins: (list) Bin edges of the speed distribution.
+    :param legacy_csv: (bool) If True, also write the totals and proportions csv files of every day to the
+    day-of-week subdirectories (0_Sun ... 6_Sat) expected by group_days().
+    :return: (None)
+    """
+    ts = read_time_series(stat_dir)
+    tensors = {'count': distribution_tensor(ts, 'Total_Flow', count_bins),
+               'speed': distribution_tensor(ts, 'Avg_Speed', speed_bins)}
+    bins = {'count': count_bins, 'speed': speed_bins}
+    np.savez_compressed(os.path.join(stat_dir, 'distributions.npz'),
+                        count_totals=tensors['count'], count_bins=np.asarray(count_bins, dtype=np.float64),
+                        speed_totals=tensors['speed'], speed_bins=np.asarray(speed_bins, dtype=np.float64))
+    if legacy_csv:
+        for day, day_dir in DAY_DIRS.items():
+            day_path = os.path.join(stat_dir, day_dir)
+            if not os.path.isdir(day_path):
+                os.mkdir(day_path)
+            for m, (tot_name, prop_name) in DIST_FILES.items():
+                totals, proportions = distribution_frames(tensors[m][day], bins[m])[0:2]
+                totals.to_csv(os.path.join(day_path, tot_name), sep=',', header=True, index=True)
+                proportions.to_csv(os.path.join(day_path, prop_name), sep=',', header=True, index=True)
+
+def generate_all_distributions(parent_dir, count_bins, speed_bins, n_workers=1, legacy_csv=True):
+    """
+    Runs build_station_distributions for every station directory in parent_dir.
+    :param parent_dir: (str) Path to the parent directory of the station time series directories.
+    :param count_bins: (list) Bin edges of the count distribution.
+    :param speed_bins: (list) Bin edges of the speed distribution.
+    :param n_workers: (int) Number of worker processes. Default is 1, which processes everything in this process.
+    :param legacy_csv: (bool) See build_station_distributions().
+    :return: (None)
+    """
+    stations = sorted([n for n in os.listdir(parent_dir) if n.isdigit()])
+    jobs = [(os.path.join(parent_dir, stat), count_bins, speed_bins, legacy_csv) for stat in stations]
+    tic0 = time.time()
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        for stat in pool.imap_unordered(build_station_distributions_job, jobs):
+            print 'Processed station %s' % stat
+        pool.close()
+        pool.join()
     else:
-        raise utils.util_exceptions.WrongParamError(
-            "The metric parameter must either be 'Count' or 'Speed'"
-        )
+        for job in jobs:
+            print 'Processed station %s' % build_station_distributions_job(job)
+    print 'Total time to build distributions %d' % (time.time() - tic0)
 
-    # Build a dict to map minutes since midnight to time string, e.g. 65:'01:05'
-    hours = [str(x/60) if len(str(x/60)) == 2 else '0'+str(x/60) for x in range(0, 60*24, 5)]
-    minutes = [str(x % 60) if len(str(x%60)) == 2 else '0'+str(x%60) for x in range(0, 60*24, 5)]
-    time_strs = [x+':'+y for x,y in zip(hours, minutes)]
-    time_dict = dict(zip(range(0, 60*24, 5), time_strs))
-
-    # Build the output dataframes
-    out = []  # Output list of lists of dataframes
-    for day in days:
-        # Extract specific day and metric
-        ts_temp = ts[ts['Timestamp'].apply(lambda t: t.weekday() == day)][['Timestamp', metric_col]]
-        # Add a column that only has the time since midnight 'hh:mm'
-        ts_temp['Minutes'] = ts_temp['Timestamp'].apply(lambda t: time_dict[60*t.hour + t.minute])
-        ##
-        # Totals dataframe
-        ##
-        # NOTE for some goddamn reason this groupby(*).apply(*) generates a series with shape (288,) where
-        # each element is an nd.array. So I then have to coerce it into a dataframe
-        series = ts_temp.groupby('Minutes').apply(lambda s: np.histogram(s[metric_col], bins=bins)[0])
-        totals = pd.DataFrame([a for a in series], index=series.index, columns=bins[0:-1])
-        ##
-        # Proportions dataframe
-        ##
-        proportions = totals.apply(lambda a: a/np.sum(a), axis=1)
-        ##
-        # Variance of totals dataframe
-        ##
-        row_totals = totals.sum(axis=1)
-        z = zip(row_totals, proportions.values)
-        var_tots = pd.DataFrame([np.power(a, 3)/(a-1)*b*(1-b) for a, b in z], index=row_totals.index,
-                                columns=proportions.columns)
-        ##
-        # Variance of proportions
-        ##
-        var_props = proportions.apply(lambda x: x*(1-x))
-        out.append([totals, proportions, var_tots, var_props])
-    return out
 #TODO improve the interface between generate_distributions and group_days. There is an implicit step, handled in my
 # executable, where the output of each call to generate_distributions is written to a subdirectory of specific format
 # group_days is expecting that same directory hierarchy.
@@ -369,57 +565,62 @@ def group_days(station_dir, days, metric='Both', out_dir=None):
     station_dir.
     :return:
     """
-    start_dir = os.getcwd()
-    os.chdir(station_dir)
-    # Get list of directories with day-of-week distributions
-    day_dict = {0: '0_Sun', 1: '1_Mon', 2: '2_Tue', 3: '3_Wed', 4: '4_Thur', 5: '5_Fri', 6: '6_Sat'}
-    # Create the output directories if do not already exist
-    if not os.path.isdir('7_Day_Groups'):
-        os.mkdir('7_Day_Groups')
-    agg_dir = os.path.abspath('7_Day_Groups')
-    os.chdir(agg_dir)
-    if not out_dir:
-        out_dir = os.path.abspath('_'.join([day_dict[day_int] for day_int in days]))
-    try:
-        os.mkdir(out_dir)
-    except OSError:  # Overwrite existing dirs by same name
-        shutil.rmtree(out_dir)
-        os.mkdir(out_dir)
-    os.chdir(station_dir)
-    # Decide which metrics to aggregates
-    m_names = {'count': ['counts_totals.csv', 'counts_proportions.csv'],
-               'speed': ['speed_totals.csv', 'speed_proportions.csv']}
+    group_days_multi(station_dir, [days], metric=metric, out_dirs=[out_dir] if out_dir else None)
+
+def group_days_multi(station_dir, day_groups, metric='Both', out_dirs=None):
+    """
+    Aggregates the day-of-week distributions of a station into several day groupings at once (e.g. weekdays, weekends,
+    Tue-Thu). The per-day totals are loaded once, from distributions.npz if build_station_distributions() wrote one
+    and from the day-of-week csv files otherwise. Each grouping is a sum over the day axis followed by a row
+    normalization. All outputs are written at the end. Existing output directories are reused and their files
+    overwritten.
+    :param station_dir: (str) Path to the station directory holding the distributions.
+    :param day_groups: ([[int]]) List of day groupings. Each is a list of days of week, Sunday = 0, Saturday = 6.
+    :param metric: (str) Defines which metric/s to aggregate. Default is 'Both', meaning both 'Counts' and 'Speed'
+    :param out_dirs: ([str]) Output directory of each grouping. Relative paths are relative to the 7_Day_Groups
+    directory in station_dir. If None, the directories are named after the days, e.g. 7_Day_Groups/6_Sat_0_Sun.
+    :return: ({str: {str: [df, df]}}) Maps each output directory to a dict of metric to the [totals, proportions]
+    dataframes.
+    """
     if metric.lower() == 'both':
-        m_file_names = m_names.values()
+        metrics = ['count', 'speed']
     elif metric.lower() == 'count' or metric.lower() == 'speed':
-        m_file_names = [m_names[metric.lower()]]
+        metrics = [metric.lower()]
     else:
         raise utils.util_exceptions.WrongParamError(
             'The metric parameter is invalid. Try using: None, Count, or Speed'
         )
-    df_lists = [[] for m in m_file_names]  # Each nested list will hold the totals dataframe from each day to be aggregated
-    # Open all the dataframes to aggregate and store in nested lists
-    for day_int in days:
-        os.chdir(day_dict[day_int])  # Move to day-of-week directory to read files
-        #  Loop through metrics to aggregate
-        for i, m in enumerate(m_file_names):
-            df_lists[i].append(pd.read_csv(m[0], sep=',', index_col='Minutes'))
-        os.chdir(station_dir)
-    #os.chdir(agg_dir)
-    # Sum the dataframes and write to output directory
-    os.chdir(out_dir)
-    for i, dfs in enumerate(df_lists):  # Iterate through each list of dataframes
-        totals = dfs[0]
-        for d in dfs[1:]:  # Iterate through the sublist and sum
-            totals = totals + d
-        proportions = totals.apply(lambda a: a/np.sum(a), axis=1)
-        totals.to_csv(m_file_names[i][0], sep=',', header=True, index=True)
-        proportions.to_csv(m_file_names[i][1], sep=',', header=True, index=True)
-    os.chdir(start_dir)
+    agg_dir = os.path.join(station_dir, '7_Day_Groups')
+    if not out_dirs:
+        out_dirs = ['_'.join([DAY_DIRS[day_int] for day_int in days]) for days in day_groups]
+    out_dirs = [os.path.join(agg_dir, d) for d in out_dirs]
+    # Load the per-day totals as (7, 288, n_bins) arrays
+    day_totals = load_day_totals(station_dir, metrics, sorted(set(sum([list(g) for g in day_groups], []))))
+    # Sum each grouping and normalize the rows
+    out = {}
+    for days, out_dir in zip(day_groups, out_dirs):
+        out[out_dir] = {}
+        for m in metrics:
+            tensor, index, columns = day_totals[m]
+            totals = tensor[list(days)].sum(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                proportions = totals / totals.sum(axis=1)[:, np.newaxis].astype(np.float64)
+            out[out_dir][m] = [pd.DataFrame(totals, index=index, columns=columns),
+                               pd.DataFrame(proportions, index=index, columns=columns)]
+    # Write everything
+    for out_dir, frames in out.items():
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        for m, (totals, proportions) in frames.items():
+            totals.to_csv(os.path.join(out_dir, DIST_FILES[m][0]), sep=',', header=True, index=True)
+            proportions.to_csv(os.path.join(out_dir, DIST_FILES[m][1]), sep=',', header=True, index=True)
+    return out
 
-def distribution_trendlines(parent_dir, target_dir, out_dir, metric, write_out=True):
+def distribution_trendlines(parent_dir, target_dir, out_dir, metric, write_out=True, n_threads=8):
     """
     Reads individual station distribution files and calculates the trendlines, the mean time series, into one output.
+    The histograms of all stations are stacked into one (n_stations, 288, n_bins) array by load_station_histograms()
+    and the trendlines are computed with a single product against the bin midpoints.
     :param parent_dir: (str) Path to the parent directory holding the station-level directories.
     :param target_dir: (str) Relative path, from station_dir to the directory with the distributions. The last
     sub-directory describes the day or day group.
@@ -429,46 +630,22 @@ def distribution_trendlines(parent_dir, target_dir, out_dir, metric, write_out=T
     :param metric: (str) Defines which metric to create trendlines for.
     :param write_out: (bool) Default is True. If True, writes the output dataframe to csv. Otherwise returns the dataframe
     without writing.
+    :param n_threads: (int) Number of threads used to read the station files. See load_station_histograms().
     :return: (DataFrame) Creates a dataframe of the trendlines  and writes them to a csv in the out_dir directory.
     """
-    stations = [n for n in os.listdir(parent_dir) if n.isdigit()]  # List of names of station directories
-    # Lookup for files to read based on metric parameter
     m_file_name = get_metric(metric)
-    # Seed the output dataframe. All csv files will have the same row labels and column headers.
-    #os.chdir(stations[0] + '/' + target_dir)
-    tp = os.path.join(parent_dir, stations[0], target_dir)
-    days_name = os.path.split(tp)[-1]  # Last directory in the target_dir. Describes the days aggergated
-    temp = pd.read_csv(os.path.join(tp, m_file_name), sep=',', header=0, index_col=0)  # Example of input csv
-    bins = temp.columns.astype(float)
-    delta = bins[1] - bins[0]
-    mid_points = bins + delta/2  # List of middle values of each bin
-    # Iterate through the stations and build mean time series
-    temp_list = []
-    for stat in stations:
-        print 'Processing %s' % (stat)
-        #os.chdir(stat + '/' + target_dir)
-        tp = os.path.join(parent_dir, stat, target_dir, m_file_name)
-        # Create a the weighted trendline
-        temp_list.append(pd.read_csv(tp, sep=',', header=0, index_col=0).
-                         apply(lambda x: np.dot(x, mid_points) / np.sum(x), axis=1))
-    # Create output directories
-    if not os.path.isdir(out_dir):
-        os.mkdir(out_dir)
-    #os.chdir(out_dir)
-    if not os.path.isdir(os.path.join(out_dir, days_name)):
-        os.mkdir(os.path.join(out_dir, days_name))
-    # try:
-    #     os.mkdir(os.path.join(out_dir, days_name))
-    # except OSError:
-    #     shutil.rmtree(os.path.join(out_dir, days_name))
-    #     os.mkdir(os.path.join(out_dir, days_name))
-    #os.chdir(days_name)
-    tp = os.path.join(out_dir, days_name, m_file_name.split('.')[0] + '_trendlines.csv')
-    # Concat the trendlines into one df and write to output
-    out = pd.concat(temp_list, axis=1).transpose()
-    out.index = stations
+    days_name = os.path.split(os.path.normpath(target_dir))[-1]  # Last directory in the target_dir. Describes the days
+    stations, bins, hists = load_station_histograms(parent_dir, target_dir, metric, n_threads=n_threads)
+    mid_points = bins + (bins[1] - bins[0])/2.0  # List of middle values of each bin
+    # Weighted mean of every station and slot
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trends = np.einsum('sij,j->si', hists, mid_points) / hists.sum(axis=2)
+    out = pd.DataFrame(trends, index=stations, columns=TIME_STRINGS)
     if write_out:
-        out.to_csv(tp)
+        # Create output directories
+        if not os.path.isdir(os.path.join(out_dir, days_name)):
+            os.makedirs(os.path.join(out_dir, days_name))
+        out.to_csv(os.path.join(out_dir, days_name, m_file_name.split('.')[0] + '_trendlines.csv'))
     return out
 
 def time_period_analysis(parent_dir, target_dir, time_period, metric, out_dir, write_out=True):
@@ -483,61 +660,52 @@ def time_period_analysis(parent_dir, target_dir, time_period, metric, out_dir, w
     :param out_dir: (str) Path to where to write the time period analysis.
     :param write_out: (bool) Default is True. If True, writes the output dataframe to csv. Otherwise returns the dataframe
     without writing.
-    :return: (None)
+    :return: (DataFrame) See time_period_analysis_multi().
+    """
+    return time_period_analysis_multi(parent_dir, target_dir, [time_period], metric, out_dir, write_out=write_out)[0]
+
+def time_period_analysis_multi(parent_dir, target_dir, time_periods, metric, out_dir, write_out=True):
+    """
+    Runs the time period analysis for several time periods from a single load of the station histograms. The
+    percentiles, mean and standard deviation are computed directly from the binned counts of all stations at once,
+    without expanding the histograms into observations. See histogram_stats().
+    :param parent_dir: (str) Path to the parent directory holding the station-level directories.
+    :param target_dir: (str) Relative path, from station_dir to the directory with the distributions.
+    :param time_periods: ([(str, str)]) List of (start, end) times, format 'hh:mm'. Both ends are included. A period
+    whose end is earlier than its start wraps around midnight.
+    :param metric: (str) Defines which metric to analyze.
+    :param out_dir: (str) Path to where to write the time period analysis. Each period is written to a sub directory
+    named after it, e.g. 07_00_09_00.
+    :param write_out: (bool) Default is True. If True, writes the output dataframes to csv.
+    :return: ([DataFrame]) One dataframe per time period. One row per station with any observations, with the
+    percentile, mean and std columns followed by the summed counts of each bin.
     """
-    stations = [n for n in os.listdir(parent_dir) if n.isdigit()]  # List of names of station directories
     m_file_name = get_metric(metric)  # Get the metric file name to read
-    # Create the output directory
-    if not os.path.isdir(out_dir):
-        #os.mkdir(out_dir)
-        os.makedirs(out_dir)
-    time_dir = os.path.join(out_dir, '_'.join(time_period[0].split(':') + time_period[1].split(':')))
-    try:
-        os.mkdir(time_dir)
-    except OSError:  # Overwrite if already exists
-        shutil.rmtree(time_dir)
-        os.mkdir(time_dir)
-    # Find the midpoints of the bins
-    tp = os.path.join(parent_dir, stations[0], target_dir, m_file_name)
-    temp = pd.read_csv(tp, sep=',', header=0, index_col=0)
-    bins = temp.columns.astype(float)
+    stations, bins, hists = load_station_histograms(parent_dir, target_dir, metric)
     mid_points = bins + (bins[1] - bins[0])/2.0
-    # Loop through each station and extract the time_period
-    temp_list = []
-    out_stations = []  # List of station ids that will be included in final aggregate
-    for stat in stations:
-        print 'Processing station %s' % stat
-        tp = os.path.join(parent_dir, stat, target_dir, m_file_name)
-        # Check if time bin includes midnight, which will cause the "later" time to be a smaller number
-        t_start = int(time_period[0].split(':')[0])
-        t_end = int(time_period[1].split(':')[0])
-        if t_start < t_end:
-            # sum over the time period
-            temp = pd.read_csv(tp, sep=',', header=0, index_col=0).loc[time_period[0]:time_period[1]].sum()
-        else:
-            temp = pd.read_csv(tp, sep=',', header=0, index_col=0)
-            idx_start = np.searchsorted(temp.index.values, time_period[0])
-            idx_end = np.searchsorted(temp.index.values, time_period[1])
-            mask = [True] * temp.shape[0]
-            mask[idx_end+1:idx_start] = [False]*(idx_start - idx_end - 1)
-            temp = temp.loc[mask].sum()
+    slot_minutes = np.arange(0, 60*24, 5)
+    out = []
+    for time_period in time_periods:
+        t_start, t_end = [int(t.split(':')[0])*60 + int(t.split(':')[1]) for t in time_period]
+        if t_start <= t_end:
+            mask = (slot_minutes >= t_start) & (slot_minutes <= t_end)
+        else:  # The time period includes midnight
+            mask = (slot_minutes >= t_start) | (slot_minutes <= t_end)
+        counts = hists[:, mask, :].sum(axis=1)
         # Some ramp detectors do not report speed, so we need to check if any speed observations exist:
-        if temp.sum():
-            # obsvs is vector where each speed is repeated the number of times observed.
-            obsvs = np.concatenate([np.repeat(val, n) for val, n in zip(mid_points, temp.values)])
-            m = np.mean(obsvs)
-            s = np.std(obsvs)
-            pct = np.percentile(obsvs, [5, 15, 25, 50, 75, 85, 95])  # percentiles
-            temp2 = pd.Series(np.concatenate((pct+[m]+[s], temp.values)))
-            temp_list.append(temp2)
-            out_stations.append(stat)
-    out = pd.concat(temp_list, axis=1).transpose()
-    out.index = out_stations
-    out.columns = np.concatenate((['5p', '15p', '25p', '50p', '75p', '85p', '95p', 'mean', 'std'],
-                                  mid_points.values.astype(str)))
-    print mid_points
-    if write_out:
-        out.to_csv(os.path.join(time_dir, m_file_name.split('.')[0] + '_analysis.csv'), header=True, index=True)
+        keep = counts.sum(axis=1) > 0
+        pct, m, sd = histogram_stats(counts[keep], mid_points, [5, 15, 25, 50, 75, 85, 95])
+        df = pd.DataFrame(np.column_stack((pct, m, sd, counts[keep])),
+                          index=[stat for stat, k in zip(stations, keep) if k],
+                          columns=np.concatenate((['5p', '15p', '25p', '50p', '75p', '85p', '95p', 'mean', 'std'],
+                                                  mid_points.astype(str))))
+        if write_out:
+            time_dir = os.path.join(out_dir, '_'.join(time_period[0].split(':') + time_period[1].split(':')))
+            if not os.path.isdir(time_dir):
+                os.makedirs(time_dir)
+            df.to_csv(os.path.join(time_dir, m_file_name.split('.')[0] + '_analysis.csv'), header=True, index=True)
+        out.append(df)
+    return out
 
 
 
@@ -549,6 +717,534 @@ def time_period_analysis(parent_dir, target_dir, time_period, metric, out_dir, w
 def calc_row_var(x, row_totals):
     coef = np.power(row_totals[x.index], 3)/float(row_totals[x.index])*x*(1-x)
 
+def extract_station_rows(in_path, target_ids, out_file, chunksize=500000, station_cols_only=False):
+    """
+    Streams a gzipped station data file in chunks and writes the rows of the target stations to out_file.
+    :param in_path: (str) Path to the gzipped station data file.
+    :param target_ids: (np.array) IDs of the stations to keep.
+    :param out_file: (str) Path of the output csv.
+    :param chunksize: (int) Number of rows to read at a time.
+    :param station_cols_only: (bool) If True, only the 12 station-level columns are read and written.
+    :return: (int) Number of extracted rows.
+    """
+    target_strs = [str(i) for i in target_ids]  # Fields are read as strings, so compare against string IDs
+    usecols = range(len(STATION_HEAD)) if station_cols_only else None
+    reader = pd.read_csv(in_path, sep=',', compression='gzip', header=None, usecols=usecols, dtype=str,
+                         chunksize=chunksize)
+    n_rows = 0
+    with open(out_file, 'w') as fo:
+        for chunk in reader:
+            chunk = chunk[chunk[1].isin(target_strs)]  # Hash-based membership test
+            chunk.to_csv(fo, sep=',', index=False, header=False)
+            n_rows += chunk.shape[0]
+    return n_rows
+
+def open_station_file(path):
+    """
+    :param path: (str) Path to a station data file.
+    :return: (file) The file opened for reading in binary mode. Files ending in .gz are decompressed as they are read.
+    """
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def read_last_line(path, block_size=65536):
+    """
+    Reads the last non-empty line of a text file. Plain files are read backwards from the end in blocks. Gzipped files
+    can not be seeked, so they are decompressed in blocks and only the tail is kept.
+    :param path: (str) Path to the file.
+    :param block_size: (int) Number of bytes to read at a time.
+    :return: (str) The last line, without the line break.
+    """
+    if path.endswith('.gz'):
+        tail = ''
+        with gzip.open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), ''):
+                tail = (tail + block)[-2*block_size:]
+        return tail.rstrip('\r\n').rsplit('\n', 1)[-1]
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        tail = ''
+        while pos > 0 and '\n' not in tail.rstrip('\r\n'):
+            pos = max(pos - block_size, 0)
+            f.seek(pos)
+            tail = f.read(end - pos)
+    return tail.rstrip('\r\n').rsplit('\n', 1)[-1]
+
+def station_file_date(path, last=False):
+    """
+    Finds the date of a station data file, from its name if it has one (e.g. d04_text_station_5min_2014_05_01.txt.gz).
+    Otherwise the Timestamp of the first, or last, row of the file is used.
+    :param path: (str) Path to the station data file.
+    :param last: (bool) If the name has no date, use the last row instead of the first.
+    :return: (datetime.date)
+    """
+    match = FILE_DATE_PATTERN.search(os.path.basename(path))
+    if match:
+        return datetime.date(*[int(g) for g in match.groups()])
+    if last:
+        line = read_last_line(path)
+    else:
+        with open_station_file(path) as f:
+            line = f.readline()
+    return datetime.datetime.strptime(line.split(',')[0].split()[0], '%m/%d/%Y').date()
+
+def read_joined_day(joined_path, day):
+    """
+    Reads the rows of one day from a file written by join_stations(), using its index to seek straight to them.
+    :param joined_path: (str) Path to the combined file.
+    :param day: (str | datetime.date) The day, '%m/%d/%Y' if a string.
+    :return: (str) The rows of the day as csv text, in the format of the station data files.
+    """
+    if isinstance(day, datetime.date):
+        day = day.strftime('%m/%d/%Y')
+    index = pd.read_csv(joined_path + '.index.csv', sep=',')
+    rows = index[index['date'] == day]
+    text = []
+    with open(joined_path, 'rb') as f:
+        for offset, length in zip(rows['offset'], rows['length']):
+            f.seek(offset)
+            block = f.read(length)
+            if joined_path.endswith('.gz'):
+                block = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(block)
+            text.append(block)
+    return ''.join(text)
+
+def read_station_file(path, typed=True, columns=None):
+    """
+    Reads the station-level columns of one raw station data file. Gzipped files are decompressed transparently. The
+    per-lane columns, and any station-level columns not in columns, are skipped by the parser.
+
+    With typed=True the columns get the compact dtypes of STATION_DTYPES: Station int32, District int16, Fwy, Dir and
+    Type categoricals and the measures float32. Timestamp is int64 seconds since the epoch. A day file only has 288
+    distinct timestamps, so they are read as a categorical and only the categories are parsed with TIMESTAMP_FORMAT.
+    :param path: (str) Path to the station data file.
+    :param typed: (bool) If False, dtypes are inferred by pandas and Timestamp is kept as a string. This is the
+    representation written to time_series.csv by generate_time_series_V2 and generate_time_series_shuffle.
+    :param columns: ([str]) Names of the STATION_HEAD columns to read. Defaults to all of them. The output keeps the
+    STATION_HEAD order.
+    :return: (pd.DataFrame) The STATION_HEAD columns.
+    """
+    if columns is None:
+        columns = STATION_HEAD
+    elif set(columns) - set(STATION_HEAD):
+        raise utils.util_exceptions.WrongParamError(
+            'Unknown station columns: %s. Try using some of: %s' % (', '.join(sorted(set(columns) - set(STATION_HEAD))),
+                                                                   ', '.join(STATION_HEAD))
+        )
+    names = [c for c in STATION_HEAD if c in columns]
+    usecols = [STATION_HEAD.index(c) for c in names]
+    if not typed:
+        return pd.read_csv(path, sep=',', header=None, index_col=False, usecols=usecols, names=names)
+    df = pd.read_csv(path, sep=',', header=None, index_col=False, usecols=usecols, names=names,
+                     dtype=dict((c, STATION_DTYPES[c]) for c in names))
+    if 'Timestamp' in names:
+        stamps = pd.to_datetime(df['Timestamp'].cat.categories, format=TIMESTAMP_FORMAT).values
+        stamps = stamps.astype('datetime64[s]').astype(np.int64)
+        df['Timestamp'] = stamps[df['Timestamp'].cat.codes.values]
+    return df
+
+def concat_station_frames(frames):
+    """
+    Concatenates dataframes read by read_station_file(), keeping its compact dtypes.
+    :param frames: ([pd.DataFrame]) Dataframes with the same columns, in the order to stack them.
+    :return: (pd.DataFrame) The rows of all the frames, with a fresh index.
+    """
+    df = pd.concat(frames, ignore_index=True)
+    for col in ['Fwy', 'Dir', 'Type']:  # Categories that differ between files are concatenated as objects
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+def iter_station_files(jobs, read_func=read_station_file, n_workers=2, prefetch=4):
+    """
+    Shared reader of the raw station data files. Yields read_func(*job) for every job, in order. With n_workers > 0 the
+    jobs run in a pool of worker processes that decompress and parse the upcoming files while the caller processes the
+    current one. At most prefetch results are pending at any time, so memory is bounded by prefetch parsed files no
+    matter how far the readers get ahead of the caller.
+    :param jobs: ([tuple]) The arguments of read_func for each file, starting with its path.
+    :param read_func: (function) Module-level function that reads one file. Must be picklable when n_workers > 0.
+    Defaults to read_station_file(), with typed dtypes.
+    :param n_workers: (int) Number of reader processes. If 0, the files are read in this process when requested.
+    :param prefetch: (int) Maximum number of files being read ahead. Should be at least n_workers to keep every
+    reader busy.
+    :return: (generator) The results of read_func, in the order of jobs.
+    """
+    if n_workers < 1:
+        for job in jobs:
+            yield read_func(*job)
+        return
+    pool = multiprocessing.Pool(n_workers)
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(read_func, job))
+            if len(pending) >= max(prefetch, 1):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:  # Also runs if the caller stops iterating early
+        pool.terminate()
+        pool.join()
+
+def rollup_arrays(samples, flow, speed, agg_period):
+    """
+    Aggregates 5-minute arrays into windows of agg_period rows. The arrays are reshaped to (n_windows, agg_period) and
+    reduced along the rows, ignoring NaN. A trailing partial window is padded with NaN.
+    :param samples: (np.array) Samples of each 5-minute row.
+    :param flow: (np.array) Total_Flow of each 5-minute row.
+    :param speed: (np.array) Avg_Speed of each 5-minute row.
+    :param agg_period: (int) Number of rows in each window.
+    :return: ((np.array, np.array, np.array)) Sum of samples, sum of flows and flow-weighted harmonic mean speed of
+    each window. A window without observations has zero sums and a NaN speed.
+    """
+    n_windows = -(-flow.shape[0] // agg_period)  # Ceiling division
+    pad = np.full(n_windows*agg_period - flow.shape[0], np.nan)
+
+    def windows(a):
+        return np.concatenate((a.astype(np.float64), pad)).reshape((n_windows, agg_period))
+
+    flow_w = windows(flow)
+    samp_sums = np.nansum(windows(samples), axis=1)
+    flow_sums = np.nansum(flow_w, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harm_means = flow_sums / np.nansum(flow_w / windows(speed), axis=1)
+    return samp_sums, flow_sums, harm_means
+
+def distribution_tensor(ts, metric_col, bins):
+    """
+    Histograms a station time series for every day of the week and 5-minute slot of the day at once. The day, slot and
+    bin of every observation are computed as integer arrays and counted with a single np.bincount.
+    :param ts: (pd.DataFrame) Station time series with a datetime Timestamp column. See read_time_series().
+    :param metric_col: (str) Column to histogram, e.g. 'Total_Flow' or 'Avg_Speed'.
+    :param bins: (list) List of bin edges. Same semantics as np.histogram: the last bin includes its right edge.
+    :return: (np.array) Counts with shape (7, 288, len(bins) - 1). Day of week is Sunday = 0, ... Saturday = 6.
+    """
+    bins = np.asarray(bins, dtype=np.float64)
+    n_bins = bins.shape[0] - 1
+    t = ts['Timestamp'].values.astype('datetime64[ns]')
+    day = t.astype('datetime64[D]')
+    weekday = (day.astype(np.int64) + 4) % 7  # 1970-01-01 was a Thursday
+    slot = ((t - day) // np.timedelta64(5, 'm')).astype(np.int64)
+    x = ts[metric_col].values.astype(np.float64)
+    b = np.searchsorted(bins, x, side='right') - 1  # NaN sorts past the last edge
+    b[x == bins[-1]] = n_bins - 1
+    valid = (b >= 0) & (b < n_bins)
+    cell = (weekday[valid]*288 + slot[valid])*n_bins + b[valid]
+    return np.bincount(cell, minlength=7*288*n_bins).reshape((7, 288, n_bins))
+
+def distribution_frames(totals, bins):
+    """
+    Derives the four distribution dataframes of generate_distributions() from a (288, n_bins) array of counts.
+    :param totals: (np.array) Counts of one day, shape (288, len(bins) - 1). See distribution_tensor().
+    :param bins: (list) List of bin edges.
+    :return: ([df...]) Totals, proportions, variance of totals and variance of proportions. Indexed by the 'hh:mm'
+    time of each slot, with the lower bin edges as columns.
+    """
+    index = pd.Index(TIME_STRINGS, name='Minutes')
+    columns = bins[0:-1]
+    row_totals = totals.sum(axis=1)[:, np.newaxis].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportions = totals / row_totals
+        var_tots = np.power(row_totals, 3)/(row_totals - 1)*proportions*(1 - proportions)
+    var_props = proportions*(1 - proportions)
+    return [pd.DataFrame(a, index=index, columns=columns) for a in [totals, proportions, var_tots, var_props]]
+
+def build_station_distributions_job(job):
+    """
+    Runs build_station_distributions() for one station.
+    :param job: ((str, list, list, bool)) The arguments of build_station_distributions().
+    :return: (str) Name of the station directory.
+    """
+    build_station_distributions(*job)
+    return os.path.basename(os.path.normpath(job[0]))
+
+def read_distributions(stat_dir):
+    """
+    Loads the distributions.npz written by build_station_distributions().
+    :param stat_dir: (str) Path to the station directory.
+    :return: ({str: (np.array, np.array)}) Maps the metric, 'count' or 'speed', to its (7, 288, n_bins) count tensor
+    and its bin edges.
+    """
+    arrays = np.load(os.path.join(stat_dir, 'distributions.npz'))
+    return dict((m, (arrays[m + '_totals'], arrays[m + '_bins'])) for m in ['count', 'speed'])
+
+def load_day_totals(station_dir, metrics, days):
+    """
+    Loads the day-of-week totals of a station's distributions. Uses distributions.npz if it exists and otherwise reads
+    the totals csv file of each day in days.
+    :param station_dir: (str) Path to the station directory.
+    :param metrics: ([str]) Metrics to load, 'count' and/or 'speed'.
+    :param days: ([int]) Days of week that must be loaded. Sunday = 0, Saturday = 6.
+    :return: ({str: (np.array, pd.Index, pd.Index)}) Maps the metric to its (7, 288, n_bins) totals, the row index and
+    the bin columns. Days that were not loaded are zero.
+    """
+    out = {}
+    if os.path.isfile(os.path.join(station_dir, 'distributions.npz')):
+        dists = read_distributions(station_dir)
+        for m in metrics:
+            tensor, bins = dists[m]
+            out[m] = (tensor, pd.Index(TIME_STRINGS, name='Minutes'), pd.Index(bins[0:-1]))
+        return out
+    for m in metrics:
+        frames = dict((day, pd.read_csv(os.path.join(station_dir, DAY_DIRS[day], DIST_FILES[m][0]), sep=',',
+                                        index_col='Minutes')) for day in days)
+        first = frames[days[0]]
+        tensor = np.zeros((7,) + first.shape, dtype=first.values.dtype)
+        for day, df in frames.items():
+            tensor[day] = df.values
+        out[m] = (tensor, first.index, first.columns)
+    return out
+
+def load_station_histograms(parent_dir, target_dir, metric, n_threads=8):
+    """
+    Stacks the distribution totals of every station in parent_dir into one array. The csv files are read in a pool of
+    threads, since the work is I/O bound. The stacked array is cached in parent_dir and reused as long as it is newer
+    than every input file and the set of stations has not changed.
+    :param parent_dir: (str) Path to the parent directory holding the station-level directories.
+    :param target_dir: (str) Relative path, from station_dir to the directory with the distributions.
+    :param metric: (str) Either 'Count' or 'Speed'.
+    :param n_threads: (int) Number of threads used to read the files.
+    :return: (([str], np.array, np.array)) The station names, the lower bin edges and the totals with shape
+    (n_stations, 288, n_bins). Slots missing from a file are zero.
+    """
+    m_file_name = get_metric(metric)
+    stations = sorted([n for n in os.listdir(parent_dir) if n.isdigit()])  # List of names of station directories
+    paths = [os.path.join(parent_dir, stat, target_dir, m_file_name) for stat in stations]
+    cache_name = '_'.join(['_hist_cache'] + [p for p in os.path.normpath(target_dir).split(os.sep) if p] +
+                          [m_file_name.split('.')[0]]) + '.npz'
+    cache_path = os.path.join(parent_dir, cache_name)
+    if os.path.isfile(cache_path):
+        cache = np.load(cache_path)
+        if list(cache['stations']) == stations and \
+                os.path.getmtime(cache_path) > max([os.path.getmtime(p) for p in paths]):
+            return stations, cache['bins'], cache['hists']
+
+    def read_hist(path):
+        return pd.read_csv(path, sep=',', header=0, index_col=0).reindex(TIME_STRINGS).fillna(0)
+
+    pool = ThreadPool(n_threads)
+    frames = pool.map(read_hist, paths)
+    pool.close()
+    pool.join()
+    bins = frames[0].columns.astype(float).values
+    hists = np.stack([f.values for f in frames])
+    np.savez(cache_path, stations=np.array(stations), bins=bins, hists=hists)
+    return stations, bins, hists
+
+def histogram_stats(counts, mid_points, percentiles):
+    """
+    Computes percentiles, mean and standard deviation from binned counts, treating every count as an observation at
+    its bin midpoint. The results equal np.percentile (linear interpolation), np.mean and np.std of the expanded
+    observations, but only cumulative sums and weighted moments of the counts are needed.
+    :param counts: (np.array) Counts with shape (n_rows, n_bins). Every row must have a positive total.
+    :param mid_points: (np.array) Midpoint of each bin.
+    :param percentiles: ([float]) Percentiles to compute, between 0 and 100.
+    :return: ((np.array, np.array, np.array)) Percentiles with shape (n_rows, len(percentiles)), means and standard
+    deviations.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    mid_points = np.asarray(mid_points, dtype=np.float64)
+    n = counts.sum(axis=1)
+    cum = counts.cumsum(axis=1)
+    mean = counts.dot(mid_points) / n
+    std = np.sqrt((counts*(mid_points[np.newaxis, :] - mean[:, np.newaxis])**2).sum(axis=1) / n)
+
+    def value_at(rank):
+        # Value of the observation at 0-based rank in each row: the bin where the cumulative count passes rank
+        idx = (cum <= rank[:, np.newaxis]).sum(axis=1)
+        return mid_points[np.minimum(idx, mid_points.shape[0] - 1)]
+
+    pct = np.empty((counts.shape[0], len(percentiles)))
+    for j, p in enumerate(percentiles):
+        pos = (n - 1)*p/100.0
+        lo = np.floor(pos)
+        v_lo = value_at(lo)
+        pct[:, j] = v_lo + (value_at(np.minimum(lo + 1, n - 1)) - v_lo)*(pos - lo)
+    return pct, mean, std
+
+def get_metric_col(metric):
+    # Lookup of the time series column for the metric parameter
+    if metric.lower() == 'count':
+        return 'Total_Flow'
+    elif metric.lower() == 'speed':
+        return 'Avg_Speed'
+    else:
+        raise utils.util_exceptions.WrongParamError(
+            "The metric parameter must either be 'Count' or 'Speed'"
+        )
+
+def rollup_station_job(job):
+    """
+    Runs rollup_time_series for one station.
+    :param job: ((str, int | [int], str | [str], int)) The station directory and the agg_period, out_name and nrows
+    arguments of rollup_time_series.
+    :return: ((str, str, float, str)) Station name, mtime of its time series, processing time and the error message,
+    which is None on success.
+    """
+    stat_dir, agg_period, out_name, nrows = job
+    stat = os.path.basename(os.path.normpath(stat_dir))
+    src_mtime = repr(os.path.getmtime(time_series_path(stat_dir)))
+    tic = time.time()
+    try:
+        rollup_time_series(agg_period, stat_dir, out_name, nrows=nrows)
+    except Exception as e:
+        return stat, src_mtime, time.time() - tic, repr(e)
+    return stat, src_mtime, time.time() - tic, None
+
+def time_series_path(stat_dir):
+    """
+    :param stat_dir: (str) Path to a station directory.
+    :return: (str) Path to the time series file that read_time_series() loads from stat_dir.
+    """
+    npz_path = os.path.join(stat_dir, 'time_series.npz')
+    return npz_path if os.path.isfile(npz_path) else os.path.join(stat_dir, 'time_series.csv')
+
+def partition_station_rows(station_df, target_ids):
+    """
+    Splits a dataframe of raw station data into per-station blocks of csv text. Rows are filtered to target_ids and
+    stable sorted on the Station column, so the rows of each station keep their chronological order.
+    :param station_df: (pd.DataFrame) Raw station data, read with header=None. Column 1 is the station ID.
+    :param target_ids: (np.array) IDs of the stations to keep.
+    :return: ([(int, str)]) List of (station ID, csv text) tuples. Only the station-level columns are kept.
+    """
+    df = station_df.iloc[:, 0:len(STATION_HEAD)]
+    df = df[df.iloc[:, 1].isin(target_ids)]
+    if not df.shape[0]:
+        return []
+    df = df.iloc[np.argsort(df.iloc[:, 1].values, kind='mergesort')]
+    # Format the whole file in one call and slice the lines at the station boundaries
+    lines = df.to_csv(sep=',', header=False, index=False).splitlines(True)
+    ids, starts = np.unique(df.iloc[:, 1].values, return_index=True)
+    ends = np.append(starts[1:], len(lines))
+    return [(int(i), ''.join(lines[s:e])) for i, s, e in zip(ids, starts, ends)]
+
+def partition_station_file(path, target_ids):
+    """
+    Reads one station data file and splits it with partition_station_rows().
+    :param path: (str) Path to the station data file.
+    :param target_ids: (np.array) IDs of the stations to keep.
+    :return: ([(int, str)]) List of (station ID, csv text) tuples.
+    """
+    temp = read_station_file(path, typed=False)  # The csv text must match generate_time_series_V2
+    return partition_station_rows(temp, target_ids)
+
+def write_station_time_series_job(job):
+    """
+    Runs write_station_time_series() for one station.
+    :param job: ((str, str, str)) The spill_path, stat_dir and out_format arguments.
+    :return: (None)
+    """
+    write_station_time_series(*job)
+
+def write_station_time_series(spill_path, stat_dir, out_format='csv'):
+    """
+    Writes the time series and summary.csv of one station from its spill file.
+    :param spill_path: (str) Path to the station's spill file, the headerless csv rows written by StationSpill. If it
+    does not exist, the station had no observations and empty outputs are written.
+    :param stat_dir: (str) Path to the output directory of the station. It is created if it does not exist.
+    :param out_format: (str) Format of the time series: 'csv', 'npz' or 'both'. See write_time_series().
+    :return: (None)
+    """
+    if not os.path.isdir(stat_dir):
+        os.mkdir(stat_dir)
+    if os.path.isfile(spill_path):
+        # round_trip recovers the exact values formatted by partition_station_rows()
+        temp_ts = pd.read_csv(spill_path, sep=',', header=None, names=STATION_HEAD, index_col=False,
+                              float_precision='round_trip')
+    else:
+        temp_ts = pd.DataFrame(columns=STATION_HEAD)
+    write_time_series(temp_ts, stat_dir, out_format)
+    ts_agg_measures(temp_ts).to_csv(os.path.join(stat_dir, 'summary.csv'), sep=',', index=False)
+
+def write_time_series(ts_df, stat_dir, out_format='csv'):
+    """
+    Writes a station time series to stat_dir.
+    :param ts_df: (pd.DataFrame) Station time series with the STATION_HEAD columns. Timestamps are strings.
+    :param stat_dir: (str) Path to the station directory.
+    :param out_format: (str) 'csv' writes time_series.csv, 'npz' writes the columnar time_series.npz and 'both' writes
+    both files. The npz stores Timestamp as int64 seconds since the epoch, Station and District as integers, Fwy, Dir
+    and Type as categorical codes and the measures as float32. It is several times smaller than the csv and is loaded
+    without any parsing. See read_time_series().
+    :return: (None)
+    """
+    if out_format.lower() not in ['csv', 'npz', 'both']:
+        raise utils.util_exceptions.WrongParamError(
+            "The out_format parameter must be 'csv', 'npz' or 'both'"
+        )
+    if out_format.lower() in ['csv', 'both']:
+        ts_df.to_csv(os.path.join(stat_dir, 'time_series.csv'), sep=',', index=False)
+    if out_format.lower() in ['npz', 'both']:
+        arrays = {'Timestamp': pd.to_datetime(ts_df['Timestamp'], format=TIMESTAMP_FORMAT).values.
+                  astype('datetime64[s]').astype(np.int64),
+                  'Station': ts_df['Station'].values.astype(np.int32),
+                  'District': ts_df['District'].values.astype(np.int16)}
+        for col in ['Fwy', 'Dir', 'Type']:
+            cat = pd.Categorical(ts_df[col])
+            categories = np.asarray(cat.categories)
+            if categories.dtype == object:
+                categories = categories.astype(str)
+            arrays[col] = cat.codes
+            arrays[col + '_categories'] = categories
+        for col in ['Length', 'Samples', 'Observed', 'Total_Flow', 'Avg_Occ', 'Avg_Speed']:
+            arrays[col] = ts_df[col].values.astype(np.float32)
+        np.savez_compressed(os.path.join(stat_dir, 'time_series.npz'), **arrays)
+
+def read_time_series(station_path):
+    """
+    Loads a station time series. Reads the columnar time_series.npz if it exists and falls back to time_series.csv
+    otherwise. All consumers of station time series should use this loader.
+    :param station_path: (str) Path to a station directory, or to the time_series.csv or time_series.npz in it.
+    :return: (pd.DataFrame) Time series with the STATION_HEAD columns. Timestamp is a datetime64 column. If read from
+    the npz, Fwy, Dir and Type are categoricals and the measures are float32.
+    """
+    stat_dir = station_path if os.path.isdir(station_path) else os.path.dirname(station_path)
+    path = time_series_path(stat_dir)
+    if path.endswith('.npz'):
+        arrays = np.load(path)
+        ts = pd.DataFrame({'Timestamp': pd.to_datetime(arrays['Timestamp'], unit='s')})
+        for col in STATION_HEAD[1:]:
+            if col in ['Fwy', 'Dir', 'Type']:
+                ts[col] = pd.Categorical.from_codes(arrays[col], arrays[col + '_categories'])
+            else:
+                ts[col] = arrays[col]
+        return ts
+    ts = pd.read_csv(path, sep=',')
+    ts['Timestamp'] = pd.to_datetime(ts['Timestamp'], format=TIMESTAMP_FORMAT)
+    return ts
+
+class StationSpill(object):
+    """
+    Per-station append buffers of csv text. The buffers are held in memory and appended to one spill file per station
+    once their total size exceeds max_bytes.
+    """
+
+    def __init__(self, spill_dir, max_bytes):
+        """
+        :param spill_dir: (str) Path to the directory to write the spill files.
+        :param max_bytes: (int) Total size of the buffers before they are spilled to disk.
+        """
+        self.spill_dir = spill_dir
+        self.max_bytes = max_bytes
+        self.buffers = defaultdict(list)
+        self.n_bytes = 0
+
+    def append(self, stat_id, text):
+        self.buffers[stat_id].append(text)
+        self.n_bytes += len(text)
+        if self.n_bytes > self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        for stat_id, chunks in self.buffers.items():
+            with open(self.spill_path(stat_id), 'a') as fo:
+                fo.write(''.join(chunks))
+        self.buffers = defaultdict(list)
+        self.n_bytes = 0
+
+    def spill_path(self, stat_id):
+        return os.path.join(self.spill_dir, '%s.csv' % stat_id)
+
 def get_id_time_series(station_df, stat_id):
     """
     Parses a dataframe of extracted station data and extracts a time series of count and speed data for
@@ -598,11 +1294,14 @@ def reindex_timeseries(ts_df, start_time_string='05/01/2014 00:00:00', days=365)
     """
     If the time series is missing observations, inserts a row with NaN values. That way every dataframe is the same
     size.
-    :param ts_df: (pd.DataFrame)
+    :param ts_df: (pd.DataFrame) Indexed by the Timestamp strings, or by datetimes (see read_time_series())
     :return: (pd.DataFrame)
     """
     # Make the index for a full day
     start_datetime = datetime.datetime.strptime(start_time_string, "%m/%d/%Y %H:%M:%S")
+    if isinstance(ts_df.index, pd.DatetimeIndex):
+        time_index = pd.date_range(start_datetime, periods=days*24*60/5, freq='5min')
+        return ts_df.reindex(time_index, method=None, copy=True)
     delta = datetime.timedelta(minutes=5)
     time_index = [(start_datetime + i*delta).strftime("%m/%d/%Y %H:%M:%S") for i in np.arange(days*24*60/5)]
     # Return a new dataframe that has been reindexed to the full set of observations. Missing rows will have NaN vals
@@ -0,0 +1,142 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils.station
+import utils.util_exceptions
+
+__author__ = 'Andrew A Campbell'
+
+"""
+Dense station x time cube of the 5-minute station measures. Each field is stored as one [station, 5-minute slot] array
+in a .npy file and opened with numpy.memmap, so cross-station queries (e.g. all stations, Tuesdays, 07:00-09:00) are
+slices of the array instead of per-station file reads. The time axis uses the same fixed grid of 288 slots per day as
+utils.station.reindex_timeseries. Missing observations are NaN.
+"""
+
+CUBE_FIELDS = ['Total_Flow', 'Avg_Speed', 'Avg_Occ', 'Samples', 'Observed']
+SLOTS_PER_DAY = 288
+
+
+def build_station_cube(ts_dir, cube_dir, start_time_string='05/01/2014 00:00:00', days=365, fields=None):
+    """
+    Materializes the station time series in ts_dir into one memory-mappable array per field.
+    :param ts_dir: (str) Path to the parent directory of the station time series. See
+    utils.station.generate_time_series_shuffle.
+    :param cube_dir: (str) Path to the directory to write the cube. Created if it does not exist.
+    :param start_time_string: (str) First 5-minute slot of the grid, same format as utils.station.reindex_timeseries.
+    :param days: (int) Number of days in the grid.
+    :param fields: ([str]) Fields to store. Defaults to CUBE_FIELDS.
+    :return: (StationCube) The new cube, opened read-only.
+    """
+    if not fields:
+        fields = CUBE_FIELDS
+    if not os.path.isdir(cube_dir):
+        os.makedirs(cube_dir)
+    stations = sorted([n for n in os.listdir(ts_dir) if n.isdigit()], key=int)
+    start = np.datetime64(datetime.datetime.strptime(start_time_string, '%m/%d/%Y %H:%M:%S'))
+    n_slots = days*SLOTS_PER_DAY
+    arrays = {}
+    for f in fields:
+        arrays[f] = np.lib.format.open_memmap(os.path.join(cube_dir, f + '.npy'), mode='w+', dtype=np.float32,
+                                              shape=(len(stations), n_slots))
+        arrays[f][:] = np.nan
+    for i, stat in enumerate(stations):
+        print 'Processing station %s' % stat
+        ts = utils.station.read_time_series(os.path.join(ts_dir, stat))
+        slots = (ts['Timestamp'].values - start) // np.timedelta64(5, 'm')
+        mask = (slots >= 0) & (slots < n_slots)
+        for f in fields:
+            arrays[f][i, slots[mask]] = ts[f].values[mask]
+    for f in fields:
+        arrays[f].flush()
+    np.savez(os.path.join(cube_dir, 'cube_index.npz'), stations=np.array(stations, dtype=np.int64),
+             start_time_string=start_time_string, days=days, fields=np.array(fields))
+    del arrays
+    return StationCube(cube_dir)
+
+
+class StationCube(object):
+    """
+    Read-only view of a cube written by build_station_cube(). Field arrays are opened lazily with numpy.memmap, so only
+    the pages touched by a query are read from disk.
+    """
+
+    def __init__(self, cube_dir):
+        """
+        :param cube_dir: (str) Path to the directory written by build_station_cube().
+        """
+        self.cube_dir = cube_dir
+        index = np.load(os.path.join(cube_dir, 'cube_index.npz'))
+        self.stations = index['stations']  # Station IDs, one per row of the field arrays
+        self.start = datetime.datetime.strptime(str(index['start_time_string']), '%m/%d/%Y %H:%M:%S')
+        self.days = int(index['days'])
+        self.fields = [str(f) for f in index['fields']]
+        self.dates = [self.start + datetime.timedelta(days=d) for d in range(self.days)]
+        # Day of week of each day in the grid. Sunday = 0, ... Saturday = 6, as in utils.station.group_days
+        self.weekdays = np.array([(d.weekday() + 1) % 7 for d in self.dates])
+        self.__arrays = {}
+
+    def field(self, name):
+        """
+        :param name: (str) Name of the field. Must be one of self.fields.
+        :return: (np.memmap) Array of shape (n_stations, days, 288).
+        """
+        if name not in self.fields:
+            raise utils.util_exceptions.WrongParamError(
+                'The field %s is not in the cube. Try using one of: %s' % (name, ', '.join(self.fields))
+            )
+        if name not in self.__arrays:
+            self.__arrays[name] = np.load(os.path.join(self.cube_dir, name + '.npy'), mmap_mode='r')
+        return self.__arrays[name].reshape((len(self.stations), self.days, SLOTS_PER_DAY))
+
+    def station_index(self, stat_ids):
+        """
+        :param stat_ids: ([int | str]) Station IDs.
+        :return: (np.array) Row index of each station in the field arrays.
+        """
+        stat_ids = np.array(stat_ids, dtype=np.int64)
+        idx = np.searchsorted(self.stations, stat_ids)
+        if (idx >= len(self.stations)).any() or (self.stations[np.minimum(idx, len(self.stations) - 1)] !=
+                                                 stat_ids).any():
+            raise utils.util_exceptions.WrongParamError('Some of the station IDs are not in the cube')
+        return idx
+
+    def select(self, name, stations=None, days_of_week=None, start_time=None, end_time=None):
+        """
+        Extracts a block of the cube.
+        :param name: (str) Name of the field.
+        :param stations: ([int | str]) Station IDs to select. If None, all stations.
+        :param days_of_week: ([int]) Days of the week to select. Sunday = 0, ... Saturday = 6. If None, all days.
+        :param start_time: (str) Start of the time of day window, format 'hh:mm'. If None, midnight.
+        :param end_time: (str) End of the time of day window, format 'hh:mm'. The slot starting at end_time is not
+        included, so '07:00' to '09:00' is 24 slots. If None, the end of the day.
+        :return: (np.array) Array of shape (n_stations, n_days, n_slots) of the selected values.
+        """
+        st_idx = np.arange(len(self.stations)) if stations is None else self.station_index(stations)
+        day_idx = np.arange(self.days) if days_of_week is None else np.where(np.in1d(self.weekdays, days_of_week))[0]
+        slot_start = time_to_slot(start_time) if start_time else 0
+        slot_end = time_to_slot(end_time) if end_time else SLOTS_PER_DAY
+        slot_idx = np.arange(slot_start, slot_end)
+        return self.field(name)[np.ix_(st_idx, day_idx, slot_idx)]
+
+    def to_df(self, name, stat_id):
+        """
+        :param name: (str) Name of the field.
+        :param stat_id: (int | str) Station ID.
+        :return: (pd.Series) The full time series of one station, indexed by datetime.
+        """
+        values = self.field(name)[self.station_index([stat_id])[0]].ravel()
+        index = pd.date_range(self.start, periods=values.shape[0], freq='5min')
+        return pd.Series(values, index=index, name=name)
+
+
+def time_to_slot(time_string):
+    """
+    :param time_string: (str) Time of day, format 'hh:mm'.
+    :return: (int) Index of the 5-minute slot starting at time_string.
+    """
+    h, m = time_string.split(':')
+    return (int(h)*60 + int(m)) // 5
@@ -0,0 +1,159 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils.station
+import utils.util_exceptions
+
+__author__ = 'Andrew A Campbell'
+
+"""
+Lazy, out-of-core view of a directory of raw 5-minute station data files. A StationDataset only records the query:
+the station IDs, date range and columns to keep. Nothing is read until the data are iterated, one file at a time.
+The date range prunes whole files by the date in their name, the columns are pruned by the parser and the station and
+time filters are applied to each file before it is returned, so memory is bounded by one day file instead of the
+whole year.
+"""
+
+
+class StationDataset(object):
+    """
+    Query over the station data files in one directory. filter() returns a new, narrower dataset, so queries can be
+    built up in steps and reused:
+
+        ds = StationDataset('/data/station_5min/').filter(stations=[400001], start_date='05/01/2014',
+                                                            end_date='05/31/2014', columns=['Timestamp', 'Total_Flow'])
+        for chunk in ds.iter_chunks():
+            ...
+    """
+
+    def __init__(self, station_path, preamble='d04_text_station', stations=None, start_date=None, end_date=None,
+                 columns=None):
+        """
+        :param station_path: (str) Path to the directory with the station data files. Gzipped files are fine.
+        :param preamble: (str) Text that target file names begin with.
+        :param stations: ([int]) Station IDs to keep. If None, all stations.
+        :param start_date: (str | datetime.date) First day to keep, '%m/%d/%Y' if a string. If None, no lower bound.
+        :param end_date: (str | datetime.date) Last day to keep, inclusive. If None, no upper bound.
+        :param columns: ([str]) STATION_HEAD columns to keep. If None, all of them.
+        """
+        self.station_path = station_path
+        self.preamble = preamble
+        self.stations = None if stations is None else np.unique(np.array(stations, dtype=np.int32))
+        self.start_date = to_date(start_date)
+        self.end_date = to_date(end_date)
+        if columns is not None and set(columns) - set(utils.station.STATION_HEAD):
+            raise utils.util_exceptions.WrongParamError(
+                'Unknown station columns. Try using some of: %s' % ', '.join(utils.station.STATION_HEAD)
+            )
+        self.columns = None if columns is None else [c for c in utils.station.STATION_HEAD if c in columns]
+
+    def filter(self, stations=None, start_date=None, end_date=None, columns=None):
+        """
+        Narrows the query. Arguments left as None keep the current value.
+        :param stations: ([int]) Station IDs to keep.
+        :param start_date: (str | datetime.date) First day to keep.
+        :param end_date: (str | datetime.date) Last day to keep, inclusive.
+        :param columns: ([str]) STATION_HEAD columns to keep.
+        :return: (StationDataset) The new dataset. self is not changed.
+        """
+        return StationDataset(self.station_path, self.preamble,
+                              stations=self.stations if stations is None else stations,
+                              start_date=self.start_date if start_date is None else start_date,
+                              end_date=self.end_date if end_date is None else end_date,
+                              columns=self.columns if columns is None else columns)
+
+    def files(self):
+        """
+        :return: ([str]) Paths of the station data files that can hold rows in the date range, in chronological order.
+        Files without a date in their name are always kept.
+        """
+        fnames = sorted([n for n in os.listdir(self.station_path) if n[0:len(self.preamble)] == self.preamble])
+        paths = []
+        for name in fnames:
+            match = utils.station.FILE_DATE_PATTERN.search(name)
+            if match:
+                day = datetime.date(*[int(g) for g in match.groups()])
+                if (self.start_date and day < self.start_date) or (self.end_date and day > self.end_date):
+                    continue
+            paths.append(os.path.join(self.station_path, name))
+        return paths
+
+    def iter_chunks(self, n_workers=2, prefetch=4):
+        """
+        Reads the dataset one file at a time. Files are read ahead by utils.station.iter_station_files().
+        :param n_workers: (int) Number of reader processes. If 0, the files are read in this process.
+        :param prefetch: (int) Maximum number of files being read ahead.
+        :return: (generator) One pd.DataFrame per file, with the dtypes of utils.station.read_station_file().
+        """
+        jobs = [(path, self.stations, self.start_date, self.end_date, self.columns) for path in self.files()]
+        return utils.station.iter_station_files(jobs, read_dataset_file, n_workers, prefetch)
+
+    def to_df(self, n_workers=2, prefetch=4):
+        """
+        Materializes the dataset. Only use it once the query is narrow enough to fit in memory.
+        :param n_workers: (int) See iter_chunks().
+        :param prefetch: (int) See iter_chunks().
+        :return: (pd.DataFrame) All the rows of the dataset, in file order.
+        """
+        chunks = list(self.iter_chunks(n_workers, prefetch))
+        if not chunks:
+            return pd.DataFrame(columns=self.columns or utils.station.STATION_HEAD)
+        return utils.station.concat_station_frames(chunks)
+
+
+def read_dataset_file(path, stations=None, start_date=None, end_date=None, columns=None):
+    """
+    Reads one station data file with the filters of a StationDataset applied.
+    :param path: (str) Path to the station data file.
+    :param stations: (np.array) Station IDs to keep. If None, all stations.
+    :param start_date: (datetime.date) First day to keep. If None, no lower bound.
+    :param end_date: (datetime.date) Last day to keep, inclusive. If None, no upper bound.
+    :param columns: ([str]) STATION_HEAD columns to return. If None, all of them.
+    :return: (pd.DataFrame) The matching rows.
+    """
+    read_cols = None
+    if columns is not None:  # The filter columns are read even if they are not returned
+        read_cols = set(columns)
+        if stations is not None:
+            read_cols.add('Station')
+        if start_date or end_date:
+            read_cols.add('Timestamp')
+    df = utils.station.read_station_file(path, columns=read_cols)
+    mask = np.ones(df.shape[0], dtype=bool)
+    if stations is not None:
+        mask &= df['Station'].isin(stations).values
+    if start_date:
+        mask &= df['Timestamp'].values >= day_seconds(start_date)
+    if end_date:
+        mask &= df['Timestamp'].values < day_seconds(end_date) + 24*60*60
+    if not mask.all():
+        df = df[mask].reset_index(drop=True)
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def to_date(value):
+    """
+    :param value: (str | datetime.date | datetime.datetime | None) A date, '%m/%d/%Y' if a string.
+    :return: (datetime.date | None)
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%m/%d/%Y').date()
+
+
+def day_seconds(day):
+    """
+    :param day: (datetime.date)
+    :return: (int) Seconds since the epoch at midnight of day. Same clock as the Timestamp column of
+    utils.station.read_station_file().
+    """
+    return (day - datetime.date(1970, 1, 1)).days*24*60*60
@@ -1,5 +1,5 @@
-from collections import defaultdict
-from functools import partial
+from collections import defaultdict, namedtuple
+import multiprocessing
 import os
 import sys
 import traceback
@@ -11,6 +11,21 @@ from shapely.geometry import Point
 from sklearn import preprocessing, svm
 
 import counts
+import utils.outliers
+import utils.station
+import utils.util_exceptions
+
+# A registered filter. name is the filter method, which is also the reason recorded when a station fails it. kwargs are
+# the arguments of the hidden implementation, prepared at registration. features names the StationFeatures the filter
+# uses, empty if it does not need the station time series. cost is a hint of the work per station, see META_COST. Specs
+# only hold picklable values, so a StationFilter can be sent to worker processes.
+FilterSpec = namedtuple('FilterSpec', ['name', 'kwargs', 'features', 'cost'])
+# Cost of the filters that only need the station ID and metadata. They are run first, for all stations at once, by a
+# hidden __<name>_batch implementation. Filters with a higher cost are run per station, cheapest first.
+META_COST = 0
+# Cost of the filters that need the time series of all the stations at once. They are run last, by a hidden
+# __<name>_batch implementation, on the stations that are left after the other filters.
+BATCH_COST = float('inf')
 
 class StationFilter(object):
     """
@@ -22,8 +37,10 @@ class StationFilter(object):
     2) Add filters
     3) Run filters
 
-    Many of the filters involve looping through the station time series. Adding all the filters first allows us to only
-    do this loop once. The third step will populate the cleand_station_ids list.
+    Adding all the filters first lets run_filters order them by cost. The filters that only need the metadata are run
+    first, for all the stations at once. The survivors then go through the per-station filters, cheapest first, and the
+    time series of a station is only read once, when it reaches the first filter that needs it. The batch filters are
+    run last, on the stations that are left. The third step will populate the cleand_station_ids list.
     """
 
     def __init__(self, ts_path, meta_path):
@@ -36,8 +53,10 @@ class StationFilter(object):
         self.ts_path = ts_path
         self.meta_path = meta_path
         self.meta_df = pd.read_csv(self.meta_path, index_col=0)
-        self.filters = []   # List of filters to be applied during run_filters.
-        self.ts_df = None  # DataFrame of single station time series
+        self.filters = []   # List of FilterSpecs to be applied during run_filters.
+        self.features = None  # StationFeatures of the station being filtered
+        self.outlier_scores = None  # DataFrame of the station-day scores of outlier_detection
+        self.outlier_fractions = None  # Series of the fraction of outlier days of each station
 
         # Initialize the Station ID lists
         self.all_station_ids = np.unique(self.meta_df['ID'])  # All unique IDs in the meta_df
@@ -46,10 +65,6 @@ class StationFilter(object):
         self.removed_station_ids = set()  # List of Station IDs that have been removed
         self.removed_stats_reasons = defaultdict(list)
 
-        # Flags
-        self.iter_time_seris = False  # Flag to indicate whether we need to iterate through all the time series files,
-        # which is expensive
-
     def date_range(self, start_date, end_date):
         """
         Checks if station was active between start_date and end_date.
@@ -57,9 +72,7 @@ class StationFilter(object):
         :param end_date: (datetime.datetime)
         :return:
         """
-        self.iter_time_seris = True
-        partial_date_range = partial(self.__date_range, start_date=start_date, end_date=end_date)
-        self.filters.append(partial_date_range)
+        self.filters.append(FilterSpec('date_range', {'start_date': start_date, 'end_date': end_date}, (), 1))
 
     def __date_range(self, stat_ID, start_date, end_date):
         """
@@ -67,14 +80,10 @@ class StationFilter(object):
         :param stat_ID: (str, int)
         :param start_date:
         :param end_date:
-        :return:
+        :return: (bool) True if the station passes.
         """
-        start, end = counts.get_TS_summary_dates('./%s/summary.csv' % stat_ID)
-        if (start < start_date) & (end_date < end):  # Check if this station was active during target periods
-            self.cleaned_station_ids.add(stat_ID)
-        else:
-            self.removed_station_ids.add(stat_ID)
-            self.removed_stats_reasons[stat_ID].append('date_range')
+        start, end = counts.get_TS_summary_dates(os.path.join(self.ts_path, str(stat_ID), 'summary.csv'))
+        return bool((start < start_date) & (end_date < end))  # Check if this station was active during target periods
 
     def link_mapping(self, stat_link_map_path):
         """
@@ -85,21 +94,25 @@ class StationFilter(object):
         id_map = pd.read_csv(stat_link_map_path, index_col='ID', dtype='string')
         id_map.index = [str(i) for i in id_map.index]  # convert index back to string for easy lookups below
         # We only have to open stat_link_map_path once by passing in the DataFrame instead of the path.
-        partial_link_mapping = partial(self.__link_mapping, stat_link_map=id_map)
-        self.filters.append(partial_link_mapping)
+        self.filters.append(FilterSpec('link_mapping', {'stat_link_map': id_map}, (), META_COST))
     
     def __link_mapping(self, stat_ID, stat_link_map):
         """
         Hidden implementation of link_mapping filter.
         :param stat_ID:
         :param stat_link_map: (pd.DataFrame)
-        :return:
+        :return: (bool) True if the station passes.
         """
-        if stat_ID in stat_link_map.index:
-            self.cleaned_station_ids.add(stat_ID)
-        else:
-            self.removed_station_ids.add(stat_ID)
-            self.removed_stats_reasons[stat_ID].append('link_mapping')
+        return stat_ID in stat_link_map.index
+
+    def __link_mapping_batch(self, stations, stat_link_map):
+        """
+        Hidden implementation of link_mapping filter for all stations at once.
+        :param stations: ([str]) Station IDs.
+        :param stat_link_map: (pd.DataFrame)
+        :return: (set) The stations that pass.
+        """
+        return set(stations) & set(stat_link_map.index)
 
     def missing_data(self, date_list):
         """
@@ -109,37 +122,25 @@ class StationFilter(object):
         :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
         :return:
         """
-        self.iter_time_seris = True
-        partial_missing_data = partial(self.__missing_data, date_list=date_list)
-        self.filters.append(partial_missing_data)
+        self.filters.append(FilterSpec('missing_data', {'date_list': date_list}, ('hourly_flow',), 3))
 
     def __missing_data(self, stat_ID, date_list):
         """
         Hidden implementation of missing_data filter.
         :param stat_ID:
         :param date_list:  ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
-        :return:
+        :return: (bool) True if the station passes.
         """
-        # Check if the self.ts_df is synced with the current stat_ID being called
-        if str(self.ts_df['Station'][0]) != str(stat_ID):
-            sys.exit("ERROR: current self.ts_df does not match stat_ID")
+        # Check if the self.features is synced with the current stat_ID being called
+        if self.features.stat_ID != str(stat_ID):
+            sys.exit("ERROR: current self.features does not match stat_ID")
 
-        # Make a small df of only days matching the target day date. It is much much faster to resample the smaller one
-        vol_5min = self.ts_df[self.ts_df['date'].isin(date_list)][['Total_Flow', 'hour']] # all 5-min observations on desired dates
-        vol_5min.index = pd.to_datetime(vol_5min.index)
         #TODO is this really the best way to resample? What if we have one hour with only one 5-minute reading?
-        vol_hourly = vol_5min.resample('1h').sum()  # Rollup the 5-minute counts to 1-hr
-        vol_hourly['hour'] = [d.hour for d in vol_hourly.index]
-        # Now we need to groupby the hour and take the mean
-        hr_means = vol_hourly.groupby('hour').mean()  # Mean hourly flows for all days in date_list!!!
+        X = self.features.hourly_flow(date_list)  # Hourly flows, one row per day in date_list
         #TODO perhaps we should run this filter earlier. Imagine we have one hour with one observation on one day and the sensor is off for all others.
-        if not hr_means['Total_Flow'].isnull().any():
-            self.cleaned_station_ids.add(stat_ID)
-        else:
-            self.removed_station_ids.add(stat_ID)
-            self.removed_stats_reasons[stat_ID].append('missing_data')
+        return not np.isnan(X).all(axis=0).any()
 
-    def boundary_buffer(self, poly_path, epsg_poly=None, epsg_sensors=4326, buffer_dist=10):
+    def boundary_buffer(self, poly_path, epsg_poly=None, epsg_sensors=4326, buffer_dist=10, epsg_proj=3310):
         """
         Removes all sensor stations that are within buffer_dist of the study boundary. This is to avoid edge effects
 
@@ -151,58 +152,54 @@ class StationFilter(object):
         which is what PeMS uses in the metadata files.
         :param buffer_dist: (float) Distance in KM from study are border to filter out stations. i.e. Any stations
         within buffer_dist of the boundary will be removed.
+        :param epsg_proj: (str | int) EPSG code of a projected CRS in meters, used to measure buffer_dist. Defaults to
+        3310, California Albers.
         :return:
         """
 
         # NOTE: For SF SmartBay, use the shapefile at:
         # /GoogleDrive/ucb_smartcities_data/2. SF Smart Bay/b. Shapefiles/Dissolve/CA_TAZ_9_counties_Dissolved.shp
 
-        # Load the polygon and convert it to the CRS of the stations
+        # Load the polygon and convert it to the projected CRS
         gdf_poly = gpd.read_file(poly_path)
         if not bool(gdf_poly.crs) | bool(epsg_poly):
             sys.exit('ERROR boundary_buffer: must specify epsg_poly OR shapefile at poly_path must have CRS defined')
         elif not gdf_poly.crs:  # If no CRS specified in shapefile
             gdf_poly.crs = {'init': 'epsg:' + str(epsg_poly).strip()}
-        elif not epsg_poly:  # If no CRS specified in call to boundary_buffer
-            epsg_poly = gdf_poly.crs  # Set equal to the shapefile's CRS
+        proj_crs = {'init': 'epsg:' + str(epsg_proj).strip()}
+        gdf_poly = gdf_poly.to_crs(proj_crs)
 
-        if str(epsg_poly) != str(epsg_sensors):  # Reproject the polygon if not equal
-            # NOTE: if poly_path shapefile has no CRS, then this line will fail
-            gdf_poly.to_crs({'init': 'epsg:' + str(epsg_sensors).strip()}, inplace=True)
-        
-        # Load the station locations
+        # Load the unique station locations and project them too
         df_stat = self.meta_df[['ID', 'Latitude', 'Longitude']].drop_duplicates()
-        df_stat.set_index('ID', inplace=True)  # Index is int64
-        df_stat['geometry'] = df_stat.apply(lambda x: Point(x['Longitude'], x['Latitude']), axis=1)
-        gdf_stat = gpd.GeoDataFrame(df_stat, crs={'init': 'epsg:' + str(epsg_sensors).strip()})  # Convert to GeoDataFrame
+        stat_points = gpd.GeoSeries([Point(xy) for xy in zip(df_stat['Longitude'], df_stat['Latitude'])],
+                                    index=df_stat['ID'].values, crs={'init': 'epsg:' + str(epsg_sensors).strip()})
+        stat_points = stat_points.to_crs(proj_crs)
 
-        #Convert the buff_dist from KM to applicable CRS units
-        #TODO We assume WGS84 for now!
-        buffer_degrees = buffer_dist * 0.01 # roughly
+        # Create the boundary buffer, buffer_dist converted from KM to meters, and test all stations at once. A station
+        # that has moved is in the buffer if any of its locations is.
+        buffer_geom = gdf_poly.boundary.buffer(buffer_dist*1000.0).unary_union
+        in_buffer = stat_points.within(buffer_geom).values
+        buffer_ids = set(str(i) for i in stat_points.index[in_buffer])
 
-        #Create the boundary buffer
-        boundary = gdf_poly.boundary
-        gdf_buffer = gpd.GeoDataFrame(crs=gdf_poly.crs['init'],
-                                       geometry=boundary.buffer(buffer_degrees))
+        self.filters.append(FilterSpec('boundary_buffer', {'buffer_ids': buffer_ids}, (), META_COST))
 
-        partial_boundary_buffer = partial(self.__boundary_buffer,
-                                          buffer_geo_df=gdf_buffer,
-                                          stat_gdf=gdf_stat)
-        self.filters.append(partial_boundary_buffer)
-
-    def __boundary_buffer(self, stat_ID, buffer_geo_df, stat_gdf):
+    def __boundary_buffer(self, stat_ID, buffer_ids):
         """
-        Hiden implementation of boundary_buffer. geo_df has already been projected to match coordinates of the stations.
+        Hiden implementation of boundary_buffer. The stations within the buffer were found when the filter was added.
         :param stat_ID: (int | str)
-        :param buffer_geo_df: (GeoPandas.GeoDataFrame) GeoDataFrame of the polygon defining the boundary buffer.
-        :return:
+        :param buffer_ids: (set) IDs, as strings, of the stations within the boundary buffer.
+        :return: (bool) True if the station passes.
         """
-        # Check if station lies within the boundary buffer
-        if not buffer_geo_df.contains(stat_gdf.loc[int(stat_ID)].geometry).all():
-            self.cleaned_station_ids.add(stat_ID)
-        else:
-            self.removed_station_ids.add(stat_ID)
-            self.removed_stats_reasons[stat_ID].append('boundary_buffer')
+        return str(stat_ID) not in buffer_ids
+
+    def __boundary_buffer_batch(self, stations, buffer_ids):
+        """
+        Hidden implementation of boundary_buffer for all stations at once.
+        :param stations: ([str]) Station IDs.
+        :param buffer_ids: (set) IDs, as strings, of the stations within the boundary buffer.
+        :return: (set) The stations that pass.
+        """
+        return set(stations) - buffer_ids
 
     def outlier_detection_SVM(self, date_list, decision_dist, threshold, kernel='rbf', nu=0.5, gamma=0.0):
         #TODO consider using **kwargs to allow for different SVM implementations.
@@ -220,14 +217,11 @@ class StationFilter(object):
         :param gamma:
         :return:
         """
-        self.iter_time_seris = True
         # Initialize the classifier
         clf = svm.OneClassSVM(kernel=kernel, nu=nu, gamma=gamma)
-        partial_outlier_detection_SVM = partial(self.__outlier_detection_SVM, clf=clf,
-                                                date_list=date_list,
-                                                decision_dist=decision_dist,
-                                                threshold=threshold)
-        self.filters.append(partial_outlier_detection_SVM)
+        self.filters.append(FilterSpec('outlier_detection_SVM', {'clf': clf, 'date_list': date_list,
+                                                                 'decision_dist': decision_dist,
+                                                                 'threshold': threshold}, ('hourly_flow',), 4))
 
     def __outlier_detection_SVM(self, stat_ID, clf, date_list, decision_dist=4, threshold=0.05):
         """
@@ -238,34 +232,25 @@ class StationFilter(object):
         :param decision_dist: (float) Cutoff distance for defining outliers. Default found through manual testing.
         :param threshold: (float) Fraction of outlier days for a station to be removed. Default chosen based on
         manual testing.
-        :return:
+        :return: (bool) True if the station passes. None if the station has days with missing hours, which are not
+        classified.
         """
-        # Check if the self.ts_df is synced with the current stat_ID being called)
-        if str(self.ts_df['Station'][0]) != str(stat_ID):
-            sys.exit("ERROR: current self.ts_df does not match stat_ID")
+        # Check if the self.features is synced with the current stat_ID being called)
+        if self.features.stat_ID != str(stat_ID):
+            sys.exit("ERROR: current self.features does not match stat_ID")
 
         ##
         # Build the feature matrix, X (each day is a single row)
         ##
-
-        # Make a small df of only days matching the target day date. It is much much faster to resample the smaller one
-        vol_5min = self.ts_df[self.ts_df['date'].isin(date_list)][['Total_Flow', 'hour', 'date']] # all 5-min observations on desired dates
-        vol_5min.index = pd.to_datetime(vol_5min.index)
-        # Group by dates
-        groups = vol_5min.groupby(['date'])
-        n = len(groups.groups.keys())  # number of unique groups
-        X = np.empty((n, 24))  # Feature vector n x p
+        X = self.features.hourly_flow(date_list).copy()  # Feature vector n x p. Copied, it is scaled in place
         print 'Shape X: ' + str(X.shape)
-        for i, (dt, g) in enumerate(groups):
-            # dt is a date string, g is dataframe
-            X[i,:] = g.resample('1h').sum().values.flatten()  # Rollup the 5-minute counts to 1-hr
         # Drop any days w/ NaN
-        if np.isnan(X).any():
+        if X.shape[0] == 0 or np.isnan(X).any():
             # row_mask = ~np.any(np.isnan(X), axis=1)
             # X = X[row_mask, :]  # remove the rows w/ NaN values
             # self.removed_station_ids.add(stat_ID)
             # self.removed_stats_reasons[stat_ID].append('outlier_detection_SVM')
-            return
+            return None
 
         preprocessing.scale(X, axis=1, copy=False)
 
@@ -281,11 +266,53 @@ class StationFilter(object):
         ##
         n_out = np.sum(dists < -1*decision_dist)
         fract_out = np.true_divide(n_out, dists.shape[0])
-        if fract_out <= threshold:
-            self.cleaned_station_ids.add(stat_ID)
-        else:
-            self.removed_station_ids.add(stat_ID)
-            self.removed_stats_reasons[stat_ID].append('outlier_detection_SVM')
+        return fract_out <= threshold
+
+    def outlier_detection(self, date_list, cutoff, threshold, method='svm', **kwargs):
+        """
+        Batched version of outlier_detection_SVM. The hourly profiles of all the remaining stations are built at once,
+        and then scored by one of the detectors of utils.outliers, in worker processes if run_filters is given
+        n_workers. The scores and the fraction of outlier days of each station are kept in self.outlier_scores and
+        self.outlier_fractions, so cutoff and threshold can be tuned with utils.outliers.outlier_fractions() without
+        refitting.
+
+        :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
+        :param cutoff: (float) Days scoring above cutoff are outliers. With method 'svm', this is the decision_dist of
+        outlier_detection_SVM.
+        :param threshold: (float) Acceptable fraction of outlier days. If more than threshold fraction of days are
+        outliers, then we remove the stat_ID.
+        :param method: (str) 'svm', 'zscore' or 'mahalanobis'. See utils.outliers.outlier_scores.
+        :param kwargs: Arguments of the detector, e.g. kernel, nu and gamma for 'svm'.
+        :return:
+        """
+        if method not in ['svm', 'zscore', 'mahalanobis']:
+            raise utils.util_exceptions.WrongParamError(
+                "The method parameter must be one of 'svm', 'zscore' or 'mahalanobis'"
+            )
+        self.filters.append(FilterSpec('outlier_detection', {'date_list': date_list, 'cutoff': cutoff,
+                                                             'threshold': threshold, 'method': method,
+                                                             'kwargs': kwargs}, ('hourly_flow',), BATCH_COST))
+
+    def __outlier_detection_batch(self, stations, date_list, cutoff, threshold, method, kwargs, n_workers=1):
+        """
+        Hidden implementation of outlier_detection.
+        :param stations: ([str]) Station IDs.
+        :param date_list: ([str]) List of date strings.
+        :param cutoff: (float) Days scoring above cutoff are outliers.
+        :param threshold: (float) Acceptable fraction of outlier days.
+        :param method: (str) Detector, see utils.outliers.outlier_scores.
+        :param kwargs: (dict) Arguments of the detector.
+        :param n_workers: (int) Number of worker processes.
+        :return: ({str: bool}) True for the stations that pass. Stations that could not be scored are left out.
+        """
+        print 'Building the hourly profiles of %d stations' % len(stations)
+        profiles, present = utils.outliers.build_profiles(self.ts_path, stations, date_list, n_workers=n_workers)
+        print 'Scoring the profiles, method: %s' % method
+        scores = utils.outliers.outlier_scores(profiles, method, n_workers=n_workers, present=present, **kwargs)
+        fractions = utils.outliers.outlier_fractions(scores, cutoff)
+        self.outlier_scores = pd.DataFrame(scores, index=stations, columns=utils.outliers.date_days(date_list))
+        self.outlier_fractions = pd.Series(fractions, index=stations)
+        return dict((stat, frac <= threshold) for stat, frac in zip(stations, fractions) if not np.isnan(frac))
 
     def observed(self, date_list, threshold=0.5):
         """
@@ -295,9 +322,8 @@ class StationFilter(object):
         :param threshold: (float) Minimum acceptable fraction of observed data.
         :return:
         """
-        self.iter_time_seris = True
-        partial_observed = partial(self.__observed, date_list=date_list, threshold=threshold)
-        self.filters.append(partial_observed)
+        self.filters.append(FilterSpec('observed', {'date_list': date_list, 'threshold': threshold},
+                                       ('daily_observed',), 2))
 
     def __observed(self, stat_ID, date_list, threshold):
         """
@@ -305,50 +331,124 @@ class StationFilter(object):
         :param stat_ID: (int | str)
         :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
         :param threshold: (float) Minimum acceptable fraction of observed data.
-        :return:
+        :return: (bool) True if the station passes.
         """
-        obsv_5min = self.ts_df[self.ts_df['date'].isin(date_list)][['Observed', 'date']] # all 5-min observations on desired dates
-        means = obsv_5min.groupby(['date']).mean()
-        if not (means['Observed'] < threshold).any():
-            self.cleaned_station_ids.add(stat_ID)
-        else:
-            self.removed_station_ids.add(stat_ID)
-            self.removed_stats_reasons[stat_ID].append('observed')
+        means = self.features.daily_observed(date_list)  # Mean observed of each day in date_list
+        return not (means < threshold).any()
 
 
-    def run_filters(self, check_removed=True):
+    def run_filters(self, check_removed=True, n_workers=1):
         """
-        Run all the filters in self.filters.
+        Run all the filters in self.filters. The metadata-only filters (cost META_COST) are run first, as set operations
+        over all the stations. The remaining filters are then run station by station with run_station(), cheapest first,
+        and the time series of a station is only read if it reaches a filter that needs it. With check_removed, the
+        stations removed by the metadata filters are not opened at all. The batch filters (cost BATCH_COST) are run
+        last, on all the stations that are left.
+
+        Filters are run in this order, not the order they were added in. The sets of cleaned and removed stations do not
+        depend on the order, but the reasons recorded for a station do: with check_removed, only the first failure is
+        recorded.
         @:param check_removed: (bool) Check if as a station has already been added to the removed_station_ids by a
          previous filter. Skips the remaining filters.
+        :param n_workers: (int) Number of worker processes. Each worker gets a copy of this StationFilter and filters
+        whole stations with run_station(). The verdicts are merged here in the order of self.stations, so the results
+        are the same as with the default of 1, which runs everything in this process. Batch filters are given the same
+        number of workers.
         :return:
         """
         # Check if filters have been initialized before running.
         if not bool(self.filters):
             sys.exit("ERROR run_filters: no filters have been initialized.")
-        # Get list of all stations in the time series folder
-        o_dir = os.getcwd()
-        os.chdir(self.ts_path)
-        # stations = [n for n in os.listdir('.') if n.isdigit()]  # list of all station folder names
-
-        # Iterate through all the stations and apply filters
-        for i, stat in enumerate(self.stations):
-            print 'Processing station: %s' % stat
-            if self.iter_time_seris:  # Only open and process time series if necessary
-                self.ts_df = pd.read_csv('./%s/time_series.csv' % stat, index_col='Timestamp')
-                self.ts_df['date'] = [d[0:10] for d in self.ts_df.index]
-                self.ts_df['hour'] = [d[-8:-6] for d in self.ts_df.index]
-            # Apply all the filters in the self.filters
-            for filter in self.filters:
-                # TODO setting check_removed to False will cause the OneClass_SVM filtering to break due to empty features (Andrew 16/07/25)
-                if check_removed and stat in self.removed_station_ids:
-                    break
-                filter(str(stat))
-        try:
-            [self.cleaned_station_ids.remove(s) for s in self.removed_station_ids]  # remove the removed from the cleaned
-        except KeyError as e:
-            pass
-        os.chdir(o_dir)
+        stations = [str(stat) for stat in self.stations]
+        # Step 1 - Metadata filters for all the stations at once
+        cleaned = set()
+        reasons = defaultdict(list)
+        for spec in [f for f in self.filters if f.cost == META_COST]:
+            passed = getattr(self, '_StationFilter__%s_batch' % spec.name)(stations, **spec.kwargs)
+            for stat in stations:
+                if check_removed and (stat in self.removed_station_ids or stat in reasons):
+                    continue
+                if stat in passed:
+                    cleaned.add(stat)
+                else:
+                    reasons[stat].append(spec.name)
+        # Step 2 - Per-station filters
+        jobs = [(stat, check_removed, stat in self.removed_station_ids or stat in reasons) for stat in stations]
+        if check_removed:  # Skip the stations that are already removed
+            jobs = [job for job in jobs if not job[2]]
+        if not self.__station_specs():
+            jobs = []
+        if n_workers > 1 and jobs:
+            pool = multiprocessing.Pool(n_workers, initializer=init_filter_worker, initargs=(self,))
+            verdicts = pool.imap(filter_station_job, jobs)
+        else:
+            pool = None
+            verdicts = (self.run_station(*job) for job in jobs)
+        for stat, stat_cleaned, stat_reasons in verdicts:
+            if stat_cleaned:
+                cleaned.add(stat)
+            reasons[stat].extend(stat_reasons)
+        if pool:
+            pool.close()
+            pool.join()
+        # Step 3 - Time series filters for all the remaining stations at once
+        for spec in [f for f in self.filters if f.cost == BATCH_COST]:
+            batch = [stat for stat in stations if not check_removed or not
+                     (stat in self.removed_station_ids or reasons.get(stat))]
+            passed = getattr(self, '_StationFilter__%s_batch' % spec.name)(batch, n_workers=n_workers, **spec.kwargs)
+            for stat in batch:
+                if stat not in passed:  # The filter could not decide
+                    continue
+                if passed[stat]:
+                    cleaned.add(stat)
+                else:
+                    reasons[stat].append(spec.name)
+        # Step 4 - Merge the verdicts, in the order of self.stations
+        for stat in stations:
+            if stat in cleaned:
+                self.cleaned_station_ids.add(stat)
+            if reasons.get(stat):
+                self.removed_station_ids.add(stat)
+                self.removed_stats_reasons[stat].extend(reasons[stat])
+        self.cleaned_station_ids -= self.removed_station_ids  # remove the removed from the cleaned
+
+    def run_station(self, stat, check_removed=True, removed=False):
+        """
+        Applies the per-station filters, those with a cost above META_COST, to one station, cheapest first. The time
+        series is read, and its StationFeatures built, when the first filter that declares features is reached. Does
+        not change the ID sets, so stations can be run in any order, or in other processes.
+        :param stat: (str) Station ID.
+        :param check_removed: (bool) Skip the remaining filters once the station fails one. See run_filters().
+        :param removed: (bool) True if the station is already removed. With check_removed, no filters are run.
+        :return: ((str, bool, [str])) The station ID, whether any filter passed it and the names of the filters it
+        failed, in order.
+        """
+        stat = str(stat)
+        print 'Processing station: %s' % stat
+        cleaned = False
+        reasons = []
+        for spec in self.__station_specs():
+            # TODO setting check_removed to False will cause the OneClass_SVM filtering to break due to empty features (Andrew 16/07/25)
+            if check_removed and (removed or reasons):
+                break
+            if spec.features and self.features is None:  # Only open and process time series if necessary
+                self.features = StationFeatures(stat, utils.station.read_time_series(os.path.join(self.ts_path, stat)))
+            passed = getattr(self, '_StationFilter__' + spec.name)(stat, **spec.kwargs)
+            if passed is None:  # The filter could not decide
+                continue
+            if passed:
+                cleaned = True
+            else:
+                reasons.append(spec.name)
+        self.features = None
+        return stat, cleaned, reasons
+
+    def __station_specs(self):
+        """
+        :return: ([FilterSpec]) The per-station filters, cheapest first. Filters of equal cost keep the order they were
+        added in.
+        """
+        return sorted([f for f in self.filters if META_COST < f.cost < BATCH_COST], key=lambda f: f.cost)
 
     def set_stations(self, stat_list):
         """
@@ -365,24 +465,114 @@ class StationFilter(object):
     def write_removed_stations(self, removed_out_path):
         pd.DataFrame({'removed': self.removed_station_ids}).to_csv(removed_out_path, index=False)
 
+    def write_outlier_fractions(self, fractions_out_path):
+        if self.outlier_fractions is None:
+            raise utils.util_exceptions.WrongParamError(
+                'No outlier fractions to write. Add the outlier_detection filter and run the filters first.'
+            )
+        self.outlier_fractions.to_frame('outlier_fraction').to_csv(fractions_out_path, index_label='station')
+
     def write_removed_reasons_log(self, removed_reasons_path):
         with open(removed_reasons_path, 'w') as fo:
             for stat in self.removed_stats_reasons.items():
                 fo.write(str(stat)[1:-1] + '\n')
 
 
+class StationFeatures(object):
+    """
+    Derived features of one station time series, shared by the per-station filters. The timestamps are parsed once, and
+    each feature is computed the first time a filter asks for it and cached per date_list, so filters over the same
+    dates do not repeat the work. The days of a feature are the days of date_list found in the time series, in
+    chronological order.
+    """
 
+    def __init__(self, stat_ID, ts_df):
+        """
+        :param stat_ID: (int | str) Station ID.
+        :param ts_df: (pd.DataFrame) Time series of the station. See utils.station.read_time_series.
+        """
+        self.stat_ID = str(stat_ID)
+        self.ts_df = ts_df
+        self.index = pd.DatetimeIndex(ts_df['Timestamp'])
+        days = self.index.values.astype('datetime64[D]')
+        self.days, self.day_codes = np.unique(days, return_inverse=True)  # Unique days and the day of each row
+        self.day_strings = np.array(pd.DatetimeIndex(self.days).strftime('%m/%d/%Y'))
+        self.hours = ((self.index.values - days) // np.timedelta64(1, 'h')).astype(np.int64)  # Hour of each row
+        self.__cache = {}
+
+    def date_mask(self, date_list):
+        """
+        :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
+        :return: ((np.array, np.array)) Boolean mask of the rows on the dates, and the position of the day of each of
+        those rows in the features of date_list.
+        """
+        key = ('date_mask', tuple(date_list))
+        if key not in self.__cache:
+            day_in = np.in1d(self.day_strings, date_list)
+            day_pos = np.cumsum(day_in) - 1  # Position of each unique day among the selected days
+            mask = day_in[self.day_codes]
+            self.__cache[key] = (mask, day_pos[self.day_codes[mask]])
+        return self.__cache[key]
+
+    def hourly_flow(self, date_list):
+        """
+        :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
+        :return: (np.array) Matrix of days x 24 hourly flows, the sum of the 5-minute Total_Flow of each hour. NaN if
+        the hour has no observations.
+        """
+        key = ('hourly_flow', tuple(date_list))
+        if key not in self.__cache:
+            mask, day_pos = self.date_mask(date_list)
+            n_days = day_pos.max() + 1 if day_pos.shape[0] else 0
+            sums, counts = utils.outliers.nan_bincount(day_pos*24 + self.hours[mask],
+                                                       self.ts_df['Total_Flow'].values[mask], n_days*24)
+            self.__cache[key] = np.where(counts > 0, sums, np.nan).reshape((n_days, 24))
+        return self.__cache[key]
+
+    def daily_observed(self, date_list):
+        """
+        :param date_list: ([str]) List of date strings. Each data should follow the '%m/%d/%Y' format (e.g. 12/31/199)
+        :return: (np.array) Mean Observed of each day. NaN if the day has no observations.
+        """
+        key = ('daily_observed', tuple(date_list))
+        if key not in self.__cache:
+            mask, day_pos = self.date_mask(date_list)
+            n_days = day_pos.max() + 1 if day_pos.shape[0] else 0
+            sums, counts = utils.outliers.nan_bincount(day_pos, self.ts_df['Observed'].values[mask], n_days)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.__cache[key] = np.where(counts > 0, sums / counts, np.nan)
+        return self.__cache[key]
 
 
 
 
 
-        
 
 
 
+        
 
 
+######################################################################################################################
+# Helper functions
+######################################################################################################################
+# Entry points of the run_filters worker processes
 
+_worker_filter = None  # The StationFilter of a worker process, set by init_filter_worker()
 
+def init_filter_worker(station_filter):
+    """
+    Pool initializer of run_filters(). Keeps the worker's copy of the StationFilter.
+    :param station_filter: (StationFilter)
+    :return: (None)
+    """
+    global _worker_filter
+    _worker_filter = station_filter
 
+def filter_station_job(job):
+    """
+    Runs StationFilter.run_station() with the worker's copy of the StationFilter.
+    :param job: ((str, bool, bool)) The stat, check_removed and removed arguments.
+    :return: ((str, bool, [str])) See StationFilter.run_station().
+    """
+    return _worker_filter.run_station(*job)